@@ -0,0 +1,47 @@
+"""Data backfills scheduled by migrations, see app.utils.backfill."""
+
+import re
+
+from sqlalchemy import bindparam, select
+
+from app.models.db import User
+from app.utils.backfill import backfill
+
+#: The cost field of a bcrypt hash, such as $2b$12$
+BCRYPT_COST = re.compile(rb"^\$2[abxy]?\$(\d\d)\$")
+
+
+@backfill("pw_cost", User.__table__)
+def pw_cost(conn, ids):
+    """Read the cost of bcrypt hashes stored before costs were recorded.
+
+    Users whose hash is already at the configured cost are then not
+    rehashed on their next login.
+    """
+    user = User.__table__
+    rows = conn.execute(
+        select([user.c.id, user.c.pw_hash]).where(
+            user.c.id.in_(ids)
+            & user.c.pw_cost.is_(None)
+            & (user.c.pw_algo == "bcrypt")
+        )
+    )
+    costs = []
+    for user_id, pw_hash in rows:
+        match = BCRYPT_COST.match(pw_hash)
+        if match:
+            costs.append({"user_id": user_id, "cost": int(match.group(1))})
+
+    # A login may rehash the password between the select and the update,
+    # so only rows still without a cost are written
+    if costs:
+        conn.execute(
+            user.update()
+            .where(
+                (user.c.id == bindparam("user_id"))
+                & user.c.pw_cost.is_(None)
+                & (user.c.pw_algo == "bcrypt")
+            )
+            .values(pw_cost=bindparam("cost")),
+            costs,
+        )
@@ -0,0 +1,295 @@
+"""Flask CLI commands for bulk user management, backfills and the outbox.
+
+Files are CSV with a header row, or JSON lines, with the fields ``email``,
+``password`` and ``roles``. Roles are separated by semicolons in CSV and
+are a list in JSON lines. Instead of a password a record may carry an
+existing ``pw_hash`` with its ``pw_algo`` and ``pw_cost``, as written by
+``export --hashes``, and it is stored without hashing. Emails are stored
+stripped and lower case, as by the register view.
+
+Example Usage::
+
+    $ export FLASK_APP=run.py
+    $ export FLASK_APP_ENV=Dev
+    $ flask users import users.csv
+    $ flask users import users.jsonl --cost 10 --batch-size 5000
+    $ flask users export users.jsonl --hashes
+    $ flask backfill run --budget 600
+    $ flask backfill status
+    $ flask outbox run
+    $ flask outbox run --once --batch-size 500
+"""
+
+import csv
+import json
+from datetime import datetime
+from itertools import groupby, islice
+from typing import Dict, Iterator, List, TextIO
+
+import click
+from flask import current_app as app
+from flask.cli import AppGroup
+
+from app import backfills  # noqa: F401 registers the backfills
+from app.extensions import db, hash_pool, registered_emails
+from app.models.db import BackfillCheckpoint, Role, User, role_user_map
+from app.utils.backfill import run_backfills
+from app.utils.hashing import hashers
+from app.utils.outbox import pending, run_dispatcher
+
+#: Flask CLI group for the user commands
+users_cli = AppGroup("users", help="Bulk import and export of users.")
+
+#: Flask CLI group for the backfill commands
+backfill_cli = AppGroup("backfill", help="Batched data backfills.")
+
+#: Flask CLI group for the outbox commands
+outbox_cli = AppGroup("outbox", help="Transactional task outbox.")
+
+#: Fields written by the export command, in order
+EXPORT_FIELDS = ["email", "roles", "auth_fail", "timestamp"]
+HASH_FIELDS = ["pw_hash", "pw_algo", "pw_cost"]
+
+
+def read_records(file: TextIO, fmt: str) -> Iterator[Dict]:
+    """Stream user records from a CSV or JSON lines file.
+
+    Args:
+        file: The open file.
+        fmt: Either "csv" or "jsonl".
+
+    Returns:
+        An iterator of records with their roles as lists.
+    """
+    if fmt == "csv":
+        for record in csv.DictReader(file):
+            roles = record.get("roles") or ""
+            record["roles"] = [r for r in roles.split(";") if r]
+            yield record
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_batch(
+    records: List[Dict], role_ids: Dict[str, int], cost: int = None
+) -> int:
+    """Insert a batch of users that do not exist yet.
+
+    Users are inserted with one multi-row statement, their IDs are read
+    back with one query and their roles are inserted with another.
+
+    Args:
+        records: The user records.
+        role_ids: The ID of every role, keyed by name.
+        cost: The cost to hash passwords with instead of the configured
+            cost. Users are rehashed at the configured cost on login.
+
+    Returns:
+        The number of users inserted.
+    """
+
+    # Skip users that already exist or are repeated within the batch
+    by_email = {r["email"]: r for r in records if r.get("email")}
+    existing = db.session.query(User.email).filter(
+        User.email.in_(list(by_email))
+    )
+    for (email,) in existing:
+        by_email.pop(email, None)
+    records = list(by_email.values())
+    if not records:
+        return 0
+
+    # Hash every password that was not supplied already hashed
+    to_hash = [r for r in records if not r.get("pw_hash")]
+    pw_hashes = hash_pool.hashpw_many([r["password"] for r in to_hash], cost)
+    for record, pw_hash in zip(to_hash, pw_hashes):
+        record["pw_hash"] = pw_hash
+        record["pw_algo"] = hash_pool.algo
+        record["pw_cost"] = cost or hash_pool.cost
+
+    now = datetime.utcnow()
+    user_rows = [
+        {
+            "email": r["email"],
+            "pw_hash": _to_bytes(r["pw_hash"]),
+            "pw_algo": r.get("pw_algo") or "bcrypt",
+            "pw_cost": int(r["pw_cost"]) if r.get("pw_cost") else None,
+            "auth_fail": 0,
+            "timestamp": now,
+        }
+        for r in records
+    ]
+    db.session.execute(User.__table__.insert().values(user_rows))
+
+    ids = db.session.query(User.email, User.id).filter(
+        User.email.in_([r["email"] for r in records])
+    )
+    user_ids = dict(ids)
+    role_rows = [
+        {"user_id": user_ids[r["email"]], "role_id": role_ids[role]}
+        for r in records
+        for role in dict.fromkeys(r.get("roles") or ["user"])
+    ]
+    if role_rows:
+        db.session.execute(role_user_map.insert().values(role_rows))
+    registered_emails.add(user_ids)
+    db.session.commit()
+    return len(records)
+
+
+@users_cli.command("import")
+@click.argument("file", type=click.File("r"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]))
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--cost", type=int, help="Hash at this cost instead.")
+def import_users(file: TextIO, fmt: str, batch_size: int, cost: int):
+    """Import users from a CSV or JSON lines FILE."""
+
+    fmt = fmt or ("csv" if file.name.endswith(".csv") else "jsonl")
+    role_ids = dict(db.session.query(Role.name, Role.id))
+    records = read_records(file, fmt)
+
+    total = read = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        read += len(batch)
+        for record in batch:
+            if record.get("email"):
+                record["email"] = record["email"].strip().lower()
+            for role in record.get("roles") or ["user"]:
+                if role not in role_ids:
+                    raise click.ClickException(f'Unknown role "{role}"')
+            if not record.get("pw_hash") and not record.get("password"):
+                raise click.ClickException(
+                    f'No password for "{record.get("email")}"'
+                )
+            algo = record.get("pw_algo")
+            if record.get("pw_hash") and algo and algo not in hashers:
+                raise click.ClickException(f'Unknown pw_algo "{algo}"')
+        total += import_batch(batch, role_ids, cost)
+        click.echo(f"Imported {total} of {read} users", err=True)
+
+    app.logger.info(f"Imported {total} users, skipped {read - total}")
+
+
+@users_cli.command("export")
+@click.argument("file", type=click.File("w"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]))
+@click.option("--hashes", is_flag=True, help="Include password hashes.")
+@click.option("--batch-size", default=1000, show_default=True)
+def export_users(file: TextIO, fmt: str, hashes: bool, batch_size: int):
+    """Export every user to a CSV or JSON lines FILE."""
+
+    fmt = fmt or ("csv" if file.name.endswith(".csv") else "jsonl")
+    fields = EXPORT_FIELDS + (HASH_FIELDS if hashes else [])
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+
+    count = 0
+    for record in stream_users(batch_size):
+        record = {f: record[f] for f in fields}
+        if writer:
+            record["roles"] = ";".join(record["roles"])
+            writer.writerow(record)
+        else:
+            file.write(json.dumps(record) + "\n")
+        count += 1
+
+    app.logger.info(f"Exported {count} users")
+
+
+def stream_users(batch_size: int = 1000) -> Iterator[Dict]:
+    """Stream every user with their roles as plain records.
+
+    Rows are read as tuples rather than ORM objects, from a server side
+    cursor where the database supports one.
+
+    Args:
+        batch_size: The number of rows fetched at a time.
+
+    Returns:
+        An iterator of user records in ID order.
+    """
+    rows = (
+        db.session.query(
+            User.id,
+            User.email,
+            User.auth_fail,
+            User.timestamp,
+            User.pw_hash,
+            User.pw_algo,
+            User.pw_cost,
+            Role.name,
+        )
+        .outerjoin(role_user_map, role_user_map.c.user_id == User.id)
+        .outerjoin(Role, Role.id == role_user_map.c.role_id)
+        .order_by(User.id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+
+    for _, group in groupby(rows, key=lambda row: row.id):
+        group = list(group)
+        row = group[0]
+        yield {
+            "email": row.email,
+            "roles": sorted(r.name for r in group if r.name),
+            "auth_fail": row.auth_fail,
+            "timestamp": str(row.timestamp or ""),
+            "pw_hash": row.pw_hash.decode("ascii"),
+            "pw_algo": row.pw_algo,
+            "pw_cost": row.pw_cost,
+        }
+
+
+def _to_bytes(value) -> bytes:
+    """Encode a password hash read from a file."""
+    return value if isinstance(value, bytes) else value.encode("ascii")
+
+
+@backfill_cli.command("run")
+@click.option("--name", "names", multiple=True, help="Only this backfill.")
+@click.option("--batch-size", type=int, help="Rows per batch.")
+@click.option("--sleep", "sleep_sec", type=float, help="Pause per batch.")
+@click.option("--budget", "budget_sec", type=float, help="Seconds to run.")
+def run_backfill(
+    names: List[str], batch_size: int, sleep_sec: float, budget_sec: float
+):
+    """Run scheduled backfills, resuming from their checkpoints."""
+    processed = run_backfills(names, batch_size, sleep_sec, budget_sec)
+    for name, rows in processed.items():
+        click.echo(f"{name} : {rows} rows", err=True)
+
+
+@backfill_cli.command("status")
+def backfill_status():
+    """Show the progress of every scheduled backfill."""
+    query = BackfillCheckpoint.query.order_by(BackfillCheckpoint.timestamp)
+    for checkpoint in query:
+        if checkpoint.finished:
+            state = f"finished {checkpoint.finished}"
+        else:
+            state = f"at key {checkpoint.last_key}"
+        click.echo(f"{checkpoint.name} : {checkpoint.rows} rows, {state}")
+
+
+@outbox_cli.command("run")
+@click.option("--batch-size", type=int, help="Tasks per broker message.")
+@click.option("--poll", "poll_sec", type=float, help="Pause when empty.")
+@click.option("--once", is_flag=True, help="Stop once the outbox is empty.")
+def run_outbox(batch_size: int, poll_sec: float, once: bool):
+    """Publish tasks from the outbox in batches."""
+    total = run_dispatcher(batch_size, poll_sec, once)
+    click.echo(f"Published {total} tasks", err=True)
+
+
+@outbox_cli.command("status")
+def outbox_status():
+    """Show the number of tasks waiting in the outbox."""
+    click.echo(f"{pending()} tasks pending")
@@ -3,15 +3,18 @@
 from importlib import import_module
 from logging.config import dictConfig
 
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request
 from flask_login import LoginManager
 
 # noinspection PyProtectedMember
 from flask_wtf.csrf import CSRFError
 
 from app.blueprints import blueprints
+from app.cli import backfill_cli, outbox_cli, users_cli
 from app.extensions import init_extensions, lm
-from app.models.db import User
+from app.utils.hashing import HashPoolBusy
+from app.utils.ratelimit import RateLimited
+from app.utils.user import load_user
 from config import Prod
 
 
@@ -80,6 +83,11 @@ def create_app(config: str = None, path: str = "config") -> Flask:
     # Initialize all extensions
     init_extensions(app)
 
+    # Register the CLI commands
+    app.cli.add_command(backfill_cli)
+    app.cli.add_command(outbox_cli)
+    app.cli.add_command(users_cli)
+
     # Set the applications error handlers
     set_error_handlers(app)
 
@@ -159,6 +167,59 @@ def set_error_handlers(app: Flask):
             500,
         )
 
+    @app.errorhandler(HashPoolBusy)
+    def hash_pool_busy(error):
+        """Password hashing is saturated, ask the client to retry."""
+
+        app.logger.warning(
+            "Hash pool busy ({ip:s}) : {desc:s}".format(
+                ip=request.environ["REMOTE_ADDR"], desc=str(error)
+            )
+        )
+        headers = {"Retry-After": str(error.retry_after)}
+
+        # API clients expect JSON rather than an HTML page
+        if request.blueprint == "api":
+            return (
+                jsonify({"status": "failure", "message": "Server busy"}),
+                503,
+                headers,
+            )
+
+        err_req = "Server Busy"
+        err_opt = "Please try again in a few seconds"
+        return (
+            render_template(
+                "base/error.html", err_req=err_req, err_opt=err_opt
+            ),
+            503,
+            headers,
+        )
+
+    @app.errorhandler(RateLimited)
+    def rate_limited(error):
+        """A client has made too many requests, ask it to slow down."""
+
+        headers = {"Retry-After": str(error.retry_after)}
+
+        # API clients expect JSON rather than an HTML page
+        if request.blueprint == "api":
+            return (
+                jsonify({"status": "failure", "message": "Too many requests"}),
+                429,
+                headers,
+            )
+
+        err_req = "Too Many Requests"
+        err_opt = "Please wait a moment before trying again"
+        return (
+            render_template(
+                "base/error.html", err_req=err_req, err_opt=err_opt
+            ),
+            429,
+            headers,
+        )
+
     @app.errorhandler(CSRFError)
     def handle_csrf_error(error):
         """CSRF error handler."""
@@ -185,9 +246,6 @@ def set_user_loader(login_manager: LoginManager):
         login_manager: The Flask-Login manager object.
     """
 
-    def load_user(user_id):
-        return User.query.get(user_id)
-
     login_manager.user_loader(load_user)
     login_manager.login_view = "user.login"
     login_manager.login_message_category = "danger"
@@ -5,17 +5,57 @@ from flask import Flask
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
+from app.utils.breaker import CircuitBreaker
+from app.utils.cache import CredentialCache, UserCache
+from app.utils.counters import SlidingWindowCounter
+from app.utils.deferred import DeferredDispatch
+from app.utils.delivery import DeliveryEngine
+from app.utils.hashing import HashPool
+from app.utils.profiler import SQLProfiler
+from app.utils.ratelimit import RateLimiter
+from app.utils.registered import RegisteredEmails
+from app.utils.routing import RoutingSQLAlchemy
+from app.utils.revoke import RevocationList
+from app.utils.smtp import SMTPPool
+
 #: Flask-CeleryExt object
 celery = None
 
+#: Circuit breaker for publishing to the Celery broker
+broker_breaker: CircuitBreaker = CircuitBreaker(
+    "broker", "BROKER_BREAKER_FAILURES", "BROKER_BREAKER_RESET_SEC"
+)
+
+#: Cache of recently verified credentials
+cred_cache: CredentialCache = CredentialCache()
+
 #: Flask-WTF CSRF Protect object
 csrf: CSRFProtect = CSRFProtect()
 
-#: Flask-SQLAlchemy DB object
-db: SQLAlchemy = SQLAlchemy()
+#: API token revocation list
+revocations: RevocationList = RevocationList()
+
+#: Flask-SQLAlchemy DB object, routing reads to any replicas
+db: RoutingSQLAlchemy = RoutingSQLAlchemy()
+
+#: Publishes each request's outbox tasks after its response
+deferred: DeferredDispatch = DeferredDispatch()
+
+#: Concurrent email delivery engine
+delivery: DeliveryEngine = DeliveryEngine()
+
+#: Password hashing process pool
+hash_pool: HashPool = HashPool()
+
+#: Sliding window counter of failed logins per user
+login_failures: SlidingWindowCounter = SlidingWindowCounter(
+    prefix="fails", window_key="AUTH_FAIL_WINDOW_SEC"
+)
+
+#: Token bucket rate limiter for expensive views
+limiter: RateLimiter = RateLimiter()
 
 #: Flask-Login object
 lm: LoginManager = LoginManager()
@@ -26,6 +66,18 @@ mail: Mail = Mail()
 #: Flask-Migrate object
 migrate = Migrate()
 
+#: Per-request SQL profiler
+profiler: SQLProfiler = SQLProfiler()
+
+#: Shared Bloom filter of registered emails
+registered_emails: RegisteredEmails = RegisteredEmails()
+
+#: Pool of persistent SMTP connections
+smtp_pool: SMTPPool = SMTPPool()
+
+#: Cache of logged in user snapshots
+user_cache: UserCache = UserCache()
+
 
 def init_extensions(app: Flask):
     """Initialize all flask extensions.
@@ -36,11 +88,23 @@ def init_extensions(app: Flask):
 
     global celery
     celery = make_celery(app)
+    broker_breaker.init_app(app)
+    cred_cache.init_app(app)
     csrf.init_app(app)
     db.init_app(app)
+    deferred.init_app(app)
+    delivery.init_app(app, smtp_pool)
+    hash_pool.init_app(app)
+    limiter.init_app(app)
     lm.init_app(app)
+    login_failures.init_app(app)
     mail.init_app(app)
     migrate.init_app(app, db)
+    profiler.init_app(app)
+    registered_emails.init_app(app)
+    revocations.init_app(app)
+    smtp_pool.init_app(app)
+    user_cache.init_app(app)
 
 
 def make_celery(app: Flask):
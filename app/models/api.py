@@ -1,6 +1,8 @@
 """Models used for API request and response validation."""
 
-from pydantic import BaseModel
+from typing import List
+
+from pydantic import BaseModel, confloat
 
 
 class AuthReq(BaseModel):
@@ -25,6 +27,13 @@ class MessageReq(BaseModel):
     message: str
 
 
+class ProfilerReq(BaseModel):
+    """The request format for the SQL profiler settings API request."""
+
+    sample_rate: confloat(ge=0, le=1) = None
+    routes: List[str] = None
+
+
 class BaseResp(BaseModel):
     """General API response parameters."""
 
@@ -26,11 +26,23 @@ from flask_login import UserMixin
 from app.extensions import db
 
 
-#: Table mapping user roles to actual users
+#: Table mapping user roles to actual users. The primary key serves lookups
+#: by user and the reverse index lookups by role.
 role_user_map = db.Table(
     "role_user_map",
-    db.Column("user_id", db.Integer(), db.ForeignKey("user.id")),
-    db.Column("role_id", db.Integer(), db.ForeignKey("role.id")),
+    db.Column(
+        "user_id",
+        db.Integer(),
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Column(
+        "role_id",
+        db.Integer(),
+        db.ForeignKey("role.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Index("ix_role_user_map_role_id_user_id", "role_id", "user_id"),
 )
 
 
@@ -39,13 +51,21 @@ class User(db.Model, UserMixin):
 
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(256), unique=True, nullable=False)
-    pw_hash = db.Column(db.Binary(64), nullable=False)
+    pw_hash = db.Column(db.Binary(128), nullable=False)
+    pw_algo = db.Column(
+        db.String(16),
+        default="bcrypt",
+        server_default="bcrypt",
+        nullable=False,
+    )
+    pw_cost = db.Column(db.Integer)
     auth_fail = db.Column(db.Integer, default=0, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     roles = db.relationship(
         "Role",
         secondary=role_user_map,
-        backref=db.backref("users", lazy="dynamic"),
+        backref=db.backref("users", lazy="dynamic", passive_deletes=True),
+        passive_deletes=True,
     )
 
     def get_roles(self) -> List[str]:
@@ -63,3 +83,28 @@ class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class BackfillCheckpoint(db.Model):
+    """Database table storing the progress of each batched backfill."""
+
+    __tablename__ = "backfill_checkpoint"
+
+    name = db.Column(db.String(64), primary_key=True)
+    last_key = db.Column(db.Integer, default=0, nullable=False)
+    rows = db.Column(db.Integer, default=0, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    finished = db.Column(db.DateTime)
+
+
+class Outbox(db.Model):
+    """Database table storing tasks to publish once their change commits.
+
+    Rows are added in the same transaction as the change that triggers the
+    task, and removed by the dispatcher in app.utils.outbox once published.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.String(128), nullable=False)
+    args = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
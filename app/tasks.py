@@ -1,12 +1,73 @@
-"""Asynchronous Celery tasks."""
+"""Asynchronous Celery tasks.
 
+Messages are rendered by the tasks and delivered by the worker's delivery
+engine, see app.utils.delivery. Tasks wait for their email to be sent and
+are acknowledged late, so one lost with its worker is delivered again.
+Views add tasks to the outbox rather than calling them, and they arrive
+in batches through send_outbox, see app.utils.outbox.
+"""
+
+from concurrent.futures import wait
+from typing import List
+
+from celery.signals import worker_process_shutdown
 from flask import current_app as app, render_template
 from flask_mail import Message
 
-from app.extensions import celery, mail
+from app.extensions import celery, delivery, smtp_pool
+from app.utils.auth import serialize_pw_token
+from app.utils.delivery import is_temporary
+
 
+@celery.task(bind=True, acks_late=True, max_retries=3)
+def send_outbox(self, entries: List[list]):
+    """Run a batch of tasks published from the outbox.
 
-@celery.task()
+    The batch's messages are sent concurrently, and the task finishes, and
+    is acknowledged, once every one has been sent. Tasks whose email failed
+    with a temporary error are retried together with backoff. Other
+    failures are logged and do not stop the rest of the batch.
+
+    Args:
+        entries: The name and list of arguments of each task, in order.
+    """
+    failed = []
+
+    def record(entry: list, error: Exception):
+        app.logger.error(f"Outbox task {entry[0]} failed : {error!r}")
+        if is_temporary(error):
+            failed.append(entry)
+
+    pending = []
+    for name, args in entries:
+        task = celery.tasks.get(name)
+        if task is None:
+            app.logger.error(f"Outbox task {name} is not registered")
+            continue
+        try:
+            with delivery.collect() as futures:
+                task(*args)
+        except Exception as e:
+            record([name, args], e)
+            continue
+        pending.append(([name, args], futures))
+
+    for entry, futures in pending:
+        wait(futures)
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            record(entry, errors[0])
+
+    if not failed:
+        return
+    if self.request.retries >= self.max_retries:
+        app.logger.error(f"Giving up on {len(failed)} outbox tasks")
+        return
+    delay = app.config["MAIL_RETRY_BACKOFF_SEC"] * 2 ** self.request.retries
+    raise self.retry(args=[failed], countdown=delay)
+
+
+@celery.task(acks_late=True)
 def send_contact_email(
     first: str,
     last: str,
@@ -44,10 +105,10 @@ def send_contact_email(
         email=email,
         category=category,
     )
-    mail.send(msg)
+    delivery.deliver(msg)
 
 
-@celery.task()
+@celery.task(acks_late=True)
 def send_new_user_email(email: str):
     """Welcome new users with an email.
 
@@ -74,19 +135,23 @@ def send_new_user_email(email: str):
     )
     adm_msg.body = email
 
-    mail.send(msg)
-    mail.send(adm_msg)
+    delivery.deliver(msg, adm_msg)
 
 
-@celery.task()
-def send_recovery_email(email: str, token: str):
+@celery.task(acks_late=True)
+def send_recovery_email(email: str):
     """Email the user a link to recover their password
 
+    The token is made here rather than passed in, so it is never stored
+    in the outbox.
+
     Args:
         email: The email address to send the reset link to.
-        token: Token used to validate the user's request.
     """
 
+    # Token used to validate the user's request
+    token = serialize_pw_token(email)
+
     # The link sent to the user to reset their password
     reset_url = f"http://{app.config['DOMAIN']}/reset?token={token}"
 
@@ -108,4 +173,11 @@ def send_recovery_email(email: str, token: str):
         reset_url=reset_url,
     )
 
-    mail.send(msg)
+    delivery.deliver(msg)
+
+
+@worker_process_shutdown.connect
+def close_mail(**kwargs):
+    """Finish delivering queued email as the worker exits."""
+    delivery.close(timeout=smtp_pool.timeout)
+    smtp_pool.close()
@@ -0,0 +1,152 @@
+"""Server side paging of the admin user table.
+
+The admin page's DataTables table requests one page of users at a time.
+Pages are found by seeking past the last row of the previous page on an
+indexed, unique column rather than with an OFFSET, so reading page after
+page does not get slower the further it goes. Jumping to an arbitrary page
+falls back to an OFFSET.
+"""
+
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from flask import current_app as app
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models.db import Role, User, role_user_map
+from app.utils.cache import TTLCache
+
+#: Table columns in display order
+COLUMNS = ("email", "auth_fail", "roles", "timestamp")
+
+#: Columns that can be sorted on and the unique, indexed column sorted by.
+#: Users are created in ID order, so IDs stand in for the timestamp.
+SORT_COLUMNS = {"email": User.email, "timestamp": User.id}
+
+#: The largest page a client may request
+MAX_PAGE_LENGTH = 100
+
+#: Briefly cached row counts, keyed by search prefix
+count_cache = TTLCache(256, 10)
+
+
+def user_page(args: Dict) -> Dict:
+    """Get a page of users for a DataTables server side request.
+
+    Args:
+        args: The request's query string parameters. Besides the standard
+            DataTables parameters, ``after`` may hold the ``next`` value
+            of the previous page's response.
+
+    Returns:
+        The DataTables response, with a ``next`` value to request the
+        following page with.
+    """
+    draw = _int(args.get("draw"), 0)
+    start = max(0, _int(args.get("start"), 0))
+    length = min(MAX_PAGE_LENGTH, max(1, _int(args.get("length"), 10)))
+    # Emails are stored lower case
+    search = args.get("search[value]", "").strip().lower()
+    column = COLUMNS[_int(args.get("order[0][column]"), 3) % len(COLUMNS)]
+    sort = SORT_COLUMNS.get(column, User.id)
+    desc = args.get("order[0][dir]", "desc") == "desc"
+
+    query = db.session.query(
+        User.id, User.email, User.auth_fail, User.timestamp
+    )
+    if search:
+        query = query.filter(User.email.startswith(search, autoescape=True))
+
+    # Seek past the previous page when possible, otherwise skip rows
+    after = _cursor(sort, args.get("after"))
+    if after is not None:
+        query = query.filter(sort < after if desc else sort > after)
+    elif start:
+        query = query.offset(start)
+    rows = query.order_by(sort.desc() if desc else sort).limit(length).all()
+
+    roles = user_roles([row.id for row in rows])
+    data = [
+        {
+            "email": row.email,
+            "auth_fail": row.auth_fail,
+            "roles": ", ".join(roles[row.id]),
+            "timestamp": str(row.timestamp or ""),
+        }
+        for row in rows
+    ]
+
+    total = count_users("")
+    last = rows[-1] if len(rows) == length else None
+    return {
+        "draw": draw,
+        "recordsTotal": total,
+        "recordsFiltered": count_users(search) if search else total,
+        "data": data,
+        "next": None if last is None else getattr(last, sort.key),
+    }
+
+
+def user_roles(user_ids: List[int]) -> Dict[int, List[str]]:
+    """Get the role names of several users in a single query.
+
+    Args:
+        user_ids: The IDs of the users.
+
+    Returns:
+        Each user's sorted role names, keyed by user ID.
+    """
+    roles = defaultdict(list)
+    if user_ids:
+        rows = (
+            db.session.query(role_user_map.c.user_id, Role.name)
+            .join(Role, Role.id == role_user_map.c.role_id)
+            .filter(role_user_map.c.user_id.in_(user_ids))
+            .order_by(Role.name)
+        )
+        for user_id, name in rows:
+            roles[user_id].append(name)
+    return roles
+
+
+def count_users(prefix: str) -> int:
+    """Count the users whose email starts with a prefix, briefly cached.
+
+    Args:
+        prefix: The email prefix, or an empty string for every user.
+
+    Returns:
+        The number of matching users.
+    """
+    count = count_cache.get(prefix)
+    if count is None:
+        query = db.session.query(func.count(User.id))
+        if prefix:
+            query = query.filter(
+                User.email.startswith(prefix, autoescape=True)
+            )
+        count = query.scalar()
+        count_cache.set(prefix, count)
+    return count
+
+
+def _cursor(sort, value: Optional[str]):
+    """Parse the value to seek past for the column being sorted on."""
+    if not value:
+        return None
+    if sort is User.id:
+        try:
+            return int(value)
+        except ValueError:
+            app.logger.warning(f"Invalid admin table cursor : {value}")
+            return None
+    return value
+
+
+def _int(value: Optional[str], default: int) -> int:
+    """Parse an integer parameter, using a default if it is invalid."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
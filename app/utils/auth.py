@@ -1,23 +1,39 @@
 """Utility functions for authentication."""
 
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
+from hashlib import sha256
+from secrets import token_urlsafe
+from time import time
 from typing import Callable, Dict, List, Union
 
-from bcrypt import checkpw
-from flask import abort, current_app as app, request, jsonify
+from flask import abort, current_app as app, g, request, jsonify
 from flask_login import current_user
 from itsdangerous import BadSignature, BadTimeSignature, SignatureExpired
 from itsdangerous import TimedJSONWebSignatureSerializer
 
-from app.extensions import db
+from app.extensions import cred_cache, db, hash_pool, login_failures
+from app.extensions import revocations
 from app.models.db import User
 from app.utils.base import Return
+from app.utils.cache import TTLCache
+from app.utils.hashing import HashPoolBusy
+from app.utils.repository import get_by_email
+from app.utils.tokens import CompactSigner
+from app.utils.user import hash_values, record_auth_fail
+
+#: Claims of recently verified JWTs keyed by a digest of the token
+jwt_cache: TTLCache = TTLCache(maxsize=4096, ttl=0)
 
 
 def authenticate(email: str, pw: str) -> Return:
     """Checks the user's email and password to authenticate them.
 
+    Failed attempts are counted in a sliding window outside the database.
+    The user row is only written when the account becomes locked out, or
+    when a successful login clears a lockout count or rehashes, and each
+    write is a single UPDATE rather than a read, modify and write.
+
     Args:
         email: The user's email address.
         pw: The user's password
@@ -25,7 +41,7 @@ def authenticate(email: str, pw: str) -> Return:
     Returns:
         An object describing the status of the user's attempt.
     """
-    user = db.session.query(User).filter(User.email == email.lower()).first()
+    user = get_by_email(email.lower())
 
     if not user:
         # This message is used to prevent attackers from guessing emails
@@ -37,22 +53,54 @@ def authenticate(email: str, pw: str) -> Return:
             "Your account is locked out. Please recover your account.",
             user,
         )
-    elif checkpw(pw.encode("utf-8"), user.pw_hash):
-        # Reset the user's authentication failure counter.
-        user.auth_fail = 0
-        db.session.add(user)
-        db.session.commit()
+    elif cred_cache.check(email, pw) or check_pw(user, pw):
+        # Reset the user's authentication failure counters.
+        login_failures.reset(user.email)
+        values = {"auth_fail": 0} if user.auth_fail else {}
+
+        # Upgrade the stored hash if the algorithm or cost has changed.
+        if hash_pool.needs_rehash(user.pw_algo, user.pw_cost):
+            try:
+                values.update(hash_values(pw))
+            except HashPoolBusy:
+                app.logger.warning(f"Deferred password rehash for : {email}")
+
+        # Only write to the database if something changed
+        if values:
+            db.session.execute(
+                User.__table__.update()
+                .where(User.id == user.id)
+                .values(**values)
+            )
+            db.session.commit()
         app.logger.info(f"Successful login for : {email}")
         return Return(True, "Login Successful", user)
     else:
-        # Increment the auth failure counter for an invalid password.
-        user.auth_fail += 1
-        db.session.add(user)
-        db.session.commit()
+        # Count the failure and persist a lockout once it is reached.
+        fails = login_failures.hit(user.email)
+        if fails > app.config["AUTH_FAILS"]:
+            fails = record_auth_fail(user.id, fails)
+            app.logger.warning(f"Locking out after {fails} failures : {email}")
         app.logger.info(f"Failed login for : {email}")
         return Return(False, "Invalid email or password", user)
 
 
+def check_pw(user: User, pw: str) -> bool:
+    """Checks a user's password, remembering it if the check succeeds.
+
+    Args:
+        user: The user to check.
+        pw: The user's password.
+
+    Returns:
+        True if the password matches the user's stored hash.
+    """
+    if hash_pool.checkpw(pw, user.pw_hash, user.pw_algo):
+        cred_cache.add(user.email, pw)
+        return True
+    return False
+
+
 def generate_jwt(email: str, roles: List[str]) -> str:
     """Generates a java web token (JWT) for user authentication.
 
@@ -64,10 +112,20 @@ def generate_jwt(email: str, roles: List[str]) -> str:
         A java web token used to authenticate the user.
     """
 
-    s = TimedJSONWebSignatureSerializer(
-        secret_key=app.config["SECRET_KEY"],
-        expires_in=app.config["JWT_EXP_SEC"],
-    )
+    # Compact tokens carry integer epoch claims and no header
+    if app.config["JWT_FORMAT"] == "compact":
+        iat = int(time())
+        return get_signer(app.config["SECRET_KEY"]).dumps(
+            {
+                "sub": email,
+                "roles": roles,
+                "iat": iat,
+                "exp": iat + app.config["JWT_EXP_SEC"],
+                "jti": token_urlsafe(12),
+            }
+        )
+
+    s = get_serializer(app.config["SECRET_KEY"], app.config["JWT_EXP_SEC"])
     jwt = s.dumps(
         {
             "exp": str(
@@ -94,12 +152,44 @@ def load_pw_token(token: str) -> Union[Dict, None]:
     """
 
     try:
-        s = TimedJSONWebSignatureSerializer(app.config["SECRET_KEY"])
+        s = get_serializer(app.config["SECRET_KEY"])
         return s.loads(token.encode("utf-8"))
     except (SignatureExpired, BadTimeSignature, BadSignature):
         return None
 
 
+@lru_cache(maxsize=8)
+def get_signer(secret_key: str) -> CompactSigner:
+    """Gets a shared compact token signer with a pre-derived key.
+
+    Args:
+        secret_key: The key used to sign tokens.
+
+    Returns:
+        A compact token signer.
+    """
+    return CompactSigner(secret_key)
+
+
+@lru_cache(maxsize=8)
+def get_serializer(
+    secret_key: str, expires_in: int = None
+) -> TimedJSONWebSignatureSerializer:
+    """Gets a shared token serializer rather than building one per call.
+
+    Serializers hold no per token state, so one instance is reused for
+    each secret key and expiry.
+
+    Args:
+        secret_key: The key used to sign tokens.
+        expires_in: Seconds until new tokens expire.
+
+    Returns:
+        A timed JSON web signature serializer.
+    """
+    return TimedJSONWebSignatureSerializer(secret_key, expires_in)
+
+
 def required_roles_ui(*roles: str) -> Callable:
     """Decorator function to check if a user has the required UI roles.
 
@@ -131,6 +221,9 @@ def required_roles_ui(*roles: str) -> Callable:
 def required_roles_api(*roles: str) -> Callable:
     """Decorator function to check if a user has the required api roles.
 
+    The decoded token is stored as ``g.token_data`` so views can use it
+    without decoding the token again.
+
     Args:
         *roles: Variable length argument list of user roles.
 
@@ -154,6 +247,7 @@ def required_roles_api(*roles: str) -> Callable:
 
                 # Validate the user's roles
                 if token_data and set(roles).issubset(token_data["roles"]):
+                    g.token_data = token_data
                     return f(*args, **kwargs)
 
             # Abort the API at this point as the user is not authorized
@@ -182,7 +276,7 @@ def serialize_pw_token(email: str) -> str:
         A password token mapped to the user's email.
     """
 
-    s = TimedJSONWebSignatureSerializer(
+    s = get_serializer(
         app.config["SECRET_KEY"], app.config["PW_TOKEN_EXP_SEC"]
     )
     return s.dumps({"email": email}).decode("utf-8")
@@ -191,14 +285,40 @@ def serialize_pw_token(email: str) -> str:
 def validate_jwt(token: str) -> Union[Dict, None]:
     """Try to validate a java web token.
 
+    Verified tokens are cached until they expire, so a token reused
+    across requests only has its signature checked once per process.
+    Legacy JSON web signature tokens are accepted while
+    JWT_ACCEPT_LEGACY is set. Revocation is checked on every call.
+
     Args:
         token: The token to decode.
 
     Returns:
         If successful, a decoded JWT. Otherwise, None.
     """
-    try:
-        s = TimedJSONWebSignatureSerializer(app.config["SECRET_KEY"])
-        return s.loads(token.encode("utf-8"))
-    except (SignatureExpired, BadTimeSignature, BadSignature):
+    key = sha256(token.encode("utf-8")).digest()
+    token_data = jwt_cache.get(key)
+
+    if token_data is None:
+        try:
+            # Compact tokens have two segments, legacy tokens have three
+            if token.count(".") == 1:
+                token_data = get_signer(app.config["SECRET_KEY"]).loads(token)
+            elif app.config["JWT_ACCEPT_LEGACY"]:
+                s = get_serializer(app.config["SECRET_KEY"])
+                payload, header = s.loads(
+                    token.encode("utf-8"), return_header=True
+                )
+                # Use the header's epoch times in place of the strings
+                token_data = dict(
+                    payload, iat=header["iat"], exp=header["exp"]
+                )
+            else:
+                return None
+        except (SignatureExpired, BadTimeSignature, BadSignature):
+            return None
+        jwt_cache.set(key, token_data, ttl=token_data["exp"] - time())
+
+    if revocations.is_revoked(token_data):
         return None
+    return token_data
@@ -0,0 +1,214 @@
+"""Batched, resumable data backfills that run alongside the application.
+
+A data migration that rewrites a large table in one statement locks it
+for as long as it runs, and ``flask db upgrade`` runs at container start.
+Instead a migration only changes the schema and schedules a backfill, and
+the backfill runs in the background with ``flask backfill run`` - see
+run.sh.
+
+A backfill walks its table in key order, BACKFILL_BATCH_SIZE rows at a
+time, each batch in its own short transaction that also moves its
+checkpoint in the backfill_checkpoint table. It sleeps BACKFILL_SLEEP_SEC
+between batches and stops after BACKFILL_TIME_BUDGET_SEC, and the next
+run resumes from the checkpoint. The checkpoint row is locked during each
+batch, so hosts starting at the same time never process a batch twice.
+
+Example Usage::
+
+    # app/backfills.py
+    @backfill("pw_cost", User.__table__)
+    def pw_cost(conn, ids):
+        ...
+
+    # migrations/versions/<revision>.py
+    def upgrade():
+        schedule(op, "pw_cost")
+"""
+
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterable, List, Optional
+
+from flask import current_app as app
+from sqlalchemy import Table, select
+
+from app.extensions import db
+from app.models.db import BackfillCheckpoint
+
+#: The checkpoint table
+checkpoints: Table = BackfillCheckpoint.__table__
+
+
+class Backfill:
+    """A data migration applied to a table in batches of keys.
+
+    Args:
+        name: The name the backfill is scheduled by.
+        table: The table to walk.
+        fn: Called with a connection and the batch's keys, in order, to
+            update those rows within the batch's transaction.
+        key: The name of the table's unique integer key column.
+    """
+
+    def __init__(self, name: str, table: Table, fn: Callable, key: str):
+        self.name = name
+        self.table = table
+        self.fn = fn
+        self.key = table.c[key]
+
+
+#: Every known backfill keyed by name
+backfills: Dict[str, Backfill] = {}
+
+
+def backfill(name: str, table: Table, key: str = "id") -> Callable:
+    """Decorator function registering a backfill.
+
+    Args:
+        name: The name the backfill is scheduled by.
+        table: The table to walk.
+        key: The name of the table's unique integer key column.
+
+    Returns:
+        The decorated function, unchanged.
+    """
+
+    def wrapper(f):
+        backfills[name] = Backfill(name, table, f, key)
+        return f
+
+    return wrapper
+
+
+def schedule(op, name: str):
+    """Schedule a backfill from an Alembic migration.
+
+    Args:
+        op: The migration's alembic.op.
+        name: The backfill's name.
+    """
+    op.execute(checkpoints.insert().values(name=name, last_key=0, rows=0))
+
+
+def unschedule(op, name: str):
+    """Remove a backfill and its progress from an Alembic downgrade.
+
+    Args:
+        op: The migration's alembic.op.
+        name: The backfill's name.
+    """
+    op.execute(checkpoints.delete().where(checkpoints.c.name == name))
+
+
+def run_batch(bf: Backfill, batch_size: int) -> Optional[int]:
+    """Apply a backfill to the next batch of keys after its checkpoint.
+
+    Args:
+        bf: The backfill.
+        batch_size: The most rows to process.
+
+    Returns:
+        The number of rows processed, 0 when the backfill has just
+        finished, or None if it was already finished or is not scheduled.
+    """
+    where = checkpoints.c.name == bf.name
+    with db.engine.begin() as conn:
+        checkpoint = conn.execute(
+            select([checkpoints]).where(where).with_for_update()
+        ).first()
+        if checkpoint is None or checkpoint.finished:
+            return None
+
+        keys = [
+            row[0]
+            for row in conn.execute(
+                select([bf.key])
+                .where(bf.key > checkpoint.last_key)
+                .order_by(bf.key)
+                .limit(batch_size)
+            )
+        ]
+        if not keys:
+            conn.execute(
+                checkpoints.update()
+                .where(where)
+                .values(finished=datetime.utcnow())
+            )
+            return 0
+
+        bf.fn(conn, keys)
+        conn.execute(
+            checkpoints.update()
+            .where(where)
+            .values(
+                last_key=keys[-1], rows=checkpoints.c.rows + len(keys)
+            )
+        )
+        return len(keys)
+
+
+def pending() -> List[str]:
+    """Get the names of the scheduled backfills that have not finished."""
+    query = (
+        select([checkpoints.c.name])
+        .where(checkpoints.c.finished.is_(None))
+        .order_by(checkpoints.c.timestamp)
+    )
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(query)]
+
+
+def run_backfills(
+    names: Iterable[str] = None,
+    batch_size: int = None,
+    sleep_sec: float = None,
+    budget_sec: float = None,
+) -> Dict[str, int]:
+    """Run scheduled backfills until they finish or the time budget ends.
+
+    Each argument that is None uses its configured default, and a zero
+    time budget means no limit.
+
+    Args:
+        names: The backfills to run, every pending one by default.
+        batch_size: The rows processed by each batch.
+        sleep_sec: The pause between batches.
+        budget_sec: The seconds to run for before stopping.
+
+    Returns:
+        The rows processed by this run for each backfill.
+    """
+    config = app.config
+    batch_size = batch_size or config["BACKFILL_BATCH_SIZE"]
+    if sleep_sec is None:
+        sleep_sec = config["BACKFILL_SLEEP_SEC"]
+    if budget_sec is None:
+        budget_sec = config["BACKFILL_TIME_BUDGET_SEC"]
+    deadline = monotonic() + budget_sec if budget_sec else None
+
+    processed = {}
+    for name in names or pending():
+        bf = backfills.get(name)
+        if bf is None:
+            app.logger.warning(f"Backfill is not registered : {name}")
+            continue
+
+        processed[name] = 0
+        while deadline is None or monotonic() < deadline:
+            count = run_batch(bf, batch_size)
+            if count is None:
+                break
+            if count == 0:
+                app.logger.info(
+                    f"Backfill {name} finished after {processed[name]} rows"
+                )
+                break
+            processed[name] += count
+            if sleep_sec:
+                sleep(sleep_sec)
+        else:
+            app.logger.info(
+                f"Backfill {name} paused after {processed[name]} rows"
+            )
+            break
+    return processed
@@ -1,8 +1,11 @@
 """General utilities."""
 
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any
 
+from redis import Redis
+
 
 @dataclass
 class Return:
@@ -11,3 +14,24 @@ class Return:
     success: bool
     message: str
     data: Any
+
+
+@lru_cache(maxsize=8)
+def get_redis(url: str, timeout: float = None) -> Redis:
+    """Get a shared Redis client for a URL.
+
+    Clients are thread safe and reconnect after a fork, so one client per
+    URL is shared by the whole process. Connecting and every command fail
+    with a RedisError after timeout seconds, so callers on the request
+    path fall back rather than hang when Redis does.
+
+    Args:
+        url: A Redis URL such as redis://redis:6379/1.
+        timeout: Seconds to wait on Redis, without limit if None.
+
+    Returns:
+        A Redis client.
+    """
+    return Redis.from_url(
+        url, socket_timeout=timeout, socket_connect_timeout=timeout
+    )
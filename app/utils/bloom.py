@@ -0,0 +1,78 @@
+"""A Bloom filter for fast negative membership checks.
+
+A Bloom filter never reports a missing item for something that was added,
+but may report an item as present when it was not. It is used to skip
+lookups in a slower store for the common case of an item that is absent.
+"""
+
+from hashlib import blake2b
+from math import ceil, log
+from typing import Union
+
+
+class BloomFilter:
+    """A fixed size Bloom filter backed by a mutable byte buffer.
+
+    Args:
+        num_bits: The number of bits in the filter.
+        num_hashes: The number of bit positions set per item.
+        buf: An optional writable buffer of at least num_bits / 8 bytes,
+            such as a memory map. A new zeroed buffer is used by default.
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int, buf=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        if buf is None:
+            buf = bytearray(self.size_bytes(num_bits))
+        self.buf = buf
+
+    @classmethod
+    def for_capacity(
+        cls, capacity: int, error_rate: float = 0.01, buf=None
+    ) -> "BloomFilter":
+        """Size a filter for a number of items and false positive rate.
+
+        Args:
+            capacity: The number of items expected to be added.
+            error_rate: The target false positive rate at capacity.
+            buf: An optional writable buffer, see the class arguments.
+
+        Returns:
+            An empty, optimally sized filter.
+        """
+        num_bits = max(8, ceil(-capacity * log(error_rate) / log(2) ** 2))
+        num_hashes = max(1, round(num_bits / capacity * log(2)))
+        return cls(num_bits, num_hashes, buf)
+
+    @staticmethod
+    def size_bytes(num_bits: int) -> int:
+        """The number of buffer bytes needed for a number of bits."""
+        return (num_bits + 7) // 8
+
+    def __contains__(self, item: Union[str, bytes]) -> bool:
+        buf = self.buf
+        return all(buf[i >> 3] & (1 << (i & 7)) for i in self._indexes(item))
+
+    def add(self, item: Union[str, bytes]):
+        """Add an item to the filter.
+
+        Args:
+            item: The item to add.
+        """
+        buf = self.buf
+        for i in self._indexes(item):
+            buf[i >> 3] |= 1 << (i & 7)
+
+    def clear(self):
+        """Remove every item from the filter."""
+        self.buf[:] = bytes(len(self.buf))
+
+    def _indexes(self, item: Union[str, bytes]):
+        """Bit positions for an item using double hashing."""
+        if isinstance(item, str):
+            item = item.encode("utf-8")
+        digest = blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
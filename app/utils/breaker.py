@@ -0,0 +1,154 @@
+"""A circuit breaker for calls to a service that may be down.
+
+While the Celery broker is down every publish waits for a connection to
+fail, which holds a uWSGI worker and the outbox rows it claimed. After
+the number of consecutive failures at the breaker's failures key it opens,
+and calls are refused at once with CircuitOpen. Once the seconds at its
+reset key have passed a single call is let through as a probe, and the
+breaker closes again when a call succeeds.
+
+State is kept per process. Every process learns of an outage from its own
+failures, so the breaker keeps working while Redis itself is down.
+
+Example Usage::
+
+    if not broker_breaker.allow():
+        raise CircuitOpen("Broker unavailable", broker_breaker.retry_after)
+    try:
+        publish()
+    except Exception:
+        broker_breaker.failure()
+        raise
+    broker_breaker.success()
+"""
+
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+from flask import Flask, current_app
+
+from app.utils.metrics import registry
+
+#: Breakers that are open, by name
+open_state = registry.gauge(
+    "circuit_open", "Circuit breakers refusing calls, by breaker."
+)
+
+#: Calls refused by an open breaker, by name
+rejected = registry.counter(
+    "circuit_rejected_total", "Calls refused by an open circuit breaker."
+)
+
+
+class CircuitOpen(Exception):
+    """The breaker is open and the call was not attempted.
+
+    Attributes:
+        retry_after: Seconds until the breaker lets a probe through.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Flask extension refusing calls after repeated failures.
+
+    Args:
+        name: Names the breaker in logs and metrics.
+        failures_key: Config key of the consecutive failures that open it.
+        reset_key: Config key of the seconds between probes while open.
+        app: The Flask application object.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failures_key: str,
+        reset_key: str,
+        app: Flask = None,
+    ):
+        self.name = name
+        self.failures_key = failures_key
+        self.reset_key = reset_key
+        self.threshold = 1
+        self.reset_sec = 0
+        self._failures = 0
+        self._probe_at = None
+        self._lock = Lock()
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the breaker and close it.
+
+        Args:
+            app: The Flask application object.
+        """
+        self.threshold = app.config[self.failures_key]
+        self.reset_sec = app.config[self.reset_key]
+        with self._lock:
+            self._failures = 0
+            self._probe_at = None
+        open_state.set(0, name=self.name)
+        app.extensions[f"{self.name}_breaker"] = self
+
+    @property
+    def is_open(self) -> bool:
+        """Check if the breaker is refusing calls other than probes."""
+        return self._probe_at is not None
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds until the breaker lets a probe through."""
+        probe_at = self._probe_at
+        if probe_at is None:
+            return 0
+        return max(0, ceil(probe_at - monotonic()))
+
+    def allow(self) -> bool:
+        """Check if a call may be attempted.
+
+        While open, one call per reset interval is allowed as a probe, so
+        a probe that never reports back cannot keep the breaker shut.
+
+        Returns:
+            False if the call must not be attempted.
+        """
+        with self._lock:
+            if self._probe_at is None:
+                return True
+            now = monotonic()
+            if now >= self._probe_at:
+                self._probe_at = now + self.reset_sec
+                return True
+        rejected.inc(name=self.name)
+        return False
+
+    def success(self):
+        """Record a successful call, closing the breaker."""
+        with self._lock:
+            was_open = self._probe_at is not None
+            self._failures = 0
+            self._probe_at = None
+        if was_open:
+            open_state.set(0, name=self.name)
+            current_app.logger.info(f"Circuit {self.name} closed")
+
+    def failure(self):
+        """Record a failed call, opening the breaker past the threshold."""
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return
+            was_open = self._probe_at is not None
+            self._probe_at = monotonic() + self.reset_sec
+        if not was_open:
+            open_state.set(1, name=self.name)
+            current_app.logger.warning(
+                f"Circuit {self.name} opened after {self._failures} "
+                f"failures, probing every {self.reset_sec}s"
+            )
@@ -0,0 +1,266 @@
+"""In-process caches.
+
+Every cache here is local to one process. uWSGI runs several processes,
+so anything cached must be safe to serve stale for up to its time to live
+in the processes that did not see an invalidation.
+"""
+
+import hmac
+from collections import OrderedDict
+from hashlib import sha256
+from os import urandom
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Hashable, Iterable, List, Optional
+
+from flask import Flask
+from flask_login import UserMixin
+
+
+class TTLCache:
+    """Thread safe LRU cache whose entries expire after a time to live.
+
+    Args:
+        maxsize: The maximum number of entries kept.
+        ttl: The default number of seconds an entry is kept.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get an unexpired entry and mark it as recently used.
+
+        Args:
+            key: The key of the entry.
+            default: The value returned on a miss.
+
+        Returns:
+            The cached value, otherwise the default.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove an entry.
+
+        Args:
+            key: The key of the entry.
+            default: The value returned if there is no entry.
+
+        Returns:
+            The removed value, otherwise the default.
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """Add or replace an entry, evicting the least recently used.
+
+        Args:
+            key: The key of the entry.
+            value: The value to cache.
+            ttl: Seconds to keep this entry instead of the default.
+        """
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class CredentialCache:
+    """Remembers recent successful password checks to skip hashing.
+
+    Only an HMAC of the email and password under a random per-process
+    key is kept, so the cache never holds a usable password. It is off
+    unless AUTH_CACHE_TTL_SEC is set.
+
+    A password change or reset in another process revokes the user, see
+    app.utils.revoke, and entries cached before the revocation are then
+    ignored, so no process keeps accepting the old password.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.enabled = False
+        self._cache = TTLCache(0, 0)
+        self._key = urandom(32)
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the cache from the application config.
+
+        Args:
+            app: The Flask application object.
+        """
+        ttl = app.config["AUTH_CACHE_TTL_SEC"]
+        self.enabled = bool(ttl)
+        self._cache = TTLCache(app.config["AUTH_CACHE_SIZE"], ttl)
+        self._key = urandom(32)
+        app.extensions["cred_cache"] = self
+
+    def add(self, email: str, pw: str):
+        """Remember that a password was verified for a user.
+
+        Args:
+            email: The user's email address.
+            pw: The verified password.
+        """
+        if self.enabled:
+            entry = (int(time()), self._digest(email, pw))
+            self._cache.set(email.lower(), entry)
+
+    def check(self, email: str, pw: str) -> bool:
+        """Check if a password was recently verified for a user.
+
+        Args:
+            email: The user's email address.
+            pw: The password to check.
+
+        Returns:
+            True if the same password was verified within the TTL.
+        """
+        if not self.enabled:
+            return False
+        entry = self._cache.get(email.lower())
+        if entry is None:
+            return False
+        cached_at, digest = entry
+        if not hmac.compare_digest(digest, self._digest(email, pw)):
+            return False
+
+        # Imported here as the extensions import this module
+        from app.extensions import revocations
+
+        # Revocations are recorded in whole seconds, so an entry cached in
+        # the same second as a revocation is also treated as stale
+        if revocations.is_revoked({"sub": email, "iat": cached_at - 1}):
+            self.invalidate(email)
+            return False
+        return True
+
+    def invalidate(self, email: str):
+        """Forget any verified password for a user.
+
+        Args:
+            email: The user's email address.
+        """
+        self._cache.pop(email.lower())
+
+    def _digest(self, email: str, pw: str) -> bytes:
+        """HMAC the email and password under this process's key."""
+        msg = f"{email.lower()}\0{pw}".encode("utf-8")
+        return hmac.new(self._key, msg, sha256).digest()
+
+
+class UserSnapshot(UserMixin):
+    """An immutable copy of the identity of a logged in user.
+
+    Args:
+        user_id: The user's database ID.
+        email: The user's email address.
+        roles: The names of the user's roles.
+    """
+
+    def __init__(self, user_id: int, email: str, roles: Iterable[str]):
+        object.__setattr__(self, "id", user_id)
+        object.__setattr__(self, "email", email)
+        object.__setattr__(self, "roles", tuple(roles))
+        object.__setattr__(self, "loaded_at", int(time()))
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError("UserSnapshot is read only")
+
+    def get_roles(self) -> List[str]:
+        """Get all of the roles this user has.
+
+        Returns:
+            A list of the user's roles.
+        """
+        return list(self.roles)
+
+
+class UserCache:
+    """Caches user snapshots for Flask-Login's user loader.
+
+    Other processes drop a snapshot once the user's tokens are revoked,
+    which happens on a password change or deletion. Role changes made in
+    another process are seen within USER_CACHE_TTL_SEC.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self._cache = TTLCache(0, 0)
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the cache from the application config.
+
+        Args:
+            app: The Flask application object.
+        """
+        self._cache = TTLCache(
+            app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL_SEC"]
+        )
+        app.extensions["user_cache"] = self
+
+    def add(self, user) -> UserSnapshot:
+        """Snapshot a user and cache the snapshot.
+
+        Args:
+            user: The user, with its roles already loaded.
+
+        Returns:
+            The user's snapshot.
+        """
+        snapshot = UserSnapshot(user.id, user.email, user.get_roles())
+        self._cache.set(str(user.id), snapshot)
+        return snapshot
+
+    def get(self, user_id: str) -> Optional[UserSnapshot]:
+        """Get a cached snapshot.
+
+        Args:
+            user_id: The user's database ID.
+
+        Returns:
+            The user's snapshot, otherwise None.
+        """
+        return self._cache.get(str(user_id))
+
+    def invalidate(self, user_id: int):
+        """Forget a user's snapshot.
+
+        Args:
+            user_id: The user's database ID.
+        """
+        self._cache.pop(str(user_id))
@@ -0,0 +1,166 @@
+"""Sliding window event counters kept outside the database.
+
+Counting every failed login in the ``user`` row costs a write and a row
+lock per attempt. Instead events are counted here, in memory for
+development and tests or in Redis so every process shares the counts, and
+the database is only written when the count crosses a threshold.
+"""
+
+from collections import defaultdict, deque
+from secrets import token_hex
+from threading import Lock
+from time import time
+from typing import Deque, Dict
+
+from flask import Flask
+from redis.exceptions import RedisError
+
+from app.utils.base import get_redis
+
+
+class MemoryCounterStore:
+    """Sliding window counts local to one process."""
+
+    def __init__(self):
+        self._events: Dict[str, Deque[float]] = defaultdict(deque)
+        self._lock = Lock()
+
+    def hit(self, key: str, window: float) -> int:
+        """Record an event and count the events within the window."""
+        with self._lock:
+            events = self._events[key]
+            events.append(time())
+            return self._trim(events, window)
+
+    def count(self, key: str, window: float) -> int:
+        """Count the events within the window."""
+        with self._lock:
+            if key not in self._events:
+                return 0
+            return self._trim(self._events[key], window)
+
+    def reset(self, key: str):
+        """Forget every event for a key."""
+        with self._lock:
+            self._events.pop(key, None)
+
+    @staticmethod
+    def _trim(events: Deque[float], window: float) -> int:
+        """Drop events older than the window and count the rest."""
+        start = time() - window
+        while events and events[0] <= start:
+            events.popleft()
+        return len(events)
+
+
+class RedisCounterStore:
+    """Sliding window counts shared through Redis sorted sets.
+
+    Args:
+        url: The Redis URL.
+        timeout: Seconds to wait on Redis.
+    """
+
+    def __init__(self, url: str, timeout: float = None):
+        self.redis = get_redis(url, timeout)
+
+    def hit(self, key: str, window: float) -> int:
+        """Record an event and count the events within the window."""
+        now = time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, 0, now - window)
+        pipe.zadd(key, {f"{now}:{token_hex(4)}": now})
+        pipe.zcard(key)
+        pipe.expire(key, int(window) + 1)
+        return pipe.execute()[2]
+
+    def count(self, key: str, window: float) -> int:
+        """Count the events within the window."""
+        return self.redis.zcount(key, time() - window, "+inf")
+
+    def reset(self, key: str):
+        """Forget every event for a key."""
+        self.redis.delete(key)
+
+
+class SlidingWindowCounter:
+    """Counts events per key over a sliding time window.
+
+    If Redis is unreachable the counter falls back to counting in this
+    process so logins keep working, with per-process counts.
+
+    Args:
+        app: The Flask application object.
+        prefix: Namespaces this counter's keys in the store.
+        window_key: The config key holding the window length in seconds.
+    """
+
+    def __init__(
+        self, app: Flask = None, prefix: str = "count", window_key: str = ""
+    ):
+        self.prefix = prefix
+        self.window_key = window_key
+        self.window = 0
+        self.store = MemoryCounterStore()
+        self.fallback = MemoryCounterStore()
+        self.logger = None
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the store from the application config.
+
+        Args:
+            app: The Flask application object.
+        """
+        url = app.config["STORE_URL"]
+        if url.startswith("memory://"):
+            self.store = MemoryCounterStore()
+        else:
+            self.store = RedisCounterStore(
+                url, timeout=app.config["STORE_TIMEOUT_SEC"]
+            )
+        self.fallback = MemoryCounterStore()
+        self.window = app.config[self.window_key]
+        self.logger = app.logger
+
+    def hit(self, key: str) -> int:
+        """Record an event for a key.
+
+        Args:
+            key: The key to count, such as an email address.
+
+        Returns:
+            The number of events for the key within the window.
+        """
+        return self._call("hit", key, self.window)
+
+    def count(self, key: str) -> int:
+        """Count the events for a key within the window.
+
+        Args:
+            key: The key to count.
+
+        Returns:
+            The number of events for the key within the window.
+        """
+        return self._call("count", key, self.window)
+
+    def reset(self, key: str):
+        """Forget every event for a key.
+
+        Args:
+            key: The key to reset.
+        """
+        self.fallback.reset(f"{self.prefix}:{key}")
+        self._call("reset", key)
+
+    def _call(self, method: str, key: str, *args):
+        """Call the store, falling back to this process if it fails."""
+        key = f"{self.prefix}:{key}"
+        try:
+            return getattr(self.store, method)(key, *args)
+        except RedisError as e:
+            self.logger.warning(f"Counter store unavailable : {e}")
+            return getattr(self.fallback, method)(key, *args)
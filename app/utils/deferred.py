@@ -0,0 +1,101 @@
+"""Publish a request's outbox tasks once its response has been sent.
+
+The outbox makes a view's tasks durable, but waiting for the dispatcher's
+next poll delays every email by up to OUTBOX_POLL_SEC, and publishing from
+the view would put the broker's latency in the response time. Instead the
+tasks a request adds to the outbox are collected and, if the request's
+transaction committed them, published as one batch once the WSGI server
+has closed the response body, see app.utils.outbox.
+
+A publish that fails is logged and the tasks stay in the outbox for the
+dispatcher, so the user never sees the error. While the broker's circuit
+breaker is open the tasks are left to the dispatcher without a publish.
+"""
+
+from functools import partial
+from typing import List
+
+from flask import Flask, current_app, g, has_request_context
+from sqlalchemy import inspect
+
+from app.utils.breaker import CircuitOpen
+from app.utils.metrics import registry
+
+#: Requests whose tasks could not be published after the response
+failures = registry.counter(
+    "deferred_publish_failures_total",
+    "Requests whose outbox tasks could not be published after the response.",
+)
+
+
+class DeferredDispatch:
+    """Flask extension publishing outbox tasks after the response.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.enabled = False
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Publish committed tasks after each response.
+
+        Args:
+            app: The Flask application object.
+        """
+        self.enabled = app.config["OUTBOX_DISPATCH_AFTER_RESPONSE"]
+        app.after_request(self._after_request)
+        app.extensions["deferred"] = self
+
+    def add(self, row):
+        """Publish an outbox row after the response, if it is committed.
+
+        Args:
+            row: The outbox row added to the current request's session.
+        """
+        if self.enabled and has_request_context():
+            g.setdefault("deferred_tasks", []).append(row)
+
+    def _after_request(self, response):
+        """Publish the request's committed tasks once the response closes."""
+        rows = g.pop("deferred_tasks", None)
+        if not rows:
+            return response
+
+        # Committed rows are expired but keep their identity, and rows
+        # rolled back or never committed have none
+        ids = [
+            inspect(row).identity[0]
+            for row in rows
+            if inspect(row).has_identity
+        ]
+        if ids:
+            app = current_app._get_current_object()
+            response.call_on_close(partial(self._publish, app, ids))
+        return response
+
+    @staticmethod
+    def _publish(app: Flask, ids: List[int]):
+        """Publish tasks in one batch, leaving them to the dispatcher."""
+
+        # Imported here as the outbox imports the extensions
+        from app.utils.outbox import dispatch_batch
+
+        with app.app_context():
+            try:
+                dispatch_batch(len(ids), ids)
+            except CircuitOpen:
+                app.logger.info(
+                    f"Broker unavailable, leaving outbox tasks {ids} to the "
+                    f"dispatcher"
+                )
+            except Exception as e:
+                failures.inc()
+                app.logger.error(
+                    f"Publishing outbox tasks {ids} after the response "
+                    f"failed, leaving them to the dispatcher : {e!r}"
+                )
@@ -0,0 +1,277 @@
+"""Concurrent email delivery for the Celery worker.
+
+Sending a message is almost all waiting on the network, so a worker
+process that sends one message per task spends most of its time idle.
+With MAIL_ASYNC set, the mail tasks render their messages and hand them
+to the delivery engine, which sends them from an asyncio event loop on a
+background thread while the task returns.
+
+Up to MAIL_CONCURRENCY messages are sent at once, each on a thread of an
+executor using the pooled SMTP connections of app.utils.smtp, and at most
+MAIL_DOMAIN_CONCURRENCY at once to any one recipient domain. Messages that
+fail with a dropped connection or a temporary (4xx) SMTP error are retried
+MAIL_RETRIES times with exponential backoff. At most MAIL_MAX_IN_FLIGHT
+messages are held, after which submitting blocks until one completes.
+
+Without MAIL_ASYNC messages are sent at once in the calling thread, and
+errors are raised to the caller as they were before.
+
+A task delivers its messages with ``deliver``, which waits until they are
+sent and raises the first failure, so the task is only acknowledged once
+its email is out. Within ``collect`` the futures are gathered instead, so
+a batch of tasks can be sent concurrently and waited on together.
+
+Example Usage::
+
+    delivery.deliver(msg, adm_msg)
+
+    with delivery.collect() as futures:
+        send_new_user_email(email)
+    wait(futures)
+"""
+
+import asyncio
+import smtplib
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import AsyncExitStack, contextmanager
+from os import getpid
+from threading import BoundedSemaphore, Lock, Thread, local
+from typing import Dict, Iterator, List, Set
+
+from flask import Flask
+from flask_mail import Message
+
+from app.utils.metrics import registry
+from app.utils.smtp import CONNECTION_ERRORS, SMTPPool
+
+#: Messages submitted and not yet sent or failed
+in_flight = registry.gauge(
+    "mail_in_flight", "Messages submitted and not yet delivered."
+)
+
+#: Deliveries retried after a temporary failure
+retries = registry.counter(
+    "mail_retries_total", "Deliveries retried after a temporary failure."
+)
+
+#: Messages that could not be delivered
+failures = registry.counter(
+    "mail_failures_total", "Messages that could not be delivered."
+)
+
+
+def is_temporary(error: Exception) -> bool:
+    """Check if a failed delivery may succeed if it is tried again."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, CONNECTION_ERRORS)
+
+
+def recipient_domains(message: Message) -> Set[str]:
+    """The domains of every recipient of a message."""
+    return {
+        address.rsplit("@", 1)[-1].strip(">").lower()
+        for address in message.send_to
+    }
+
+
+class DeliveryEngine:
+    """Flask extension delivering email concurrently from an event loop.
+
+    Args:
+        app: The Flask application object.
+        pool: The SMTP connection pool to send with.
+    """
+
+    def __init__(self, app: Flask = None, pool: SMTPPool = None):
+        self.app = None
+        self.pool = None
+        self.enabled = False
+        self.concurrency = 1
+        self.domain_concurrency = 1
+        self.retries = 0
+        self.backoff_sec = 1.0
+        self.max_in_flight = 1
+        self._loop = None
+        self._executor = None
+        self._in_flight = None
+        self._limit = None
+        self._domains: Dict[str, asyncio.Semaphore] = {}
+        self._pending: Set[Future] = set()
+        self._pid = None
+        self._lock = Lock()
+        self._local = local()
+
+        if app:
+            self.init_app(app, pool)
+
+    def init_app(self, app: Flask, pool: SMTPPool):
+        """Configure delivery, finishing any messages already submitted.
+
+        Args:
+            app: The Flask application object.
+            pool: The SMTP connection pool to send with.
+        """
+        self.close()
+        self.app = app
+        self.pool = pool
+        self.enabled = app.config["MAIL_ASYNC"]
+        self.concurrency = app.config["MAIL_CONCURRENCY"]
+        self.domain_concurrency = app.config["MAIL_DOMAIN_CONCURRENCY"]
+        self.retries = app.config["MAIL_RETRIES"]
+        self.backoff_sec = app.config["MAIL_RETRY_BACKOFF_SEC"]
+        self.max_in_flight = app.config["MAIL_MAX_IN_FLIGHT"]
+        app.extensions["delivery"] = self
+
+    def submit(self, message: Message) -> Future:
+        """Deliver a message, in the background if MAIL_ASYNC is set.
+
+        Args:
+            message: The rendered message.
+
+        Returns:
+            A future that completes when the message has been sent, or
+            raises the error that stopped it.
+        """
+        if not self.enabled:
+            self._send(message)
+            future = Future()
+            future.set_result(None)
+            return future
+
+        loop = self._get_loop()
+        self._in_flight.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            self._deliver(message), loop
+        )
+        with self._lock:
+            self._pending.add(future)
+            in_flight.set(len(self._pending))
+        future.add_done_callback(self._done)
+        return future
+
+    def deliver(self, *messages: Message):
+        """Deliver messages, waiting until every one is sent.
+
+        Within ``collect`` the messages are only submitted, and their
+        futures added to the collected list.
+
+        Args:
+            *messages: The rendered messages.
+
+        Raises:
+            Exception: The error that stopped the first failed message.
+        """
+        futures = [self.submit(message) for message in messages]
+        collected = getattr(self._local, "collected", None)
+        if collected is not None:
+            collected.extend(futures)
+            return
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    @contextmanager
+    def collect(self) -> Iterator[List[Future]]:
+        """Gather the futures of messages delivered within the context.
+
+        Returns:
+            The list the futures are added to.
+        """
+        collected = []
+        self._local.collected = collected
+        try:
+            yield collected
+        finally:
+            self._local.collected = None
+
+    def close(self, timeout: float = None):
+        """Wait for submitted messages and stop the event loop.
+
+        Args:
+            timeout: The most seconds to wait for messages to be sent.
+        """
+        with self._lock:
+            loop, pending = self._loop, set(self._pending)
+            self._loop = None
+        if loop is None or self._pid != getpid():
+            return
+
+        wait(pending, timeout)
+        loop.call_soon_threadsafe(loop.stop)
+        self._executor.shutdown(wait=False)
+
+    async def _deliver(self, message: Message):
+        """Send a message within the limits, retrying temporary failures."""
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_event_loop()
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with AsyncExitStack() as stack:
+                    await stack.enter_async_context(self._limit)
+                    for domain in sorted(recipient_domains(message)):
+                        limit = self._domain_limit(domain)
+                        await stack.enter_async_context(limit)
+                    await loop.run_in_executor(
+                        self._executor, self._send, message
+                    )
+                return
+            except Exception as e:
+                if attempt == self.retries or not is_temporary(e):
+                    raise
+                delay = self.backoff_sec * 2 ** attempt
+                self.app.logger.warning(
+                    f"Retrying email to {message.send_to} in {delay}s : {e}"
+                )
+                retries.inc()
+            await asyncio.sleep(delay)
+
+    def _domain_limit(self, domain: str) -> asyncio.Semaphore:
+        """Get the semaphore limiting deliveries to a recipient domain."""
+        limit = self._domains.get(domain)
+        if limit is None:
+            limit = asyncio.Semaphore(self.domain_concurrency)
+            self._domains[domain] = limit
+        return limit
+
+    def _send(self, message: Message):
+        """Send a message from an executor thread."""
+        with self.app.app_context():
+            self.pool.send(message)
+
+    def _done(self, future: Future):
+        """Account for a finished delivery and log its failure."""
+        with self._lock:
+            self._pending.discard(future)
+            in_flight.set(len(self._pending))
+        self._in_flight.release()
+
+        error = future.exception()
+        if error is not None:
+            failures.inc()
+            self.app.logger.error(f"Email delivery failed : {error!r}")
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Get this process's event loop, starting it on first use."""
+        with self._lock:
+            if self._loop is None or self._pid != getpid():
+                self._loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(
+                    self.concurrency, thread_name_prefix="mail"
+                )
+                self._in_flight = BoundedSemaphore(self.max_in_flight)
+                self._limit = None
+                self._domains = {}
+                self._pending = set()
+                self._pid = getpid()
+                Thread(
+                    target=self._loop.run_forever,
+                    name="mail-delivery",
+                    daemon=True,
+                ).start()
+            return self._loop
@@ -0,0 +1,343 @@
+"""Password hashing performed in a dedicated, bounded process pool.
+
+bcrypt is deliberately slow. Running it inline on the few uWSGI threads
+lets a burst of logins starve every other request, so all hashing work is
+handed to a process pool that is sized to the host's cores. The number of
+requests allowed to wait on the pool is bounded per process. Requests that
+cannot be admitted, or that miss their deadline, fail fast with a
+``HashPoolBusy`` error that is rendered as a 503 with a Retry-After header.
+
+The algorithm is chosen from a registry of hashers. Each stored hash keeps
+the algorithm name and cost it was made with, so the configured algorithm
+or cost can change at any time and users are migrated as they log in.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from functools import partial
+from os import cpu_count, getpid
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from argon2 import PasswordHasher, Type
+from argon2.exceptions import InvalidHash, VerificationError
+from bcrypt import checkpw, gensalt, hashpw
+from flask import Flask
+
+
+class HashPoolBusy(Exception):
+    """The hashing pool cannot accept or complete work right now.
+
+    Attributes:
+        retry_after: Seconds the client should wait before retrying.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Hasher:
+    """A password hashing algorithm with a tunable cost.
+
+    Attributes:
+        name: The algorithm name stored next to each password hash.
+        min_cost: The lowest cost auto-tuning is allowed to choose.
+        max_cost: The highest cost auto-tuning is allowed to choose.
+        default_cost: The cost used when no cost is configured.
+    """
+
+    name: str = ""
+    min_cost: int = 1
+    max_cost: int = 1
+    default_cost: int = 1
+
+    def hash(self, pw: bytes, cost: int) -> bytes:
+        """Hash a password with a new salt at the given cost."""
+        raise NotImplementedError
+
+    def check(self, pw: bytes, pw_hash: bytes) -> bool:
+        """Check a password against a hash made by this algorithm."""
+        raise NotImplementedError
+
+
+class BcryptHasher(Hasher):
+    """bcrypt, where the cost is the log2 of the number of rounds."""
+
+    name = "bcrypt"
+    min_cost = 10
+    max_cost = 16
+    default_cost = 12
+
+    def hash(self, pw: bytes, cost: int) -> bytes:
+        return hashpw(pw, gensalt(rounds=cost))
+
+    def check(self, pw: bytes, pw_hash: bytes) -> bool:
+        return checkpw(pw, pw_hash)
+
+
+class Argon2idHasher(Hasher):
+    """argon2id, where the cost is the number of passes over memory.
+
+    Parallelism is fixed at one lane as the pool already uses every core.
+
+    Args:
+        memory_kib: The memory used by each hash in kibibytes.
+    """
+
+    name = "argon2id"
+    min_cost = 2
+    max_cost = 16
+    default_cost = 3
+
+    def __init__(self, memory_kib: int = 65536):
+        self.memory_kib = memory_kib
+
+    def hash(self, pw: bytes, cost: int) -> bytes:
+        ph = PasswordHasher(
+            time_cost=cost,
+            memory_cost=self.memory_kib,
+            parallelism=1,
+            type=Type.ID,
+        )
+        return ph.hash(pw).encode("utf-8")
+
+    def check(self, pw: bytes, pw_hash: bytes) -> bool:
+        try:
+            return PasswordHasher().verify(pw_hash, pw)
+        except (InvalidHash, VerificationError):
+            return False
+
+
+#: All available password hashers keyed by algorithm name
+hashers: Dict[str, Hasher] = {}
+
+
+def register_hasher(hasher: Hasher):
+    """Make a password hasher available by its algorithm name.
+
+    Args:
+        hasher: The hasher to register.
+    """
+    hashers[hasher.name] = hasher
+
+
+register_hasher(BcryptHasher())
+register_hasher(Argon2idHasher())
+
+
+def tune_cost(hasher: Hasher, budget_ms: float, min_cost: int = None) -> int:
+    """Benchmark this host to find the highest cost within a time budget.
+
+    A host that is busy while it benchmarks, such as one starting several
+    processes at once, measures slow hashes, so the result is floored.
+
+    Args:
+        hasher: The hasher to benchmark.
+        budget_ms: The target time for a single hash in milliseconds.
+        min_cost: The lowest cost to choose.
+
+    Returns:
+        The highest cost that hashes within the budget, but never less
+        than min_cost or the hasher's minimum cost.
+    """
+
+    cost = max(hasher.min_cost, min_cost or 0)
+    while cost < hasher.max_cost:
+        start = perf_counter()
+        hasher.hash(b"benchmark", cost + 1)
+        if (perf_counter() - start) * 1000 > budget_ms:
+            break
+        cost += 1
+
+    return cost
+
+
+def _check(algo: str, pw: bytes, pw_hash: bytes) -> bool:
+    """Verify a password in a worker process."""
+    return hashers[algo].check(pw, pw_hash)
+
+
+def _hash(algo: str, pw: bytes, cost: int) -> bytes:
+    """Hash a password in a worker process."""
+    return hashers[algo].hash(pw, cost)
+
+
+class HashPool:
+    """Bounded process pool used for all password hashing.
+
+    The pool is created lazily in each process so that uWSGI workers
+    forked from the master never share the master's pool. Serving
+    processes start it in uWSGI's postfork hook instead, before they start
+    threads, as forking a threaded process can copy locks held by other
+    threads into the workers - see run.py.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.algo = BcryptHasher.name
+        self.cost = BcryptHasher.default_cost
+        self.workers = 0
+        self.timeout = None
+        self.retry_after = 1
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(1)
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the pool from the application config.
+
+        When no cost is configured it is tuned to PW_HASH_BUDGET_MS by
+        benchmarking the host once at startup, but never below
+        PW_HASH_MIN_COST or, without one, the algorithm's default cost.
+
+        Args:
+            app: The Flask application object.
+        """
+
+        self.algo = app.config["PW_HASH_ALGO"]
+        hasher = hashers[self.algo]
+        self.cost = app.config["PW_HASH_COST"]
+        if self.cost is None:
+            if app.config["PW_HASH_BUDGET_MS"]:
+                self.cost = tune_cost(
+                    hasher,
+                    app.config["PW_HASH_BUDGET_MS"],
+                    app.config["PW_HASH_MIN_COST"] or hasher.default_cost,
+                )
+            else:
+                self.cost = hasher.default_cost
+        app.logger.info(f"Password hashing with {self.algo} cost {self.cost}")
+
+        workers = app.config["PW_HASH_WORKERS"]
+        if workers is None:
+            share = (cpu_count() or 1) // app.config["PW_HASH_PROCESSES"]
+            workers = min(app.config["PW_HASH_MAX_PENDING"], max(1, share))
+        self.workers = workers
+        self.timeout = app.config["PW_HASH_TIMEOUT_SEC"]
+        self.retry_after = app.config["PW_HASH_RETRY_AFTER_SEC"]
+        self._slots = BoundedSemaphore(app.config["PW_HASH_MAX_PENDING"])
+        self.shutdown()
+        app.extensions["hash_pool"] = self
+
+    def start(self):
+        """Start this process's worker processes, if it has any."""
+        if self.workers:
+            self._get_executor().submit(getpid).result()
+
+    def shutdown(self):
+        """Stop the worker processes owned by this process, if any."""
+        with self._lock:
+            if self._executor and self._pid == getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._pid = None
+
+    def checkpw(self, pw: str, pw_hash: bytes, algo: str) -> bool:
+        """Check a password against a stored hash.
+
+        Args:
+            pw: The plain text password.
+            pw_hash: The stored password hash.
+            algo: The algorithm the stored hash was made with.
+
+        Returns:
+            True if the password matches the hash.
+        """
+        return self._run(_check, algo, pw.encode("utf-8"), pw_hash)
+
+    def hashpw(self, pw: str) -> bytes:
+        """Hash a password with the configured algorithm and cost.
+
+        Args:
+            pw: The plain text password.
+
+        Returns:
+            The password hash.
+        """
+        return self._run(_hash, self.algo, pw.encode("utf-8"), self.cost)
+
+    def hashpw_many(self, pws: List[str], cost: int = None) -> List[bytes]:
+        """Hash a batch of passwords across every worker process.
+
+        This is meant for bulk jobs such as imports, so it is not limited
+        by PW_HASH_MAX_PENDING and waits for the whole batch.
+
+        Args:
+            pws: The plain text passwords.
+            cost: The cost to hash with instead of the configured cost.
+
+        Returns:
+            The password hashes, in the same order as the passwords.
+        """
+        fn = partial(_hash, self.algo, cost=cost or self.cost)
+        pws = [pw.encode("utf-8") for pw in pws]
+        if not self.workers:
+            return [fn(pw) for pw in pws]
+        chunksize = max(1, len(pws) // (self.workers * 4))
+        return list(self._get_executor().map(fn, pws, chunksize=chunksize))
+
+    def needs_rehash(self, algo: str, cost: int) -> bool:
+        """Check if a stored hash should be replaced on the next login.
+
+        Hashes are only replaced to change algorithm or raise their cost.
+        One made at a higher cost than this host's is kept, so a host that
+        tunes to a lower cost never weakens stored hashes.
+
+        Args:
+            algo: The algorithm the stored hash was made with.
+            cost: The cost the stored hash was made with, if known.
+
+        Returns:
+            True if the hash is out of date.
+        """
+        return (
+            algo != self.algo
+            or cost is None
+            or cost < self.cost
+        )
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Get this process's executor, creating it after a fork."""
+        with self._lock:
+            if self._pid != getpid():
+                self._executor = ProcessPoolExecutor(self.workers)
+                self._pid = getpid()
+            return self._executor
+
+    def _run(self, fn: Callable, *args):
+        """Run a hashing function subject to the pool's limits."""
+
+        # Reject immediately rather than queueing behind other requests
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashPoolBusy(
+                "Password hashing queue is full", self.retry_after
+            )
+
+        # Run inline when no worker processes are configured
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                slots.release()
+
+        # The slot is held until the work finishes, even after a timeout
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashPoolBusy("Password hashing timed out", self.retry_after)
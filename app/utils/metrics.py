@@ -0,0 +1,197 @@
+"""A minimal in-process metrics registry.
+
+Counters, gauges and histograms are kept in memory and rendered in the
+Prometheus text format by the ``/api/metrics`` view. Each uWSGI worker
+keeps its own metrics, so every sample carries a ``pid`` label naming the
+worker that served the scrape.
+
+Example Usage::
+
+    waits = registry.histogram("db_wait_seconds", "Connection waits")
+    waits.observe(0.002, pool="mariadb")
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from os import getpid
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+
+#: Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _labels(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    """A hashable, ordered form of a metric's labels."""
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(name: str, labels: Tuple, value: float) -> str:
+    """Format one sample in the Prometheus text format."""
+    pairs = labels + (("pid", str(getpid())),)
+    text = ",".join(f'{k}="{v}"' for k, v in pairs)
+    return f"{name}{{{text}}} {value:g}"
+
+
+class Metric:
+    """The state shared by every kind of metric.
+
+    Args:
+        name: The metric name.
+        description: The help text rendered with the metric.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = Lock()
+
+    def render(self) -> List[str]:
+        """Render the metric's help, type and samples."""
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ] + self.samples()
+
+    def samples(self) -> List[str]:
+        """Render the metric's samples."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only increases, such as a number of events."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increase the counter for a set of labels."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels: str) -> float:
+        """Get the counter's value for a set of labels."""
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [_format(self.name, k, v) for k, v in items]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as connections in use."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        """Set the gauge for a set of labels."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Counts observations, such as latencies, into buckets.
+
+    Args:
+        name: The metric name.
+        description: The help text rendered with the metric.
+        buckets: The increasing upper bounds of the buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+        self._counts = {}
+        self._sums = defaultdict(float)
+
+    def observe(self, value: float, **labels: str):
+        """Record an observation for a set of labels."""
+        key = _labels(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        """Get the number of observations for a set of labels."""
+        return sum(self._counts.get(_labels(labels), ()))
+
+    def samples(self) -> List[str]:
+        lines = []
+        bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        with self._lock:
+            items = [
+                (key, list(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            ]
+        for key, counts, total in items:
+            cumulative = 0
+            for le, count in zip(bounds, counts):
+                cumulative += count
+                name = f"{self.name}_bucket"
+                lines.append(_format(name, key + (("le", le),), cumulative))
+            lines.append(_format(f"{self.name}_sum", key, total))
+            lines.append(_format(f"{self.name}_count", key, cumulative))
+        return lines
+
+
+class Registry:
+    """Creates and renders a process's metrics."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, description: str) -> Counter:
+        """Get or create a counter."""
+        return self._get(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """Get or create a gauge."""
+        return self._get(Gauge, name, description)
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Get or create a histogram."""
+        return self._get(Histogram, name, description, buckets)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _get(self, cls, name: str, *args) -> Metric:
+        """Get a metric by name, creating it on first use."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            return metric
+
+
+#: The process's metrics
+registry = Registry()
@@ -0,0 +1,195 @@
+"""A transactional outbox for the Celery tasks triggered by views.
+
+A view that commits a change and then calls ``.delay`` loses the task if
+the broker is unreachable between the two, and pays a broker round trip
+for every task. Instead the view adds the task to the outbox table in the
+same transaction as its change, so the task exists exactly when the change
+does.
+
+Once its response has been sent, a request publishes the tasks it added,
+see app.utils.deferred. The dispatcher, ``flask outbox run`` - see run.sh,
+publishes any left behind, such as while the broker was down. It claims up
+to OUTBOX_BATCH_SIZE rows at a time and publishes each batch as a single
+``send_outbox`` task, which runs the tasks in the worker. The batch is
+removed in the same transaction that claimed it, so a failed publish
+leaves it in the table to be tried again, and a dispatcher that dies after
+publishing may send a batch twice but never drops one. Rows are claimed
+with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the database supports it,
+so dispatchers on several hosts take different batches without waiting on
+each other. SQLite has no row locks and allows one writer at a time, so a
+dispatcher there gives up a batch that another removed first.
+
+While publishes keep failing the broker's circuit breaker opens, see
+app.utils.breaker. Requests and the dispatcher then leave tasks in the
+outbox without waiting on the broker, and the dispatcher drains the
+backlog once a probe gets through.
+
+Example Usage::
+
+    db.session.add(new_user)
+    enqueue(send_new_user_email, new_user.email)
+    db.session.commit()
+"""
+
+import json
+from time import monotonic, sleep
+from typing import Callable, List
+
+from flask import current_app as app
+from sqlalchemy import Table, select
+
+from app.extensions import broker_breaker, db, deferred
+from app.models.db import Outbox
+from app.utils.breaker import CircuitOpen
+from app.utils.metrics import registry
+
+#: The outbox table
+outbox: Table = Outbox.__table__
+
+#: Dialects that can skip rows locked by another dispatcher
+SKIP_LOCKED_DIALECTS = {"mysql", "postgresql", "oracle"}
+
+#: Tasks published from the outbox
+dispatched = registry.counter(
+    "outbox_dispatched_total", "Tasks published from the outbox."
+)
+
+
+def enqueue(task: Callable, *args):
+    """Add a task to the outbox within the current session's transaction.
+
+    Within a request the task is also published once the response has been
+    sent, see app.utils.deferred.
+
+    Args:
+        task: The Celery task.
+        *args: The task's JSON serializable arguments.
+    """
+    row = Outbox(task=task.name, args=json.dumps(args))
+    db.session.add(row)
+    deferred.add(row)
+
+
+def dispatch_batch(batch_size: int, ids: List[int] = None) -> int:
+    """Claim the oldest tasks in the outbox and publish them as one batch.
+
+    Args:
+        batch_size: The most tasks to publish.
+        ids: Only claim the tasks with these IDs.
+
+    Returns:
+        The number of tasks published.
+
+    Raises:
+        CircuitOpen: The broker has been failing and is not being tried.
+    """
+    # Imported here as the tasks need the Celery app made by create_app
+    from app.tasks import send_outbox
+
+    if not broker_breaker.allow():
+        raise CircuitOpen(
+            "Broker unavailable", retry_after=broker_breaker.retry_after
+        )
+
+    query = select([outbox]).order_by(outbox.c.id).limit(batch_size)
+    if ids is not None:
+        query = query.where(outbox.c.id.in_(ids))
+    with db.engine.connect() as conn, conn.begin() as trans:
+        if conn.dialect.name in SKIP_LOCKED_DIALECTS:
+            query = query.with_for_update(skip_locked=True)
+        rows = conn.execute(query).fetchall()
+        if not rows:
+            return 0
+
+        ids = [row.id for row in rows]
+        deleted = conn.execute(outbox.delete().where(outbox.c.id.in_(ids)))
+        if deleted.rowcount != len(ids):
+            # Another dispatcher removed part of the batch first
+            trans.rollback()
+            return 0
+
+        entries = [[row.task, json.loads(row.args)] for row in rows]
+        publish(send_outbox, entries)
+    dispatched.inc(len(rows))
+    return len(rows)
+
+
+def publish(task: Callable, *args):
+    """Publish a task within the broker timeouts, tracking the breaker.
+
+    The publish gets its own connection with BROKER_PUBLISH_TIMEOUT_SEC
+    connect and socket timeouts, rather than the defaults that can wait
+    on an unresponsive broker indefinitely. Errors, timeouts and publishes
+    slower than BROKER_SLOW_PUBLISH_SEC count as breaker failures.
+
+    Args:
+        task: The Celery task.
+        *args: The task's arguments.
+    """
+    timeout = app.config["BROKER_PUBLISH_TIMEOUT_SEC"]
+    start = monotonic()
+    try:
+        with task.app.connection_for_write(
+            connect_timeout=timeout,
+            transport_options={
+                "socket_timeout": timeout,
+                "socket_connect_timeout": timeout,
+            },
+        ) as conn:
+            task.apply_async(args, connection=conn, retry=False)
+    except Exception:
+        broker_breaker.failure()
+        raise
+
+    elapsed = monotonic() - start
+    if elapsed > app.config["BROKER_SLOW_PUBLISH_SEC"]:
+        app.logger.warning(f"Slow publish of {task.name} : {elapsed:.2f}s")
+        broker_breaker.failure()
+    else:
+        broker_breaker.success()
+
+
+def pending() -> int:
+    """Count the tasks waiting in the outbox."""
+    with db.engine.connect() as conn:
+        return conn.execute(select([db.func.count(outbox.c.id)])).scalar()
+
+
+def run_dispatcher(
+    batch_size: int = None, poll_sec: float = None, once: bool = False
+) -> int:
+    """Publish tasks from the outbox as they are added.
+
+    Each argument that is None uses its configured default.
+
+    Args:
+        batch_size: The most tasks published together.
+        poll_sec: The pause once the outbox is empty.
+        once: Stop once the outbox is empty rather than polling.
+
+    Returns:
+        The number of tasks published.
+    """
+    batch_size = batch_size or app.config["OUTBOX_BATCH_SIZE"]
+    if poll_sec is None:
+        poll_sec = app.config["OUTBOX_POLL_SEC"]
+
+    total = 0
+    while True:
+        try:
+            count = dispatch_batch(batch_size)
+        except CircuitOpen as e:
+            if once:
+                raise
+            sleep(max(e.retry_after, poll_sec))
+            continue
+        except Exception as e:
+            if once:
+                raise
+            app.logger.error(f"Outbox dispatch failed : {e!r}")
+            count = 0
+        total += count
+        if count < batch_size:
+            if once:
+                return total
+            sleep(poll_sec)
@@ -0,0 +1,130 @@
+"""Database connection pool instrumentation and pre-warming.
+
+Every engine that would use a QueuePool uses ``InstrumentedQueuePool``
+instead while DB_POOL_METRICS is set. It records how long each checkout
+waits for a connection, how many connections are in use and in overflow,
+and how many are opened, invalidated or time out, labelled by host.
+
+Connections are opened lazily, so the first requests a new uWSGI worker
+serves would each pay for a new connection. ``prewarm_pools`` opens
+DB_POOL_PREWARM connections per engine up front, and is run after each
+worker forks - see run.py.
+"""
+
+from time import perf_counter
+
+from flask import Flask
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+from app.utils.metrics import registry
+
+#: Seconds each checkout waited for a connection
+checkout_wait = registry.histogram(
+    "db_pool_checkout_wait_seconds",
+    "Seconds a checkout waited for a pooled connection.",
+    (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+
+#: Connections currently checked out
+in_use = registry.gauge(
+    "db_pool_in_use", "Connections currently checked out of the pool."
+)
+
+#: Connections currently open beyond the pool size
+overflow = registry.gauge(
+    "db_pool_overflow", "Connections open beyond the pool size."
+)
+
+#: Connections opened
+connects = registry.counter("db_pool_connects_total", "Connections opened.")
+
+#: Connections invalidated, such as after a disconnect
+invalidations = registry.counter(
+    "db_pool_invalidations_total", "Connections invalidated."
+)
+
+#: Checkouts that gave up waiting for a connection
+timeouts = registry.counter(
+    "db_pool_timeouts_total", "Checkouts that timed out waiting."
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records its use in the metrics registry.
+
+    Attributes:
+        label: The host the pool connects to, used as the metric label.
+    """
+
+    label = ""
+
+    def recreate(self) -> "InstrumentedQueuePool":
+        pool = super().recreate()
+        pool.label = self.label
+        return pool
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            timeouts.inc(pool=self.label)
+            raise
+        checkout_wait.observe(perf_counter() - start, pool=self.label)
+        self._record()
+        return conn
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._record()
+
+    def _record(self):
+        """Update the in use and overflow gauges."""
+        in_use.set(self.checkedout(), pool=self.label)
+        overflow.set(max(0, self.overflow()), pool=self.label)
+
+
+def instrument_pool(pool: InstrumentedQueuePool, label: str):
+    """Label a new pool and count the connections it opens and invalidates.
+
+    Listeners carry over when the pool is recreated, so this is called
+    once per engine.
+
+    Args:
+        pool: The engine's pool.
+        label: The host the pool connects to.
+    """
+    pool.label = label
+
+    @event.listens_for(pool, "connect")
+    def on_connect(*args):
+        connects.inc(pool=label)
+
+    @event.listens_for(pool, "invalidate")
+    def on_invalidate(*args):
+        invalidations.inc(pool=label)
+
+
+def prewarm_pools(app: Flask, engines):
+    """Open connections in each engine's pool ahead of the first request.
+
+    Args:
+        app: The Flask application object.
+        engines: The engines to warm.
+    """
+    count = app.config["DB_POOL_PREWARM"]
+    for engine in engines:
+        if not count or not isinstance(engine.pool, QueuePool):
+            continue
+        conns = []
+        try:
+            for _ in range(min(count, engine.pool.size())):
+                conns.append(engine.connect())
+        except exc.SQLAlchemyError as e:
+            app.logger.warning(f"Connection pool pre-warm failed : {e}")
+        finally:
+            for conn in conns:
+                conn.close()
+        host = engine.url.host or engine.url.database
+        app.logger.info(f"Pre-warmed {len(conns)} connections : {host}")
@@ -0,0 +1,303 @@
+"""Per-request SQL profiling.
+
+A sampled request records every statement it runs. When it finishes its
+query count, total database time and slowest statements are logged, and
+the count and time are also returned in the ``X-SQL-Queries`` and
+``X-SQL-Time-Ms`` response headers. Any SELECT slower than SQL_SLOW_MS is
+logged at once with its EXPLAIN output.
+
+Requests are sampled at SQL_PROFILE_RATE, and requests to the endpoints in
+SQL_PROFILE_ROUTES are always profiled. Both can be changed while running
+through the internal ``/api/profiler`` view, which saves them in the store
+at STORE_URL. Every process picks up the change within
+SQL_PROFILE_SYNC_SEC.
+"""
+
+import json
+from functools import wraps
+from random import random
+from time import monotonic, perf_counter
+from typing import Callable, List, Tuple
+
+from flask import Flask, current_app as app, g, has_request_context, request
+from sqlalchemy import event
+from redis.exceptions import RedisError
+from sqlalchemy.engine import Engine
+
+from app.utils.base import get_redis
+from app.utils.metrics import registry
+
+#: Queries run by each profiled request
+request_queries = registry.histogram(
+    "db_request_queries",
+    "Queries run by each profiled request.",
+    (1, 2, 5, 10, 20, 50, 100),
+)
+
+#: Requests that ran more queries than their view's budget
+budget_exceeded = registry.counter(
+    "db_query_budget_exceeded_total",
+    "Requests that ran more queries than their view's budget.",
+)
+
+#: EXPLAIN prefix for each SQL dialect that supports one
+EXPLAIN = {"mysql": "EXPLAIN ", "sqlite": "EXPLAIN QUERY PLAN "}
+
+#: Store key of the profiling settings changed while running
+SETTINGS_KEY = "sql_profile:settings"
+
+
+class Profile:
+    """The statements run by a single request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.statements: List[Tuple[float, str]] = []
+
+    def add(self, statement: str, elapsed: float):
+        """Record a statement and how long it took in seconds."""
+        self.count += 1
+        self.total += elapsed
+        self.statements.append((elapsed, statement))
+
+    def slowest(self, n: int) -> List[Tuple[float, str]]:
+        """Get the n slowest statements, slowest first."""
+        return sorted(self.statements, reverse=True)[:n]
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A view ran more SQL statements than its budget allows."""
+
+
+def query_budget(limit: int) -> Callable:
+    """Decorator function limiting the SQL statements a view may run.
+
+    Place it directly below the route so the user loader and any other
+    decorators count towards the budget. With QUERY_BUDGET_STRICT set an
+    exceeded budget raises QueryBudgetExceeded listing the statements,
+    otherwise it logs a warning and counts it in a metric.
+
+    Args:
+        limit: The most statements a single request may run.
+
+    Returns:
+        The decorated function.
+    """
+
+    def wrapper(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            # A view called from another view also counts towards its budget
+            outer = g.get("sql_budget")
+            g.sql_budget = budget = Profile()
+            try:
+                response = f(*args, **kwargs)
+            finally:
+                g.sql_budget = outer
+                if outer is not None:
+                    for elapsed, statement in budget.statements:
+                        outer.add(statement, elapsed)
+
+            if budget.count > limit:
+                _over_budget(budget, limit)
+            return response
+
+        wrapped.query_budget = limit
+        return wrapped
+
+    return wrapper
+
+
+def _over_budget(budget: Profile, limit: int):
+    """Report a request that went over its view's query budget."""
+    statements = "".join(f"\n  {s}" for _, s in budget.statements)
+    message = (
+        f"{request.endpoint} ran {budget.count} queries, over its budget of "
+        f"{limit}:{statements}"
+    )
+    if app.config["QUERY_BUDGET_STRICT"]:
+        raise QueryBudgetExceeded(message)
+    budget_exceeded.inc(endpoint=request.endpoint)
+    app.logger.warning(message)
+
+
+class SQLProfiler:
+    """Flask extension profiling the SQL run by sampled requests.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.sample_rate = 0.0
+        self.routes = set()
+        self.slow_sec = 0.1
+        self.top = 3
+        self.logger = None
+        self.redis = None
+        self.sync_sec = 1
+        self._synced_at = None
+        self._listening = False
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure profiling and hook into requests and every engine.
+
+        Args:
+            app: The Flask application object.
+        """
+        self.sample_rate = app.config["SQL_PROFILE_RATE"]
+        self.routes = set(app.config["SQL_PROFILE_ROUTES"])
+        self.slow_sec = app.config["SQL_SLOW_MS"] / 1000
+        self.top = app.config["SQL_PROFILE_TOP"]
+        self.logger = app.logger
+        url = app.config["STORE_URL"]
+        if url.startswith("memory://"):
+            self.redis = None
+        else:
+            self.redis = get_redis(url, app.config["STORE_TIMEOUT_SEC"])
+        self.sync_sec = app.config["SQL_PROFILE_SYNC_SEC"]
+        self._synced_at = None
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._before)
+            event.listen(Engine, "after_cursor_execute", self._after)
+            event.listen(Engine, "handle_error", self._error)
+            self._listening = True
+        app.extensions["profiler"] = self
+
+    @property
+    def settings(self) -> dict:
+        """The settings that can be changed while running."""
+        return {
+            "sample_rate": self.sample_rate,
+            "routes": sorted(self.routes),
+        }
+
+    def configure(self, sample_rate: float = None, routes: List[str] = None):
+        """Change which requests are profiled by every process.
+
+        Args:
+            sample_rate: The fraction of requests profiled.
+            routes: The endpoints whose requests are always profiled.
+
+        Raises:
+            RedisError: The settings could not be shared.
+        """
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if routes is not None:
+            self.routes = set(routes)
+        if self.redis is not None:
+            self.redis.set(SETTINGS_KEY, json.dumps(self.settings))
+
+    def _sync(self):
+        """Pick up settings changed by other processes."""
+        now = monotonic()
+        if self.redis is None:
+            return
+        synced_at = self._synced_at
+        if synced_at is not None and now < synced_at + self.sync_sec:
+            return
+        self._synced_at = now
+        try:
+            data = self.redis.get(SETTINGS_KEY)
+        except RedisError as e:
+            self.logger.warning(f"Profiler settings unavailable : {e}")
+            return
+        if data:
+            settings = json.loads(data)
+            self.sample_rate = settings["sample_rate"]
+            self.routes = set(settings["routes"])
+
+    def _start(self):
+        """Decide if this request is profiled."""
+        self._sync()
+        if request.endpoint in self.routes or random() < self.sample_rate:
+            g.sql_profile = Profile()
+
+    def _finish(self, response):
+        """Log a profiled request's statements and add its headers."""
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return response
+
+        total_ms = profile.total * 1000
+        request_queries.observe(profile.count, endpoint=request.endpoint)
+        response.headers["X-SQL-Queries"] = str(profile.count)
+        response.headers["X-SQL-Time-Ms"] = f"{total_ms:.1f}"
+
+        slowest = "".join(
+            f"\n  {elapsed * 1000:.1f} ms : {statement}"
+            for elapsed, statement in profile.slowest(self.top)
+        )
+        self.logger.info(
+            f"SQL profile {request.endpoint} : {profile.count} queries in "
+            f"{total_ms:.1f} ms{slowest}"
+        )
+        return response
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, many):
+        """Note when a statement starts."""
+        conn.info.setdefault("sql_profile_start", []).append(perf_counter())
+
+    @staticmethod
+    def _error(context):
+        """Forget the start of a statement that failed."""
+        conn = context.connection
+        starts = conn.info.get("sql_profile_start") if conn else None
+        if starts:
+            starts.pop()
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        """Record a statement and explain it if it was slow."""
+        elapsed = perf_counter() - conn.info["sql_profile_start"].pop()
+        if not has_request_context():
+            return
+
+        budget = g.get("sql_budget")
+        if budget is not None:
+            budget.add(statement, elapsed)
+
+        profile = g.get("sql_profile")
+        if profile is None:
+            return
+
+        profile.add(statement, elapsed)
+        if elapsed >= self.slow_sec:
+            plan = self._explain(conn, cursor, statement, parameters, context)
+            self.logger.warning(
+                f"Slow query {elapsed * 1000:.1f} ms in {request.endpoint} : "
+                f"{statement}{plan}"
+            )
+
+    @staticmethod
+    def _explain(conn, cursor, statement, parameters, context) -> str:
+        """Run EXPLAIN for a SELECT on the same connection."""
+        prefix = EXPLAIN.get(conn.dialect.name)
+        streaming = context and context.execution_options.get(
+            "stream_results"
+        )
+        if (
+            not prefix
+            or streaming
+            or not statement.lstrip().upper().startswith("SELECT")
+        ):
+            return ""
+
+        # Profiling must never fail the request, whatever the driver raises
+        explain = cursor.connection.cursor()
+        try:
+            explain.execute(prefix + statement, parameters)
+            rows = explain.fetchall()
+        except Exception as e:
+            return f"\n  EXPLAIN failed : {e}"
+        finally:
+            explain.close()
+        return "".join(f"\n  {tuple(row)}" for row in rows)
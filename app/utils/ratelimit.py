@@ -0,0 +1,238 @@
+"""Token bucket rate limiting for expensive views.
+
+Each limit is a bucket per client IP address or per account that holds up
+to ``count`` tokens and refills at ``count`` tokens per period. A request
+takes one token, and is rejected with a 429 when the bucket is empty. The
+check runs before the view so a rejected request never parses its form,
+touches the database, hashes a password or sends an email.
+
+Example Usage::
+
+    @user.route("/login", methods=["GET", "POST"])
+    @limiter.limit("10/minute")
+    @limiter.limit("5/minute", per="account")
+    def login():
+        ...
+"""
+
+from functools import wraps
+from threading import Lock
+from time import time
+from typing import Callable, Dict, Iterable, Tuple
+
+from flask import Flask, current_app as app, request
+from redis.exceptions import RedisError
+
+from app.utils.base import get_redis
+
+#: Seconds in each period a rate can be expressed in
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class RateLimited(Exception):
+    """A client has used up a rate limit.
+
+    Attributes:
+        retry_after: Seconds until the client may try again.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class MemoryBucketStore:
+    """Token buckets local to one process.
+
+    A bucket that has refilled behaves like one never used, so full
+    buckets are dropped every ``prune_sec`` to keep one-off clients from
+    growing the store without bound.
+
+    Args:
+        prune_sec: Seconds between sweeps for full buckets.
+    """
+
+    def __init__(self, prune_sec: float = 60):
+        self.prune_sec = prune_sec
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._prune_at = time() + prune_sec
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        """Take a token from a bucket.
+
+        Returns:
+            Zero if a token was taken, otherwise seconds until one is free.
+        """
+        now = time()
+        rate = capacity / period
+        with self._lock:
+            if now >= self._prune_at:
+                self._prune(now)
+            tokens, last, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            full_at = now + (capacity - tokens) / rate
+            self._buckets[key] = (tokens, now, full_at)
+            return wait
+
+    def _prune(self, now: float):
+        """Drop the buckets that have refilled, holding the lock."""
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if bucket[2] > now
+        }
+        self._prune_at = now + self.prune_sec
+
+
+class RedisBucketStore:
+    """Token buckets shared through Redis, updated atomically in Lua.
+
+    Args:
+        url: The Redis URL.
+        timeout: Seconds to wait on Redis.
+    """
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "last")
+    local tokens = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "last", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str, timeout: float = None):
+        self.redis = get_redis(url, timeout)
+        self._take = self.redis.register_script(self.SCRIPT)
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        """Take a token from a bucket.
+
+        Returns:
+            Zero if a token was taken, otherwise seconds until one is free.
+        """
+        return float(
+            self._take(keys=[key], args=[capacity, capacity / period, time()])
+        )
+
+
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """Parse a rate such as "5/minute" into a count and period.
+
+    Args:
+        rate: The number of requests allowed per second, minute, hour or
+            day.
+
+    Returns:
+        The count and the period in seconds.
+    """
+    count, period = rate.split("/")
+    return int(count), PERIODS[period.strip()]
+
+
+def request_account() -> str:
+    """The lower case email address a request is for, if it has one."""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        email = data.get("email") if isinstance(data, dict) else None
+    else:
+        email = request.form.get("email")
+    return email.lower() if isinstance(email, str) else ""
+
+
+class RateLimiter:
+    """Flask extension applying token bucket limits to views.
+
+    Limits are only enforced while RATELIMIT_ENABLED is set. If Redis is
+    unreachable requests are allowed rather than failing logins.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.store = MemoryBucketStore()
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the bucket store from the application config.
+
+        Args:
+            app: The Flask application object.
+        """
+        url = app.config["STORE_URL"]
+        if url.startswith("memory://"):
+            self.store = MemoryBucketStore()
+        else:
+            self.store = RedisBucketStore(
+                url, timeout=app.config["STORE_TIMEOUT_SEC"]
+            )
+        app.extensions["limiter"] = self
+
+    def limit(
+        self, rate: str, per: str = "ip", methods: Iterable[str] = ("POST",)
+    ) -> Callable:
+        """Decorator function limiting how often a view can be called.
+
+        Args:
+            rate: The allowed rate, such as "5/minute".
+            per: Either "ip" for a bucket per client address, or "account"
+                for a bucket per email address in the request.
+            methods: The HTTP methods the limit applies to.
+
+        Returns:
+            The decorated function if within the limit, otherwise an error.
+        """
+
+        count, period = parse_rate(rate)
+        methods = set(methods)
+
+        def wrapper(f):
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                if (
+                    app.config["RATELIMIT_ENABLED"]
+                    and request.method in methods
+                ):
+                    if per == "ip":
+                        key = request.remote_addr
+                    else:
+                        key = request_account()
+                    if key:
+                        key = f"rl:{request.endpoint}:{per}:{key}"
+                        self._take(key, count, period)
+                return f(*args, **kwargs)
+
+            return wrapped
+
+        return wrapper
+
+    def _take(self, key: str, count: int, period: int):
+        """Take a token or raise RateLimited if there is none."""
+        try:
+            wait = self.store.take(key, count, period)
+        except RedisError as e:
+            app.logger.warning(f"Rate limit store unavailable : {e}")
+            return
+        if wait:
+            app.logger.warning(f"Rate limited : {key}")
+            raise RateLimited("Too many requests", int(wait) + 1)
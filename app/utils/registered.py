@@ -0,0 +1,268 @@
+"""A shared Bloom filter of registered emails.
+
+Most login and recovery attempts for unknown emails come from credential
+stuffing and account probing. The filter lets those definite misses be
+answered without a database query, see app.utils.repository.
+
+The filter lives in a memory mapped file at EMAIL_FILTER_PATH, so every
+uWSGI worker on a host reads and updates the same bits. Its header holds
+the highest user ID added. A process scans only the users above that ID,
+or every user if the file is new, once uWSGI has forked it - see run.py -
+or else after its first request. Nothing is queried while the app is
+created, as a connection left in the pool then would be shared by every
+forked worker. Users are added as they are inserted. Every
+EMAIL_FILTER_SYNC_SEC each process scans the users above the ID again, to
+catch users added by other hosts and the CLI. The scan runs once a
+response has been sent, so it never adds to a request's latency.
+
+Users added by another host are missing from the filter until the next
+scan, so misses are only trusted for EMAIL_FILTER_MAX_AGE_SEC after a
+scan succeeds. An older filter sends every lookup to the database.
+
+IDs are not committed in order, so a user with an ID below the highest
+one may appear after the scan that passed it. Each scan therefore starts
+EMAIL_FILTER_RESCAN_IDS below the highest ID held.
+
+Deleted users cannot be removed from a Bloom filter. They only cost the
+query the filter would have saved, and are dropped when the file is
+recreated, such as when the host restarts and /dev/shm is emptied.
+
+Without a path the filter is kept in process memory. That is only correct
+with a single process, as in development.
+"""
+
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from functools import partial
+from fcntl import LOCK_EX, LOCK_UN, lockf
+from itertools import islice
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Tuple
+
+from flask import Flask, current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.utils.bloom import BloomFilter
+from app.utils.metrics import registry
+
+#: Lookups answered by the filter without a database query
+skipped = registry.counter(
+    "email_filter_skipped_total",
+    "Email lookups the filter answered without a database query.",
+)
+
+#: Magic bytes, number of hashes, number of bits and highest user ID added
+HEADER = struct.Struct("<4sIQQ")
+MAGIC = b"EBF1"
+
+
+def normalize(email: str) -> str:
+    """The form of an email added to and checked against the filter."""
+    return email.strip().lower()
+
+
+class RegisteredEmails:
+    """Flask extension tracking which emails may be registered.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.enabled = False
+        self.sync_sec = 0
+        self.max_age = 0
+        self.rescan_ids = 0
+        self.logger = None
+        self._bloom = BloomFilter(8, 1)
+        self._header = bytearray(HEADER.size)
+        self._fd = None
+        self._next_sync = 0
+        self._synced_at = None
+        self._lock = Lock()
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Open the filter, which is used once it has been synced.
+
+        Args:
+            app: The Flask application object.
+        """
+        self.close()
+        self.enabled = app.config["EMAIL_FILTER_ENABLED"]
+        self.sync_sec = app.config["EMAIL_FILTER_SYNC_SEC"]
+        self.max_age = app.config["EMAIL_FILTER_MAX_AGE_SEC"]
+        self.rescan_ids = app.config["EMAIL_FILTER_RESCAN_IDS"]
+        self.logger = app.logger
+        self._next_sync = 0
+        self._synced_at = None
+        app.extensions["registered_emails"] = self
+        if not self.enabled:
+            return
+
+        bloom = BloomFilter.for_capacity(
+            app.config["EMAIL_FILTER_CAPACITY"],
+            app.config["EMAIL_FILTER_ERROR_RATE"],
+        )
+        path = app.config["EMAIL_FILTER_PATH"]
+        if path:
+            try:
+                self._open(path, bloom.num_bits, bloom.num_hashes)
+            except OSError as e:
+                self.logger.warning(f"Email filter kept in memory : {e}")
+        if self._fd is None:
+            self._bloom = bloom
+            self._header = bytearray(
+                HEADER.pack(MAGIC, bloom.num_hashes, bloom.num_bits, 0)
+            )
+
+        app.after_request(self._after_request)
+
+    def close(self):
+        """Close the filter's file, if it has one."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def fresh(self) -> bool:
+        """Check if a scan succeeded within the last max_age seconds."""
+        synced_at = self._synced_at
+        if synced_at is None:
+            return False
+        return monotonic() - synced_at <= self.max_age
+
+    def __contains__(self, email: str) -> bool:
+        """Check if an email may be registered.
+
+        Unless the filter is fresh every email may be registered.
+        """
+        if not self.fresh or normalize(email) in self._bloom:
+            return True
+        skipped.inc()
+        return False
+
+    def add(self, emails: Iterable[str], max_id: int = 0):
+        """Add emails to the filter.
+
+        Args:
+            emails: The emails to add.
+            max_id: The highest user ID the emails belong to, if they are
+                every user above the ID the filter already holds.
+        """
+        if not self.enabled:
+            return
+        with self._locked():
+            for email in emails:
+                self._bloom.add(normalize(email))
+            _, num_hashes, num_bits, held_id = HEADER.unpack(self._header)
+            if max_id > held_id:
+                HEADER.pack_into(
+                    self._header, 0, MAGIC, num_hashes, num_bits, max_id
+                )
+
+    def sync(self):
+        """Add the users near or above the highest user ID held.
+
+        Scanning needs an application context. A failed scan is logged
+        and retried later, and the filter is not used until one succeeds.
+        """
+        start = monotonic()
+        self._next_sync = start + self.sync_sec
+        held_id = HEADER.unpack(self._header)[3]
+        try:
+            count = 0
+            after_id = max(0, held_id - self.rescan_ids)
+            for emails, max_id in self._scan(after_id):
+                self.add(emails, max_id)
+                count += len(emails)
+        except SQLAlchemyError as e:
+            self.logger.warning(f"Email filter sync failed : {e}")
+            return
+
+        if self._synced_at is None:
+            self.logger.info(f"Email filter ready, added {count} users")
+        self._synced_at = start
+
+    def _after_request(self, response):
+        """Sync once the interval passes and the response has been sent."""
+        if self.enabled and monotonic() >= self._next_sync:
+            # Claim the sync so concurrent requests do not scan as well
+            self._next_sync = monotonic() + self.sync_sec
+            app = current_app._get_current_object()
+            response.call_on_close(partial(self._sync_in, app))
+        return response
+
+    def _sync_in(self, app: Flask):
+        """Sync within a new application context."""
+        with app.app_context():
+            self.sync()
+
+    @staticmethod
+    def _scan(after_id: int) -> Iterable[Tuple[list, int]]:
+        """Stream the emails of users above an ID in batches."""
+
+        # Imported here as the models import the extensions
+        from app.extensions import db
+        from app.models.db import User
+
+        rows = iter(
+            db.session.query(User.id, User.email)
+            .filter(User.id > after_id)
+            .order_by(User.id)
+            .yield_per(1000)
+        )
+        while True:
+            batch = list(islice(rows, 1000))
+            if not batch:
+                break
+            yield [email for _, email in batch], batch[-1][0]
+
+    def _open(self, path: str, num_bits: int, num_hashes: int):
+        """Map the filter's file, creating it if it is new or resized."""
+        size = HEADER.size + BloomFilter.size_bytes(num_bits)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            lockf(fd, LOCK_EX)
+            header = os.pread(fd, HEADER.size, 0)
+            expected = (MAGIC, num_hashes, num_bits)
+            if (
+                len(header) < HEADER.size
+                or HEADER.unpack(header)[:3] != expected
+                or os.fstat(fd).st_size != size
+            ):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(*expected, 0), 0)
+            buf = mmap.mmap(fd, size)
+            lockf(fd, LOCK_UN)
+        except OSError:
+            os.close(fd)
+            raise
+
+        view = memoryview(buf)
+        self._fd = fd
+        self._header = view[: HEADER.size]
+        self._bloom = BloomFilter(num_bits, num_hashes, view[HEADER.size :])
+
+    @contextmanager
+    def _locked(self):
+        """Lock the filter against other threads and processes.
+
+        POSIX record locks are held per process, so unlike flock they also
+        exclude workers forked with the file already open.
+        """
+        with self._lock:
+            if self._fd is None:
+                yield
+                return
+            lockf(self._fd, LOCK_EX)
+            try:
+                yield
+            finally:
+                lockf(self._fd, LOCK_UN)
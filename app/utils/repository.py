@@ -0,0 +1,92 @@
+"""Precompiled lookups for the user queries run on every request.
+
+Building a Query and compiling it to SQL costs more Python time than
+running a simple indexed lookup. These lookups are baked, so each one is
+built and compiled once per process and later calls only bind their
+parameters. They run in ``db.session`` and are routed to replicas like
+any other query.
+
+Emails that a recently synced registered email filter has never seen are
+not looked up at all, see app.utils.registered. Checks guarding an insert
+skip the filter, as it can lag registrations on other hosts.
+
+Example Usage::
+
+    user = get_by_email(email)
+    if email_exists(email):
+        ...
+"""
+
+from typing import Optional
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+
+from app.extensions import db, registered_emails
+from app.models.db import Role, User
+
+#: Cache of compiled queries shared by every lookup
+bakery = baked.bakery()
+
+
+def get_by_email(email: str) -> Optional[User]:
+    """Get a user by their email.
+
+    Args:
+        email: The user's email, as stored.
+
+    Returns:
+        The user, otherwise None if there is no such user.
+    """
+    if email not in registered_emails:
+        return None
+    query = bakery(lambda s: s.query(User))
+    query += lambda q: q.filter(User.email == bindparam("email"))
+    return query(db.session()).params(email=email).first()
+
+
+def get_with_roles(user_id: int) -> Optional[User]:
+    """Get a user and their roles in a single query.
+
+    Args:
+        user_id: The user's database ID.
+
+    Returns:
+        The user, otherwise None if there is no such user.
+    """
+    query = bakery(lambda s: s.query(User))
+    query += lambda q: q.options(joinedload(User.roles))
+    query += lambda q: q.filter(User.id == bindparam("user_id"))
+    return query(db.session()).params(user_id=user_id).first()
+
+
+def email_exists(email: str, use_filter: bool = True) -> bool:
+    """Check if a user has registered an email, without loading them.
+
+    Args:
+        email: The email, as stored.
+        use_filter: Answer misses from the registered email filter.
+
+    Returns:
+        True if a user has the email.
+    """
+    if use_filter and email not in registered_emails:
+        return False
+    query = bakery(lambda s: s.query(User.id))
+    query += lambda q: q.filter(User.email == bindparam("email"))
+    return query(db.session()).params(email=email).first() is not None
+
+
+def get_role(name: str) -> Optional[Role]:
+    """Get a role by its name.
+
+    Args:
+        name: The role's name.
+
+    Returns:
+        The role, otherwise None if there is no such role.
+    """
+    query = bakery(lambda s: s.query(Role))
+    query += lambda q: q.filter(Role.name == bindparam("name"))
+    return query(db.session()).params(name=name).first()
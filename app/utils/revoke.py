@@ -0,0 +1,267 @@
+"""Revocation of API tokens before they expire.
+
+Two kinds of revocation are kept in a shared store: individual token IDs
+(the ``jti`` claim), and a per user "not before" time that rejects every
+token the user was issued before it. Entries only need to live as long as
+a token can, so they expire after JWT_EXP_SEC.
+
+Almost every token checked has not been revoked, so each process keeps a
+Bloom filter of the store's keys. A token is only looked up in the store
+when the filter reports a possible match. The filter follows the store's
+change log every REVOKE_REFRESH_SEC, so revocations made by other processes
+take effect within that interval.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask
+from redis.exceptions import RedisError
+
+from app.utils.base import get_redis
+from app.utils.bloom import BloomFilter
+
+
+class MemoryRevocationStore:
+    """Revocation store local to one process, for development and tests."""
+
+    def __init__(self):
+        self._keys: Dict[str, Tuple[float, int]] = OrderedDict()
+        self._log: List[str] = []
+        self._lock = Lock()
+
+    def add(self, key: str, value: int, ttl: int):
+        """Store a revocation key for ttl seconds."""
+        with self._lock:
+            self._keys[key] = (time() + ttl, value)
+            self._log.append(key)
+
+    def get(self, key: str) -> Optional[int]:
+        """Get the value of an unexpired revocation key."""
+        item = self._keys.get(key)
+        if item and item[0] > time():
+            return item[1]
+        return None
+
+    def snapshot(self) -> Tuple[int, List[str]]:
+        """Get every unexpired key and the log position that follows it."""
+        with self._lock:
+            now = time()
+            keys = [k for k, (exp, _) in self._keys.items() if exp > now]
+            return len(self._log), keys
+
+    def changes(self, version: int) -> Optional[Tuple[int, List[str]]]:
+        """Get keys added after a log position."""
+        with self._lock:
+            return len(self._log), self._log[version:]
+
+
+class RedisRevocationStore:
+    """Revocation store shared through Redis.
+
+    Keys are stored as ``revoke:<key>`` with an expiry, and each addition
+    is appended to the ``revoke:log`` stream that processes follow.
+
+    Args:
+        url: The Redis URL.
+        max_log: The approximate number of log entries to keep.
+        timeout: Seconds to wait on Redis.
+    """
+
+    LOG = "revoke:log"
+    PREFIX = "revoke:"
+
+    def __init__(
+        self, url: str, max_log: int = 100000, timeout: float = None
+    ):
+        self.redis = get_redis(url, timeout)
+        self.max_log = max_log
+
+    def add(self, key: str, value: int, ttl: int):
+        """Store a revocation key for ttl seconds."""
+        pipe = self.redis.pipeline()
+        pipe.set(self.PREFIX + key, value, ex=max(1, int(ttl)))
+        pipe.xadd(self.LOG, {"k": key}, maxlen=self.max_log)
+        pipe.execute()
+
+    def get(self, key: str) -> Optional[int]:
+        """Get the value of an unexpired revocation key."""
+        value = self.redis.get(self.PREFIX + key)
+        return None if value is None else int(value)
+
+    def snapshot(self) -> Tuple[str, List[str]]:
+        """Get every unexpired key and the log position that follows it."""
+        last = self.redis.xrevrange(self.LOG, count=1)
+        version = last[0][0].decode() if last else "0-0"
+        keys = [
+            k.decode()[len(self.PREFIX) :]
+            for k in self.redis.scan_iter(f"{self.PREFIX}[tu]:*", count=1000)
+        ]
+        return version, keys
+
+    def changes(self, version: str) -> Optional[Tuple[str, List[str]]]:
+        """Get keys added after a log position.
+
+        Returns:
+            The new log position and keys, or None if the log has been
+            trimmed past the given position and a snapshot is needed.
+        """
+        entries = [
+            (entry_id.decode(), fields[b"k"].decode())
+            for entry_id, fields in self.redis.xrange(self.LOG, min=version)
+        ]
+
+        # The last entry seen is missing, check if it was trimmed away
+        if version != "0-0" and (not entries or entries[0][0] != version):
+            first = self.redis.xrange(self.LOG, count=1)
+            if first and _stream_id(first[0][0]) > _stream_id(version):
+                return None
+
+        keys = [key for entry_id, key in entries if entry_id != version]
+        return (entries[-1][0] if entries else version), keys
+
+
+def _stream_id(entry_id) -> Tuple[int, int]:
+    """Parse a Redis stream ID so IDs can be compared."""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, seq = entry_id.split("-")
+    return int(ms), int(seq)
+
+
+class RevocationList:
+    """Checks and records token revocations.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.store = MemoryRevocationStore()
+        self.ttl = 0
+        self.capacity = 1
+        self.refresh_sec = 0
+        self.logger = None
+        self._bloom = BloomFilter(8, 1)
+        self._count = 0
+        self._version = None
+        self._next_refresh = 0
+        self._lock = Lock()
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the store and build the filter from it.
+
+        Args:
+            app: The Flask application object.
+        """
+        url = app.config["STORE_URL"]
+        if url.startswith("memory://"):
+            self.store = MemoryRevocationStore()
+        else:
+            self.store = RedisRevocationStore(
+                url, timeout=app.config["STORE_TIMEOUT_SEC"]
+            )
+        self.ttl = app.config["JWT_EXP_SEC"]
+        self.capacity = app.config["REVOKE_BLOOM_CAPACITY"]
+        self.refresh_sec = app.config["REVOKE_REFRESH_SEC"]
+        self.logger = app.logger
+        self._version = None
+        self._next_refresh = 0
+        self._refresh()
+        app.extensions["revocations"] = self
+
+    def is_revoked(self, token_data: Dict) -> bool:
+        """Check if a decoded token has been revoked.
+
+        Args:
+            token_data: The token's claims.
+
+        Returns:
+            True if the token or every token of its user was revoked.
+        """
+        self._refresh()
+        jti = token_data.get("jti")
+        token_key = f"t:{jti}"
+        user_key = f"u:{token_data['sub'].lower()}"
+
+        # The common case: neither key can be in the store
+        maybe_token = jti and token_key in self._bloom
+        maybe_user = user_key in self._bloom
+        if not maybe_token and not maybe_user:
+            return False
+
+        # Confirm possible matches, failing closed if the store is down
+        try:
+            if maybe_token and self.store.get(token_key):
+                return True
+            if not maybe_user:
+                return False
+            not_before = self.store.get(user_key)
+        except RedisError as e:
+            self.logger.error(f"Revocation store unavailable : {e}")
+            return True
+        return not_before is not None and token_data["iat"] < not_before
+
+    def revoke_token(self, token_data: Dict):
+        """Revoke a single token by its ID.
+
+        Args:
+            token_data: The token's claims.
+        """
+        jti = token_data.get("jti")
+        if jti:
+            self._add(f"t:{jti}", 1, token_data["exp"] - time())
+
+    def revoke_user(self, email: str):
+        """Revoke every token issued to a user until now.
+
+        Args:
+            email: The user's email address.
+        """
+        self._add(f"u:{email.lower()}", int(time()), self.ttl)
+
+    def _add(self, key: str, value: int, ttl: float):
+        """Store a revocation and add it to the local filter at once."""
+        if ttl > 0:
+            self.store.add(key, value, ttl)
+            with self._lock:
+                self._bloom.add(key)
+                self._count += 1
+
+    def _rebuild(self):
+        """Build a new filter from a snapshot of the store."""
+        version, keys = self.store.snapshot()
+        bloom = BloomFilter.for_capacity(max(self.capacity, 2 * len(keys)))
+        for key in keys:
+            bloom.add(key)
+        with self._lock:
+            self._bloom = bloom
+            self._count = len(keys)
+            self._version = version
+            self._next_refresh = monotonic() + self.refresh_sec
+
+    def _refresh(self):
+        """Add keys revoked by other processes once the interval passes."""
+        if monotonic() < self._next_refresh:
+            return
+        self._next_refresh = monotonic() + self.refresh_sec
+
+        try:
+            changes = None
+            if self._version is not None:
+                changes = self.store.changes(self._version)
+            if changes is None or self._count > self.capacity:
+                self._rebuild()
+                return
+            with self._lock:
+                self._version, keys = changes
+                for key in keys:
+                    self._bloom.add(key)
+                self._count += len(keys)
+        except RedisError as e:
+            self.logger.warning(f"Revocation filter refresh failed : {e}")
@@ -0,0 +1,159 @@
+"""Routing of read only queries to database replicas.
+
+Replicas are ordinary Flask-SQLAlchemy binds, configured in
+SQLALCHEMY_BINDS and listed in DB_REPLICA_BINDS. Each session picks one
+replica for its reads, and sends flushes, explicit writes and locking
+reads to the primary.
+
+Replicas lag behind the primary, so once a session has written anything
+it reads from the primary for the rest of its life, which is the rest of
+the request. While replicas are configured, a commit during a browser
+request also marks the browser session so that the client's next
+requests, such as the page it is redirected to, read from the primary for
+DB_REPLICA_STICKY_SEC. Requests authenticated by a bearer token are
+stateless and are not marked, so the JSON API never sets a cookie.
+
+Example Usage::
+
+    with db.use_primary():
+        user = User.query.filter(User.email == email).first()
+"""
+
+from contextlib import contextmanager
+from random import choice
+from time import time
+from typing import Dict, List
+
+from flask import Flask, g, has_request_context, session as flask_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+from app.utils.pool import InstrumentedQueuePool, instrument_pool
+
+#: Browser session key holding the time reads may use replicas again
+STICKY_KEY = "_db_primary_until"
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica until it writes."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.primary_depth = 0
+        self.wrote = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        """Get the primary, a model's own bind or this session's replica."""
+        bind = super().get_bind(mapper, clause)
+
+        # Models with a __bind_key__ are never routed
+        if bind is not self.bind:
+            return bind
+
+        if self._flushing or not self._is_read(clause):
+            self.wrote = True
+            return bind
+        if self.wrote or self.primary_depth:
+            return bind
+        return self._get_replica() or bind
+
+    def commit(self):
+        """Commit, keeping this client on the primary if anything changed."""
+        super().commit()
+        if (
+            self.wrote
+            and self.app.config["DB_REPLICA_BINDS"]
+            and has_request_context()
+            and "token_data" not in g
+        ):
+            sticky_sec = self.app.config["DB_REPLICA_STICKY_SEC"]
+            flask_session[STICKY_KEY] = int(time()) + sticky_sec
+
+    def _get_replica(self):
+        """Choose a replica engine for this session, if reads may use one."""
+        if self._replica is None:
+            self._replica = False
+            replicas = self.app.config["DB_REPLICA_BINDS"]
+            if replicas and not self._recently_wrote():
+                state = get_state(self.app)
+                self._replica = state.db.get_engine(
+                    self.app, bind=choice(replicas)
+                )
+        return self._replica
+
+    @staticmethod
+    def _is_read(clause) -> bool:
+        """Check if a statement is a plain SELECT."""
+        if clause is None:
+            return False
+        return isinstance(clause, Select) and clause._for_update_arg is None
+
+    @staticmethod
+    def _recently_wrote() -> bool:
+        """Check if this client committed a change within the sticky time."""
+        return (
+            has_request_context()
+            and flask_session.get(STICKY_KEY, 0) > time()
+        )
+
+
+def _enable_foreign_keys(dbapi_conn, connection_record):
+    """Turn on foreign key enforcement for a new SQLite connection."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with read only queries routed to replicas.
+
+    While DB_POOL_METRICS is set, engines that would use a QueuePool use
+    an instrumented one instead, see app.utils.pool.
+    """
+
+    def apply_driver_hacks(self, app: Flask, sa_url, options: Dict):
+        """Use the instrumented pool where a QueuePool would be used."""
+        super().apply_driver_hacks(app, sa_url, options)
+        if app.config["DB_POOL_METRICS"] and "poolclass" not in options:
+            default = sa_url.get_dialect().get_pool_class(sa_url)
+            if issubclass(default, QueuePool):
+                options["poolclass"] = InstrumentedQueuePool
+
+    def create_engine(self, sa_url, engine_opts: Dict):
+        """Create an engine, labelling its pool if it is instrumented.
+
+        SQLite only enforces foreign keys, and so cascades deletes, when
+        each connection asks it to.
+        """
+        engine = super().create_engine(sa_url, engine_opts)
+        if isinstance(engine.pool, InstrumentedQueuePool):
+            instrument_pool(engine.pool, sa_url.host or sa_url.database)
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", _enable_foreign_keys)
+        return engine
+
+    @property
+    def engines(self) -> List:
+        """The primary engine followed by every replica engine."""
+        app = self.get_app()
+        return [self.get_engine(app)] + [
+            self.get_engine(app, bind=bind)
+            for bind in app.config["DB_REPLICA_BINDS"]
+        ]
+
+    def create_session(self, options):
+        """Create the session factory, using the routing session."""
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def use_primary(self):
+        """Send every query made within the context to the primary."""
+        session = self.session()
+        session.primary_depth += 1
+        try:
+            yield
+        finally:
+            session.primary_depth -= 1
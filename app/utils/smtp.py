@@ -0,0 +1,203 @@
+"""A per-process pool of persistent SMTP connections.
+
+Flask-Mail opens a new connection, with its STARTTLS and login round
+trips, for every ``mail.send``. The pool keeps up to MAIL_POOL_SIZE
+connections open between tasks and reuses them. A connection idle for
+more than MAIL_POOL_NOOP_SEC is checked with a NOOP before it is used, one
+that has sent MAIL_POOL_MAX_MESSAGES is replaced, and a message that fails
+because the server dropped the connection is retried once on a new one.
+
+Connections cannot be shared with a forked process, so a Celery worker
+child that finds the pool was created by its parent starts a new one.
+
+Example Usage::
+
+    smtp_pool.send(welcome_msg, admin_msg)
+"""
+
+import smtplib
+from os import getpid
+from threading import Condition
+from time import monotonic
+from typing import List
+
+from flask import Flask, current_app
+from flask_mail import Connection, Message
+
+from app.utils.metrics import registry
+
+#: SMTP connections opened
+connects = registry.counter("smtp_connects_total", "SMTP connections opened.")
+
+#: Pooled connections that failed their NOOP check or dropped a message
+reconnects = registry.counter(
+    "smtp_reconnects_total", "Pooled SMTP connections found broken."
+)
+
+#: Errors meaning the connection, rather than the message, has failed
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, OSError)
+
+
+class PooledConnection(Connection):
+    """A Flask-Mail connection that stays open between messages.
+
+    Args:
+        mail: The Flask-Mail state.
+        timeout: Seconds to wait on the server before failing.
+    """
+
+    def __init__(self, mail, timeout: float):
+        super().__init__(mail)
+        self.timeout = timeout
+        self.num_emails = 0
+        self.last_used = monotonic()
+        self.closed = False
+        self.host = None if mail.suppress else self.configure_host()
+
+    def configure_host(self) -> smtplib.SMTP:
+        """Connect, start TLS and log in, with a timeout."""
+        mail = self.mail
+        cls = smtplib.SMTP_SSL if mail.use_ssl else smtplib.SMTP
+        host = cls(mail.server, mail.port, timeout=self.timeout)
+        try:
+            host.set_debuglevel(int(mail.debug))
+            if mail.use_tls:
+                host.starttls()
+            if mail.username and mail.password:
+                host.login(mail.username, mail.password)
+        except Exception:
+            host.close()
+            raise
+        connects.inc()
+        return host
+
+    def is_alive(self) -> bool:
+        """Check the server still answers on this connection."""
+        if self.host is None:
+            return True
+        try:
+            return self.host.noop()[0] == 250
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            return False
+
+    def close(self):
+        """Say goodbye to the server, ignoring a connection already lost."""
+        self.closed = True
+        if self.host is None:
+            return
+        try:
+            self.host.quit()
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            self.host.close()
+        self.host = None
+
+
+class SMTPPool:
+    """Flask extension sending mail over pooled SMTP connections.
+
+    Args:
+        app: The Flask application object.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.size = 1
+        self.max_messages = 100
+        self.noop_sec = 30
+        self.timeout = 30
+        self._idle: List[PooledConnection] = []
+        self._count = 0
+        self._pid = None
+        self._available = Condition()
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Configure the pool, closing any connections it has.
+
+        Args:
+            app: The Flask application object.
+        """
+        self.close()
+        self.size = app.config["MAIL_POOL_SIZE"]
+        self.max_messages = app.config["MAIL_POOL_MAX_MESSAGES"]
+        self.noop_sec = app.config["MAIL_POOL_NOOP_SEC"]
+        self.timeout = app.config["MAIL_TIMEOUT_SEC"]
+        app.extensions["smtp_pool"] = self
+
+    def send(self, *messages: Message):
+        """Send messages over a single pooled connection.
+
+        Args:
+            *messages: The messages to send, in order.
+        """
+        conn = self._acquire()
+        try:
+            for message in messages:
+                conn = self._send(conn, message)
+        finally:
+            self._release(conn)
+
+    def close(self):
+        """Close every idle connection this process opened."""
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            if self._pid != getpid():
+                return
+        for conn in idle:
+            conn.close()
+
+    def _send(self, conn: PooledConnection, message: Message):
+        """Send a message, retrying once on a new connection if it drops."""
+        if conn is not None and conn.num_emails >= self.max_messages:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self._connect()
+        try:
+            conn.send(message)
+        except CONNECTION_ERRORS as e:
+            current_app.logger.warning(f"SMTP connection lost : {e}")
+            reconnects.inc()
+            conn.close()
+            conn = self._connect()
+            conn.send(message)
+        return conn
+
+    def _connect(self) -> PooledConnection:
+        """Open a connection using the current app's mail settings."""
+        return PooledConnection(current_app.extensions["mail"], self.timeout)
+
+    def _acquire(self) -> PooledConnection:
+        """Take an idle connection, or None if a new one may be opened."""
+        with self._available:
+            if self._pid != getpid():
+                # The parent's connections belong to the parent
+                self._idle, self._count, self._pid = [], 0, getpid()
+            while not self._idle and self._count >= self.size:
+                self._available.wait()
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                self._count += 1
+                conn = None
+
+        if conn and monotonic() - conn.last_used > self.noop_sec:
+            if not conn.is_alive():
+                reconnects.inc()
+                conn.close()
+                conn = None
+        return conn
+
+    def _release(self, conn: PooledConnection):
+        """Return a connection to the pool, or free its place."""
+        if conn is not None and conn.num_emails >= self.max_messages:
+            conn.close()
+        with self._available:
+            if conn is None or conn.closed:
+                self._count -= 1
+            else:
+                conn.last_used = monotonic()
+                self._idle.append(conn)
+            self._available.notify()
@@ -0,0 +1,80 @@
+"""Compact signed tokens used for API authentication.
+
+A compact token is ``<payload>.<signature>`` where the payload is the
+URL safe base64 of the JSON claims and the signature is an HMAC-SHA256 of
+the payload. Unlike the JSON web signature format there is no header and
+the ``iat`` and ``exp`` claims are integer epoch seconds, so tokens are
+smaller and cheaper to parse. The HMAC key is derived once per signer
+rather than on every call.
+"""
+
+import hmac
+import json
+from hashlib import sha256
+from time import time
+from typing import Dict
+
+from itsdangerous import BadData, BadSignature, SignatureExpired
+from itsdangerous import base64_decode, base64_encode
+
+
+class CompactSigner:
+    """Signs and verifies compact tokens.
+
+    Args:
+        secret_key: The application's secret key.
+        salt: Separates these signatures from other uses of the key.
+    """
+
+    def __init__(self, secret_key: str, salt: str = "crc.token"):
+        key = sha256(f"{salt}\0{secret_key}".encode("utf-8")).digest()
+        self._mac = hmac.new(key, digestmod=sha256)
+
+    def dumps(self, claims: Dict) -> str:
+        """Sign a set of claims.
+
+        Args:
+            claims: JSON serializable claims, which must include ``exp``.
+
+        Returns:
+            The signed token.
+        """
+        payload = base64_encode(
+            json.dumps(claims, separators=(",", ":")).encode("utf-8")
+        )
+        sig = base64_encode(self._sign(payload))
+        return (payload + b"." + sig).decode("ascii")
+
+    def loads(self, token: str) -> Dict:
+        """Verify a token and return its claims.
+
+        Args:
+            token: The signed token.
+
+        Returns:
+            The token's claims.
+
+        Raises:
+            BadSignature: The token is malformed or its signature is wrong.
+            SignatureExpired: The token's ``exp`` claim has passed.
+        """
+        try:
+            payload, sig = token.encode("ascii").split(b".")
+            sig = base64_decode(sig)
+        except (BadData, UnicodeEncodeError, ValueError):
+            raise BadSignature("Malformed token")
+
+        if not hmac.compare_digest(sig, self._sign(payload)):
+            raise BadSignature("Signature does not match")
+
+        claims = json.loads(base64_decode(payload))
+        if claims["exp"] < time():
+            raise SignatureExpired("Signature expired", payload=claims)
+
+        return claims
+
+    def _sign(self, payload: bytes) -> bytes:
+        """HMAC a payload starting from the pre-keyed HMAC state."""
+        mac = self._mac.copy()
+        mac.update(payload)
+        return mac.digest()
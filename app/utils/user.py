@@ -1,16 +1,30 @@
 """Utility functions for user management."""
 
-from bcrypt import hashpw, gensalt
+from typing import Dict, Optional
+
 from flask import current_app as app
+from sqlalchemy import case, select
+from sqlalchemy.engine import RowProxy
 
-from app.extensions import db
+from app.extensions import cred_cache, db, hash_pool, login_failures
+from app.extensions import registered_emails, revocations, user_cache
 from app.models.db import User
 from app.utils.base import Return
+from app.utils.cache import UserSnapshot
+from app.utils.repository import email_exists, get_with_roles
+
+
+#: Dialects that can return columns from an UPDATE statement
+RETURNING_DIALECTS = {"postgresql", "oracle", "mssql"}
 
 
 def change_pw(email: str, pw: str) -> Return:
     """Change the user's password.
 
+    The new hash is written with a single UPDATE, without loading the
+    user, and the user's lockout count is cleared with it. Unknown emails
+    are turned away before the password takes a hashing slot.
+
     Args:
         email: The email of the user.
         pw: The new password for the user.
@@ -18,15 +32,154 @@ def change_pw(email: str, pw: str) -> Return:
     Returns:
         An object describing the status of the password change.
     """
-    user = db.session.query(User).filter(User.email == email).first()
-    if user:
-        user.pw_hash = hashpw(pw.encode("utf-8"), gensalt())
-        user.auth_fail = 0
-        db.session.add(user)
-        db.session.commit()
-        app.logger.info(f"Password reset completed by : {email}")
-        return Return(
-            True, "Your password has been updated successfully", user
-        )
+    if not email_exists(email):
+        return Return(False, f'"{email}" is not registered', None)
+
+    values = hash_values(pw)
+    values["auth_fail"] = 0
+    result = db.session.execute(
+        User.__table__.update().where(User.email == email).values(**values)
+    )
+    db.session.commit()
+
+    if not result.rowcount:
+        return Return(False, f'"{email}" is not registered', None)
+
+    # Revoking the user also drops their cached snapshot in every worker
+    cred_cache.invalidate(email)
+    login_failures.reset(email)
+    revocations.revoke_user(email)
+    app.logger.info(f"Password reset completed by : {email}")
+    return Return(True, "Your password has been updated successfully", None)
+
+
+def hash_values(pw: str) -> Dict:
+    """Hash a password into the user columns that store it.
+
+    Args:
+        pw: The password to hash.
+
+    Returns:
+        The pw_hash, pw_algo and pw_cost column values.
+    """
+    return {
+        "pw_hash": hash_pool.hashpw(pw),
+        "pw_algo": hash_pool.algo,
+        "pw_cost": hash_pool.cost,
+    }
+
+
+def set_pw(user: User, pw: str):
+    """Hash a password and store it, with its algorithm and cost, on a user.
+
+    The user is not committed to the database.
+
+    Args:
+        user: The user to update.
+        pw: The new password for the user.
+    """
+    for column, value in hash_values(pw).items():
+        setattr(user, column, value)
+
+
+def record_auth_fail(user_id: int, fails: int) -> int:
+    """Count a failed login against a user's row in a single statement.
+
+    The stored count is incremented by the database rather than written
+    from Python, so concurrent failures are never lost, and it is raised
+    to the sliding window's count if that is higher.
+
+    Args:
+        user_id: The user's database ID.
+        fails: The failures counted in the sliding window.
+
+    Returns:
+        The user's new auth_fail count.
+    """
+    auth_fail = User.__table__.c.auth_fail
+    count = case([(auth_fail >= fails, auth_fail + 1)], else_=fails)
+    row = update_user(User.id == user_id, {"auth_fail": count}, auth_fail)
+    return row.auth_fail if row else fails
+
+
+def update_user(criteria, values: Dict, *columns) -> Optional[RowProxy]:
+    """Update a user row and read back some of its columns.
+
+    The columns are returned by the UPDATE itself where the database
+    supports RETURNING. Elsewhere they are selected straight after it in
+    the same transaction, where the UPDATE's row lock keeps them current.
+    The change is committed.
+
+    Args:
+        criteria: The WHERE clause matching a single user.
+        values: The columns to set.
+        *columns: The columns to read back.
+
+    Returns:
+        The columns of the updated row, otherwise None if no row matched.
+    """
+    stmt = User.__table__.update().where(criteria).values(**values)
+    bind = db.session.get_bind(User.__mapper__, stmt)
+
+    if bind.dialect.name in RETURNING_DIALECTS:
+        row = db.session.execute(stmt.returning(*columns)).first()
     else:
-        return Return(False, f'"{email}" is not registered', user)
+        row = None
+        if db.session.execute(stmt).rowcount:
+            query = select(list(columns)).where(criteria)
+            row = db.session.execute(query).first()
+    db.session.commit()
+    return row
+
+
+def load_user(user_id: str) -> Optional[UserSnapshot]:
+    """Load the logged in user for Flask-Login, from the cache if possible.
+
+    A cache miss loads the user and their roles in a single query.
+
+    Args:
+        user_id: The user's database ID.
+
+    Returns:
+        A snapshot of the user, otherwise None if there is no such user.
+    """
+    snapshot = user_cache.get(user_id)
+    revoked = False
+
+    # Revocations are recorded in whole seconds, so a snapshot loaded in
+    # the same second as a revocation is also treated as stale
+    if snapshot and revocations.is_revoked(
+        {"sub": snapshot.email, "iat": snapshot.loaded_at - 1}
+    ):
+        user_cache.invalidate(user_id)
+        snapshot = None
+        revoked = True
+
+    # A revoked user was just changed, which replicas may not have seen
+    if snapshot is None:
+        if revoked:
+            with db.use_primary():
+                user = get_with_roles(int(user_id))
+        else:
+            user = get_with_roles(int(user_id))
+        if user:
+            snapshot = user_cache.add(user)
+    return snapshot
+
+
+@db.event.listens_for(User, "after_insert")
+def add_registered(mapper, conn, user: User):
+    """Add a new user's email to the registered email filter.
+
+    This runs before the user is committed, so no request can see the user
+    before the filter does.
+    """
+    registered_emails.add([user.email])
+
+
+@db.event.listens_for(User.roles, "append")
+@db.event.listens_for(User.roles, "remove")
+def invalidate_roles(user: User, *args):
+    """Drop a user's cached snapshot when their roles change."""
+    if user.id is not None:
+        user_cache.invalidate(user.id)
@@ -1,17 +1,27 @@
 """Application views that are limited to admin users."""
 
-from flask import render_template
+from flask import jsonify, render_template, request
 from flask_login import login_required
 
 from app.blueprints import admin
-from app.models.db import User
+from app.utils.admin import user_page
 from app.utils.auth import required_roles_ui
+from app.utils.profiler import query_budget
 
 
 @admin.route("/admin", methods=["GET", "POST"])
+@query_budget(2)
 @required_roles_ui(*["admin"])
 @login_required
 def adm():
     """The admin portal showing all registered users in a table."""
-    users = User.query.all()
-    return render_template("admin/admin.html", users=users)
+    return render_template("admin/admin.html")
+
+
+@admin.route("/admin/users", methods=["GET"])
+@query_budget(5)
+@required_roles_ui(*["admin"])
+@login_required
+def users():
+    """One page of the admin user table as DataTables JSON."""
+    return jsonify(user_page(request.args))
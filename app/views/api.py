@@ -1,23 +1,37 @@
 """API views supported by the application."""
 
-from flask import jsonify, request
+from flask import abort, current_app as app, g, jsonify, request
 from pydantic import ValidationError
+from redis.exceptions import RedisError
 
 from app.blueprints import api
-from app.extensions import db
-from app.models.api import AccountReq, AuthReq, AuthResp, BaseResp, MessageReq
-from app.models.db import User
-from app.tasks import send_contact_email
-from app.utils.auth import (
-    authenticate,
-    generate_jwt,
-    required_roles_api,
-    validate_jwt,
+from app.extensions import (
+    cred_cache,
+    db,
+    limiter,
+    profiler,
+    revocations,
+    user_cache,
+)
+from app.models.api import (
+    AccountReq,
+    AuthReq,
+    AuthResp,
+    BaseResp,
+    MessageReq,
+    ProfilerReq,
 )
+from app.tasks import send_contact_email
+from app.utils.auth import authenticate, generate_jwt, required_roles_api
+from app.utils.metrics import registry
+from app.utils.outbox import enqueue
+from app.utils.profiler import query_budget
+from app.utils.repository import get_by_email
 from app.utils.user import change_pw
 
 
 @api.route("/api/account", methods=["PUT"])
+@query_budget(5)
 @required_roles_api(*["user"])
 def change_password():
     """Changes the password for a user's account."""
@@ -28,16 +42,12 @@ def change_password():
     except ValidationError as e:
         return e.json(), 400
 
-    # Load the token
-    header = request.headers.get("Authorization")
-    jwt = header.split("Bearer ")[1]
-    token_data = validate_jwt(jwt)
-
     # Change the password via a function
-    result = change_pw(token_data["sub"], req.password)
+    result = change_pw(g.token_data["sub"], req.password)
 
     # Return the results of the password change
     if result.success:
+        revocations.revoke_token(g.token_data)
         return jsonify(
             BaseResp(status="success", message=result.message).dict()
         )
@@ -48,21 +58,25 @@ def change_password():
 
 
 @api.route("/api/account", methods=["DELETE"])
+@query_budget(4)
 @required_roles_api(*["user"])
 def delete_account():
     """Deletes a user's account."""
 
-    # Load the token
-    header = request.headers.get("Authorization")
-    jwt = header.split("Bearer ")[1]
-    token_data = validate_jwt(jwt)
-
     # Delete the user
-    user = (
-        db.session.query(User).filter(User.email == token_data["sub"]).first()
-    )
+    email = g.token_data["sub"]
+    user = get_by_email(email)
+    if user is None:
+        return (
+            jsonify(BaseResp(status="failure", message="No account").dict()),
+            404,
+        )
     db.session.delete(user)
     db.session.commit()
+    cred_cache.invalidate(email)
+    user_cache.invalidate(user.id)
+    revocations.revoke_user(email)
+    revocations.revoke_token(g.token_data)
 
     # Return the results of the account deletion
     return jsonify(
@@ -73,12 +87,54 @@ def delete_account():
 
 
 @api.route("/api/health", methods=["GET"])
+@query_budget(0)
 def health():
     """Health check endpoint that returns a simple JSON payload."""
     return jsonify({"status": "online"})
 
 
+@api.route("/api/metrics", methods=["GET"])
+@query_budget(0)
+def metrics():
+    """Internal metrics of the serving process in the Prometheus format."""
+
+    # Only internal addresses may read metrics, hide it from everyone else
+    if request.remote_addr not in app.config["METRICS_ALLOWED_IPS"]:
+        abort(404)
+
+    return (
+        registry.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@api.route("/api/profiler", methods=["GET", "PUT"])
+@query_budget(0)
+def sql_profiler():
+    """Internal view reading or changing which requests are SQL profiled."""
+
+    # Only internal addresses may change profiling, hide it from everyone
+    if request.remote_addr not in app.config["METRICS_ALLOWED_IPS"]:
+        abort(404)
+
+    if request.method == "PUT":
+        # Validate the request data
+        try:
+            req = ProfilerReq(**(request.get_json(silent=True) or {}))
+        except ValidationError as e:
+            return e.json(), 400
+        try:
+            profiler.configure(req.sample_rate, req.routes)
+        except RedisError as e:
+            resp = BaseResp(status="error", message=str(e))
+            return jsonify(resp.dict()), 503
+
+    return jsonify(profiler.settings)
+
+
 @api.route("/api/message", methods=["POST"])
+@query_budget(1)
 @required_roles_api(*["user"])
 def message():
     """Sends a message to the website owner."""
@@ -89,15 +145,16 @@ def message():
     except ValidationError as e:
         return e.json(), 400
 
-    # Load the token
-    header = request.headers.get("Authorization")
-    jwt = header.split("Bearer ")[1]
-    token_data = validate_jwt(jwt)
-
     # Send the contact message
-    send_contact_email.delay(
-        req.first, req.last, req.message, token_data["sub"], req.category,
+    enqueue(
+        send_contact_email,
+        req.first,
+        req.last,
+        req.message,
+        g.token_data["sub"],
+        req.category,
     )
+    db.session.commit()
 
     # Default return value for failed authentication
     return jsonify(
@@ -106,6 +163,9 @@ def message():
 
 
 @api.route("/api/token", methods=["POST"])
+@query_budget(3)
+@limiter.limit("30/minute")
+@limiter.limit("10/minute", per="account")
 def token():
     """Generates a token to used to access protected APIs."""
 
@@ -4,23 +4,29 @@ from flask import flash, redirect, render_template, url_for
 
 from app.blueprints import base
 from app.forms import ContactForm
+from app.extensions import db
 from app.tasks import send_contact_email
+from app.utils.outbox import enqueue
+from app.utils.profiler import query_budget
 
 
 @base.route("/", methods=["GET", "POST"])
 @base.route("/index", methods=["GET", "POST"])
+@query_budget(2)
 def index():
     """The main landing page for the application."""
     form = ContactForm()
 
     if form.validate_on_submit():
-        send_contact_email.delay(
+        enqueue(
+            send_contact_email,
             form.first.data,
             form.last.data,
             form.message.data,
             form.email.data,
             form.category.data,
         )
+        db.session.commit()
         flash("Message submitted successfully", category="secondary")
         return redirect(url_for("base.index"))
 
@@ -1,20 +1,25 @@
 """Application views that handle general user management."""
 
-from bcrypt import checkpw, gensalt, hashpw
 from flask import current_app as app, flash, redirect, request, render_template
 from flask import url_for
 from flask_login import current_user, login_required, login_user, logout_user
+from sqlalchemy.exc import IntegrityError
 
 from app.blueprints import user
-from app.extensions import db
+from app.extensions import cred_cache, db, hash_pool, limiter, revocations
+from app.extensions import user_cache
 from app.forms import PasswordForm, LoginForm, RecoverForm, RegisterForm
-from app.models.db import Role, User
-from app.utils.auth import authenticate, load_pw_token, serialize_pw_token
-from app.utils.user import change_pw
+from app.models.db import User
+from app.utils.auth import authenticate, load_pw_token
+from app.utils.outbox import enqueue
+from app.utils.profiler import query_budget
+from app.utils.repository import email_exists, get_by_email, get_role
+from app.utils.user import change_pw, set_pw
 from app.tasks import send_new_user_email, send_recovery_email
 
 
 @user.route("/delete", methods=["GET", "POST"])
+@query_budget(5)
 @login_required
 def delete():
     """Allows an authenticated user to delete their account."""
@@ -26,17 +31,16 @@ def delete():
     # If the form is valid, try to delete the user.
     if form.validate_on_submit():
 
-        u = (
-            db.session.query(User)
-            .filter(User.email == current_user.email)
-            .first()
-        )
+        u = get_by_email(current_user.email)
 
         # Delete the user if they provided the proper password.
-        if u and checkpw(form.pw.data.encode("utf-8"), u.pw_hash):
+        if u and hash_pool.checkpw(form.pw.data, u.pw_hash, u.pw_algo):
             logout_user()
             db.session.delete(u)
             db.session.commit()
+            cred_cache.invalidate(u.email)
+            user_cache.invalidate(u.id)
+            revocations.revoke_user(u.email)
             flash(
                 f'Your account, "{u.email}", has been removed',
                 category="secondary",
@@ -51,6 +55,9 @@ def delete():
 
 
 @user.route("/login", methods=["GET", "POST"])
+@query_budget(4)
+@limiter.limit("10/minute")
+@limiter.limit("5/minute", per="account")
 def login():
     """Allows a registered user to log into the application."""
 
@@ -81,6 +88,7 @@ def login():
 
 
 @user.route("/logout", methods=["GET"])
+@query_budget(1)
 @login_required
 def logout():
     """Logs the user out of the application."""
@@ -91,6 +99,9 @@ def logout():
 
 
 @user.route("/recover", methods=["GET", "POST"])
+@query_budget(3)
+@limiter.limit("5/minute")
+@limiter.limit("3/hour", per="account")
 def recover():
     """Allows the user to recover a forgotten account password."""
 
@@ -101,16 +112,9 @@ def recover():
     # If the form is valid, send the user an email to recover their password
     if form.validate_on_submit():
 
-        u = (
-            db.session.query(User)
-            .filter(User.email == form.email.data.lower())
-            .first()
-        )
-
-        if u:
-            send_recovery_email.delay(
-                form.email.data, serialize_pw_token(form.email.data)
-            )
+        if email_exists(form.email.data.lower()):
+            enqueue(send_recovery_email, form.email.data)
+            db.session.commit()
             flash(
                 "Account recovery email sent successfully",
                 category="secondary",
@@ -133,6 +137,8 @@ def recover():
 
 
 @user.route("/register", methods=["GET", "POST"])
+@query_budget(6)
+@limiter.limit("5/minute")
 def register():
     """Allows the user to register a new account."""
 
@@ -143,15 +149,9 @@ def register():
     # If the form is valid, try to register the user.
     if form.validate_on_submit():
 
-        # Query for the new user by their email.
-        new_user = (
-            db.session.query(User)
-            .filter(User.email == form.email.data.lower())
-            .first()
-        )
-
-        # Add the user if they don't already exist.
-        if new_user:
+        # Add the user if they don't already exist, asking the database as
+        # the filter can lag users registered on other hosts.
+        if email_exists(form.email.data.lower(), use_filter=False):
             flash(
                 f'"{form.email.data}" account already exists',
                 category="danger",
@@ -163,14 +163,21 @@ def register():
             return redirect(url_for("user.login"))
         else:
             # noinspection PyArgumentList
-            new_user = User(
-                email=form.email.data.lower(),
-                pw_hash=hashpw(form.pw.data.encode("utf-8"), gensalt()),
-            )
-            new_user.roles.append(Role.query.filter_by(name="user").first())
+            new_user = User(email=form.email.data.lower())
+            set_pw(new_user, form.pw.data)
+            new_user.roles.append(get_role("user"))
             db.session.add(new_user)
-            db.session.commit()
-            send_new_user_email.delay(form.email.data)
+            enqueue(send_new_user_email, form.email.data)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another request registered the email since the check
+                db.session.rollback()
+                flash(
+                    f'"{form.email.data}" account already exists',
+                    category="danger",
+                )
+                return redirect(url_for("user.login"))
             app.logger.info(
                 f'Successful account registration : {form.email.data} from "'
                 f'"{request.environ["REMOTE_ADDR"]}'
@@ -182,6 +189,7 @@ def register():
 
 
 @user.route("/reset", methods=["GET", "POST"])
+@query_budget(4)
 def reset():
     """Allows the user to reset their password.
 
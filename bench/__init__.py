@@ -0,0 +1,6 @@
+"""Microbenchmarks for performance sensitive code paths.
+
+Each module can be run on its own, for example::
+
+    $ python -m bench.tokens
+"""
@@ -0,0 +1,137 @@
+"""Benchmark role lookups before and after keying role_user_map.
+
+Builds the user and role tables with one role assignment per user, every
+hundredth user also being an admin, and two copies of role_user_map. The
+"before" copy has no keys or indexes, as created by the first migration,
+and the "after" copy has the composite primary key and reverse index. It
+then reports milliseconds per lookup of a user's roles and of a page of a
+role's users on each copy.
+
+A SQLite file is used by default. Pass a database URL to benchmark
+MariaDB, whose tables are dropped and recreated.
+
+Example Usage::
+
+    $ python -m bench.roles
+    $ python -m bench.roles --users 100000 --number 200
+    $ python -m bench.roles --url mysql+pymysql://user:pw@localhost/bench
+"""
+
+from argparse import ArgumentParser
+from os import remove
+from random import randrange
+from tempfile import mkstemp
+from timeit import timeit
+
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, String
+from sqlalchemy import Table, create_engine, select
+
+metadata = MetaData()
+
+role = Table(
+    "role",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(128), unique=True, nullable=False),
+)
+
+user = Table(
+    "user",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("email", String(256), unique=True, nullable=False),
+)
+
+before = Table(
+    "role_user_map_before",
+    metadata,
+    Column("user_id", Integer, ForeignKey("user.id")),
+    Column("role_id", Integer, ForeignKey("role.id")),
+)
+
+after = Table(
+    "role_user_map_after",
+    metadata,
+    Column(
+        "user_id",
+        Integer,
+        ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "role_id",
+        Integer,
+        ForeignKey("role.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Index("ix_role_user_map_after_role_id_user_id", "role_id", "user_id"),
+)
+
+
+def populate(engine, users: int, batch_size: int = 50000):
+    """Create the tables and fill them with users and their roles."""
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(role.insert(), [{"name": "user"}, {"name": "admin"}])
+
+    for start in range(1, users + 1, batch_size):
+        ids = range(start, min(start + batch_size, users + 1))
+        rows = [{"user_id": i, "role_id": 1} for i in ids]
+        rows += [{"user_id": i, "role_id": 2} for i in ids if i % 100 == 0]
+        with engine.begin() as conn:
+            conn.execute(
+                user.insert(), [{"id": i, "email": f"{i}@bench"} for i in ids]
+            )
+            conn.execute(before.insert(), rows)
+            conn.execute(after.insert(), rows)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--url", help="Database URL, SQLite by default.")
+    args = parser.parse_args()
+
+    path = None
+    if not args.url:
+        _, path = mkstemp(suffix=".db")
+    engine = create_engine(args.url or f"sqlite:///{path}")
+
+    try:
+        populate(engine, args.users)
+        print(f"{'lookup':<12} {'before ms':>10} {'after ms':>10}")
+        for name, query in [
+            (
+                "user roles",
+                lambda m: select([role.c.name])
+                .select_from(role.join(m, m.c.role_id == role.c.id))
+                .where(m.c.user_id == randrange(1, args.users + 1)),
+            ),
+            (
+                "role users",
+                lambda m: select([m.c.user_id])
+                .where(m.c.role_id == 2)
+                .order_by(m.c.user_id)
+                .limit(50),
+            ),
+        ]:
+            times = []
+            with engine.connect() as conn:
+                for table in (before, after):
+                    seconds = timeit(
+                        lambda: conn.execute(query(table)).fetchall(),
+                        number=args.number,
+                    )
+                    times.append(seconds / args.number * 1000)
+            print(f"{name:<12} {times[0]:>10.2f} {times[1]:>10.2f}")
+    finally:
+        metadata.drop_all(engine)
+        engine.dispose()
+        if path:
+            remove(path)
+
+
+if __name__ == "__main__":
+    main()
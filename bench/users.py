@@ -0,0 +1,91 @@
+"""Benchmark the user lookups built per call against the baked ones.
+
+Reports microseconds per call for each lookup in app.utils.repository and
+for the equivalent query built and compiled on every call, as the views
+used to. An in-memory SQLite database is used, so the time is almost all
+Python overhead. The app's configuration is loaded, so the environment
+variables read by config.py must be set.
+
+Example Usage::
+
+    $ python -m bench.users
+    $ python -m bench.users --number 20000
+"""
+
+from argparse import ArgumentParser
+from timeit import timeit
+
+from sqlalchemy.orm import joinedload
+
+from app.create import create_app
+from app.extensions import db
+from app.models.db import Role, User
+from app.utils.repository import email_exists, get_by_email, get_with_roles
+from app.utils.user import set_pw
+
+EMAIL = "user@example.com"
+
+
+def setup():
+    """Create an app with an in-memory database holding one user."""
+    app = create_app("Test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["DB_POOL_METRICS"] = False
+    app.app_context().push()
+
+    db.create_all()
+    # noinspection PyArgumentList
+    user = User(email=EMAIL, roles=[Role(name="user")])
+    set_pw(user, "password")
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=10000)
+    args = parser.parse_args()
+    user_id = setup()
+
+    lookups = [
+        (
+            "by email",
+            lambda: db.session.query(User)
+            .filter(User.email == EMAIL)
+            .first(),
+            lambda: get_by_email(EMAIL),
+        ),
+        (
+            "with roles",
+            lambda: User.query.options(joinedload(User.roles))
+            .filter(User.id == user_id)
+            .first(),
+            lambda: get_with_roles(user_id),
+        ),
+        (
+            "exists",
+            lambda: db.session.query(User.id)
+            .filter(User.email == EMAIL)
+            .first()
+            is not None,
+            lambda: email_exists(EMAIL),
+        ),
+    ]
+
+    print(f"{'lookup':<12} {'built us':>10} {'baked us':>10} {'speedup':>8}")
+    for name, built, baked in lookups:
+        times = []
+        for f in (built, baked):
+            f()
+            times.append(timeit(f, number=args.number) / args.number * 1e6)
+            db.session.remove()
+        built_us, baked_us = times
+        print(
+            f"{name:<12} {built_us:>10.1f} {baked_us:>10.1f} "
+            f"{built_us / baked_us:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
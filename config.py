@@ -6,25 +6,48 @@ see run.py.
 """
 
 import logging
-from typing import Dict
-
 from base64 import b64decode
 from os import environ
 from os.path import abspath, dirname, join
-from typing import List
+from typing import Dict, List
 
 
 class Prod:
     """Production (default) configuration parameters."""
 
-    # Authentication parameters
+    # Authentication parameters. A non zero AUTH_CACHE_TTL_SEC skips
+    # hashing for repeated logins until it passes or the password changes.
     AUTH_FAILS = 10
+    AUTH_FAIL_WINDOW_SEC: int = 86400
+    AUTH_CACHE_SIZE: int = 4096
+    AUTH_CACHE_TTL_SEC: int = 0
+
+    # Logged in user cache parameters. Role changes made by another process
+    # are seen within USER_CACHE_TTL_SEC.
+    USER_CACHE_SIZE: int = 4096
+    USER_CACHE_TTL_SEC: int = 60
+
+    # Backfill parameters. A zero BACKFILL_TIME_BUDGET_SEC runs backfills
+    # until they finish.
+    BACKFILL_BATCH_SIZE: int = 1000
+    BACKFILL_SLEEP_SEC: float = 0.05
+    BACKFILL_TIME_BUDGET_SEC: float = 0
 
     # Celery parameters
     CELERY_BROKER_URL: str = "redis://redis:6379"
     CELERY_RESULT_BACKEND: str = "redis://redis:6379"
     CELERY_INCLUDE: List[str] = ["app.tasks"]
 
+    # Broker circuit breaker parameters. After BROKER_BREAKER_FAILURES
+    # failed publishes in a row tasks are left in the outbox without trying
+    # the broker, which is probed again every BROKER_BREAKER_RESET_SEC.
+    # Publishes time out after BROKER_PUBLISH_TIMEOUT_SEC, and those slower
+    # than BROKER_SLOW_PUBLISH_SEC also count as failures.
+    BROKER_BREAKER_FAILURES: int = 3
+    BROKER_BREAKER_RESET_SEC: float = 15
+    BROKER_PUBLISH_TIMEOUT_SEC: float = 2
+    BROKER_SLOW_PUBLISH_SEC: float = 0.5
+
     # Email parameters
     MAIL_SERVER: str = "smtp.gmail.com"
     MAIL_PORT: int = 587
@@ -32,6 +55,22 @@ class Prod:
     MAIL_USERNAME: str = b64decode(environ.get("MAIL_USER")).decode("utf-8")
     MAIL_PASSWORD: str = b64decode(environ.get("MAIL_AUTH")).decode("utf-8")
     MAIL_TO: str = b64decode(environ.get("MAIL_TO")).decode("utf-8")
+    MAIL_TIMEOUT_SEC: float = 30
+
+    # Email delivery parameters, per worker process. With MAIL_ASYNC set
+    # tasks return once their messages are queued, and up to
+    # MAIL_CONCURRENCY are sent at once. Keep MAIL_POOL_SIZE at least
+    # MAIL_CONCURRENCY, and connections idle for MAIL_POOL_NOOP_SEC are
+    # checked before they are reused.
+    MAIL_ASYNC: bool = True
+    MAIL_CONCURRENCY: int = 10
+    MAIL_DOMAIN_CONCURRENCY: int = 5
+    MAIL_MAX_IN_FLIGHT: int = 500
+    MAIL_RETRIES: int = 3
+    MAIL_RETRY_BACKOFF_SEC: float = 2
+    MAIL_POOL_SIZE: int = 10
+    MAIL_POOL_MAX_MESSAGES: int = 100
+    MAIL_POOL_NOOP_SEC: float = 30
 
     # Flask debugging
     DEBUG: bool = False
@@ -48,6 +87,38 @@ class Prod:
     log_format_p2 = "(%(funcName)s@%(pathname)s:%(lineno)d) [PID:%(process)d]"
     LOG_FORMAT = log_format_p1 + log_format_p2
 
+    # Password hashing parameters. A PW_HASH_WORKERS of None splits the
+    # cores between the PW_HASH_PROCESSES serving processes on a host - see
+    # run.sh - but never exceeds PW_HASH_MAX_PENDING, as no more can run.
+    # A PW_HASH_COST of None is tuned to PW_HASH_BUDGET_MS at startup, but
+    # never below PW_HASH_MIN_COST or by default the algorithm's default
+    PW_HASH_ALGO: str = "bcrypt"
+    PW_HASH_COST: int = None
+    PW_HASH_MIN_COST: int = None
+    PW_HASH_BUDGET_MS: float = 250
+    PW_HASH_WORKERS: int = None
+    PW_HASH_PROCESSES: int = 4
+    PW_HASH_MAX_PENDING: int = 2
+    PW_HASH_TIMEOUT_SEC: float = 5
+    PW_HASH_RETRY_AFTER_SEC: int = 2
+
+    # Metrics parameters, the addresses allowed to read /api/metrics
+    METRICS_ALLOWED_IPS: List[str] = ["127.0.0.1"]
+
+    # Outbox parameters. The dispatcher publishes up to OUTBOX_BATCH_SIZE
+    # tasks per broker message and checks an empty outbox every
+    # OUTBOX_POLL_SEC. With OUTBOX_DISPATCH_AFTER_RESPONSE a request
+    # publishes its own tasks once its response has been sent.
+    OUTBOX_BATCH_SIZE: int = 100
+    OUTBOX_POLL_SEC: float = 1
+    OUTBOX_DISPATCH_AFTER_RESPONSE: bool = True
+
+    # Query budget parameters, raise rather than warn for exceeded budgets
+    QUERY_BUDGET_STRICT: bool = False
+
+    # Rate limiting parameters
+    RATELIMIT_ENABLED: bool = True
+
     # Recaptcha parameters
     RECAPTCHA_PUBLIC_KEY: str = b64decode(environ.get("RECAP_PUBLIC")).decode(
         "utf-8"
@@ -77,8 +148,54 @@ class Prod:
     SQLALCHEMY_MAX_OVERFLOW: int = 2
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
 
-    # Token parameters
+    # Connection pool parameters. DB_POOL_PREWARM connections are opened
+    # per engine after each uWSGI worker forks.
+    DB_POOL_METRICS: bool = True
+    DB_POOL_PREWARM: int = 2
+
+    # SQL profiling parameters. A fraction SQL_PROFILE_RATE of requests and
+    # every request to SQL_PROFILE_ROUTES log their queries, and SELECTs
+    # slower than SQL_SLOW_MS are logged with their EXPLAIN output. Changes
+    # made through /api/profiler reach every process within
+    # SQL_PROFILE_SYNC_SEC.
+    SQL_PROFILE_RATE: float = 0.0
+    SQL_PROFILE_ROUTES: List[str] = []
+    SQL_PROFILE_SYNC_SEC: float = 1
+    SQL_PROFILE_TOP: int = 3
+    SQL_SLOW_MS: float = 200
+
+    # Read replica parameters. Replicas are binds in SQLALCHEMY_BINDS named
+    # by DB_REPLICA_BINDS, and clients that commit read from the primary
+    # for DB_REPLICA_STICKY_SEC.
+    SQLALCHEMY_BINDS: Dict[str, str] = {}
+    DB_REPLICA_BINDS: List[str] = []
+    DB_REPLICA_STICKY_SEC: int = 5
+
+    # Registered email filter parameters. The filter is shared by the
+    # workers on a host through the file at EMAIL_FILTER_PATH, and picks up
+    # users added elsewhere within EMAIL_FILTER_SYNC_SEC. Each sync rescans
+    # the last EMAIL_FILTER_RESCAN_IDS IDs for users committed out of order.
+    # Misses are only trusted for EMAIL_FILTER_MAX_AGE_SEC after a sync.
+    EMAIL_FILTER_ENABLED: bool = True
+    EMAIL_FILTER_CAPACITY: int = 1000000
+    EMAIL_FILTER_ERROR_RATE: float = 0.01
+    EMAIL_FILTER_PATH: str = "/dev/shm/registered_emails.bloom"
+    EMAIL_FILTER_SYNC_SEC: float = 2
+    EMAIL_FILTER_MAX_AGE_SEC: float = 5
+    EMAIL_FILTER_RESCAN_IDS: int = 1000
+
+    # Shared state parameters, either "memory://" or a Redis URL. Redis
+    # calls taking over STORE_TIMEOUT_SEC fail into the in-memory fallbacks.
+    STORE_URL: str = "redis://redis:6379/1"
+    STORE_TIMEOUT_SEC: float = 0.25
+
+    # Token parameters. JWT_FORMAT is "compact" or "legacy", and legacy
+    # tokens are still accepted while JWT_ACCEPT_LEGACY is set.
+    JWT_ACCEPT_LEGACY: bool = True
     JWT_EXP_SEC = 600
+    JWT_FORMAT: str = "compact"
+    REVOKE_BLOOM_CAPACITY: int = 100000
+    REVOKE_REFRESH_SEC: float = 2
     PW_TOKEN_EXP_SEC = 3600
 
 
@@ -104,9 +221,24 @@ class Dev(Prod):
     # General parameters
     DOMAIN = "localhost:5000"
 
+    # Registered email filter parameters
+    EMAIL_FILTER_PATH: str = ""
+
     # Logging parameters
     LOG_LEVEL = logging.DEBUG
 
+    # Password hashing parameters
+    PW_HASH_WORKERS: int = 0
+
+    # Query budget parameters
+    QUERY_BUDGET_STRICT: bool = True
+
+    # Shared state parameters
+    STORE_URL: str = "memory://"
+
+    # SQL profiling parameters
+    SQL_PROFILE_RATE: float = 1.0
+
     # SQLAlchemy parameters
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
     SQLALCHEMY_DATABASE_URI: str = f"sqlite:///{BASE_DIR}/dev_db.db"
@@ -138,16 +270,33 @@ class Test(Prod):
     # Flask debugging
     DEBUG: bool = True
 
+    # Password hashing parameters
+    PW_HASH_COST: int = 4
+    PW_HASH_WORKERS: int = 1
+
     # Mail parameters
     TESTING = True
+    MAIL_ASYNC: bool = False
     MAIL_USERNAME = "test"
     MAIL_TO = "test@test.com"
 
+    # Query budget parameters
+    QUERY_BUDGET_STRICT: bool = True
+
+    # Rate limiting parameters
+    RATELIMIT_ENABLED: bool = False
+
+    # Registered email filter parameters
+    EMAIL_FILTER_PATH: str = ""
+
     # Recaptcha parameters
     # Test keys: https://developers.google.com/recaptcha/docs/faq
     RECAPTCHA_PUBLIC_KEY: str = "6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI"
     RECAPTCHA_PRIVATE_KEY: str = "6LeIxAcTAAAAAGG-vFI1TnRWxMZNFuojJ4WifJWe"
 
+    # Shared state parameters
+    STORE_URL: str = "memory://"
+
     # SQLAlchemy parameters
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
     SQLALCHEMY_DATABASE_URI: str = f"sqlite:///{BASE_DIR}/test_db.db"
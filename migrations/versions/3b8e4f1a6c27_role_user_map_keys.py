@@ -0,0 +1,107 @@
+"""role user map keys
+
+Revision ID: 3b8e4f1a6c27
+Revises: 7c2f5a9e1d34
+Create Date: 2026-10-17 14:05:18.902311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3b8e4f1a6c27"
+down_revision = "7c2f5a9e1d34"
+branch_labels = None
+depends_on = None
+
+
+#: Copies the distinct, valid assignments from one table into another
+COPY = (
+    "INSERT {ignore}INTO {target} (user_id, role_id) "
+    "SELECT DISTINCT m.user_id, m.role_id FROM {source} m "
+    "JOIN user u ON u.id = m.user_id "
+    "JOIN role r ON r.id = m.role_id"
+)
+
+
+def swap(new: str, catch_up: bool):
+    """Replace role_user_map with a table copied from it.
+
+    MariaDB commits each DDL statement, so the tables are swapped with one
+    atomic RENAME TABLE and role_user_map never goes missing. Elsewhere DDL
+    runs within the migration's transaction.
+
+    Args:
+        new: The name of the table replacing role_user_map.
+        catch_up: Copy the assignments written to the old table while it
+            was being copied, for a new table with a primary key.
+    """
+    if op.get_bind().dialect.name != "mysql":
+        op.drop_table("role_user_map")
+        op.rename_table(new, "role_user_map")
+        return
+
+    op.execute(
+        f"RENAME TABLE role_user_map TO role_user_map_swapped, "
+        f"{new} TO role_user_map"
+    )
+    if catch_up:
+        op.execute(
+            COPY.format(
+                ignore="IGNORE ",
+                target="role_user_map",
+                source="role_user_map_swapped",
+            )
+        )
+    op.drop_table("role_user_map_swapped")
+
+
+def upgrade():
+    # The keyed table is filled from the old one and then swapped in, so
+    # rows with a null or dangling ID and duplicate assignments are
+    # dropped without ever failing part way through on existing data.
+    op.create_table(
+        "role_user_map_new",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("role_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["role_id"],
+            ["role.id"],
+            name="fk_role_user_map_role_id",
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["user.id"],
+            name="fk_role_user_map_user_id",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("user_id", "role_id"),
+    )
+    op.execute(
+        COPY.format(
+            ignore="", target="role_user_map_new", source="role_user_map"
+        )
+    )
+    swap("role_user_map_new", catch_up=True)
+    op.create_index(
+        "ix_role_user_map_role_id_user_id",
+        "role_user_map",
+        ["role_id", "user_id"],
+    )
+
+
+def downgrade():
+    op.create_table(
+        "role_user_map_old",
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("role_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["role_id"], ["role.id"],),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"],),
+    )
+    op.execute(
+        "INSERT INTO role_user_map_old (user_id, role_id) "
+        "SELECT user_id, role_id FROM role_user_map"
+    )
+    swap("role_user_map_old", catch_up=False)
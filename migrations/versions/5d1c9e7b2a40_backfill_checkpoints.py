@@ -0,0 +1,39 @@
+"""backfill checkpoints
+
+Revision ID: 5d1c9e7b2a40
+Revises: 3b8e4f1a6c27
+Create Date: 2026-10-17 16:22:47.118530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.utils.backfill import schedule, unschedule
+
+
+# revision identifiers, used by Alembic.
+revision = "5d1c9e7b2a40"
+down_revision = "3b8e4f1a6c27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "backfill_checkpoint",
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("last_key", sa.Integer(), nullable=False),
+        sa.Column("rows", sa.Integer(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=True),
+        sa.Column("finished", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+    # Read the cost of the hashes stored before 7c2f5a9e1d34 in the
+    # background rather than rehashing every one of them on login
+    schedule(op, "pw_cost")
+
+
+def downgrade():
+    unschedule(op, "pw_cost")
+    op.drop_table("backfill_checkpoint")
@@ -0,0 +1,37 @@
+"""password hasher
+
+Revision ID: 7c2f5a9e1d34
+Revises: 409ed4dbeb05
+Create Date: 2026-10-17 09:12:40.381022
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7c2f5a9e1d34"
+down_revision = "409ed4dbeb05"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing hashes are bcrypt with an unknown cost. A null cost makes
+    # each one get rehashed at the configured cost on its next login.
+    with op.batch_alter_table("user") as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                "pw_algo",
+                sa.String(length=16),
+                server_default="bcrypt",
+                nullable=False,
+            )
+        )
+        batch_op.add_column(sa.Column("pw_cost", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("user") as batch_op:
+        batch_op.drop_column("pw_cost")
+        batch_op.drop_column("pw_algo")
@@ -0,0 +1,31 @@
+"""outbox
+
+Revision ID: 8e3a7c1f5b92
+Revises: 5d1c9e7b2a40
+Create Date: 2026-10-17 18:41:09.527316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8e3a7c1f5b92"
+down_revision = "5d1c9e7b2a40"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("task", sa.String(length=128), nullable=False),
+        sa.Column("args", sa.Text(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("outbox")
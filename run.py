@@ -13,10 +13,36 @@ Example Usage::
 from os import environ
 
 from app.create import create_app
-from app.extensions import make_celery
+from app.extensions import db, hash_pool, make_celery, registered_emails
+from app.utils.pool import prewarm_pools
 
 app = create_app(config=environ.get("FLASK_APP_ENV", None))
 celery = make_celery(app)
 
+# uwsgidecorators can only be imported when running under uWSGI
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+if postfork:
+
+    @postfork
+    def prewarm():
+        """Open pooled connections in each worker before it serves.
+
+        Connections inherited from the master share its sockets, so they
+        are dropped before the worker opens its own. The hashing workers
+        are forked here, before uWSGI starts the worker's threads.
+        """
+        hash_pool.start()
+        with app.app_context():
+            for engine in db.engines:
+                engine.dispose()
+            if registered_emails.enabled:
+                registered_emails.sync()
+            prewarm_pools(app, db.engines)
+
+
 if __name__ == "__main__":
     app.run()
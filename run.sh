@@ -1,3 +1,5 @@
 #!/bin/sh
 flask db upgrade
-uwsgi --http :5000 --manage-script-name --mount /=run:app --master --processes 4 --threads 2
+flask backfill run &
+flask outbox run &
+uwsgi --http :5000 --manage-script-name --mount /=run:app --master --processes 4 --threads 4
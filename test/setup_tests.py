@@ -1,12 +1,15 @@
 """Shared utilities for unit test cases."""
 
+from contextlib import contextmanager
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Thread
+from typing import List
 from unittest import TestCase
 
-from bcrypt import hashpw, gensalt
-
 from app.create import create_app
 from app.extensions import db
 from app.models.db import Role, User
+from app.utils.user import set_pw
 
 # Global testing parameters
 USR = "usr@usr.com"
@@ -29,27 +32,48 @@ class SetupTest(TestCase):
             db.session.add(usr_role)
             db.session.add(adm_role)
             # noinspection PyArgumentList
-            db.session.add(
-                User(
-                    email=USR,
-                    pw_hash=hashpw("password".encode("utf-8"), gensalt()),
-                    roles=[usr_role],
-                )
-            )
+            usr = User(email=USR, roles=[usr_role])
+            set_pw(usr, "password")
+            db.session.add(usr)
             # noinspection PyArgumentList
-            db.session.add(
-                User(
-                    email=ADM,
-                    pw_hash=hashpw("password".encode("utf-8"), gensalt()),
-                    roles=[adm_role, usr_role],
-                )
-            )
+            adm = User(email=ADM, roles=[adm_role, usr_role])
+            set_pw(adm, "password")
+            db.session.add(adm)
             db.session.commit()
 
     def tearDown(self):
         with self.app.app_context():
             db.drop_all()
 
+    @contextmanager
+    def assert_max_queries(self, limit: int):
+        """Fail if the code within the context runs more than limit queries.
+
+        Args:
+            limit: The most SQL statements allowed.
+        """
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        assert len(statements) <= limit, "\n".join(statements)
+
+    def assert_query_budgets(self, *blueprints: str):
+        """Fail if any view of the blueprints has no query budget.
+
+        Args:
+            *blueprints: The names of the blueprints to check.
+        """
+        for endpoint, view in self.app.view_functions.items():
+            if endpoint.split(".")[0] in blueprints:
+                assert hasattr(view, "query_budget"), endpoint
+
 
 def force_anon_user(app):
     """EditFlask-Login's request loader to force an anonymous user."""
@@ -67,3 +91,65 @@ def force_auth_user(app, admin=False):
     @app.login_manager.request_loader
     def load_user_from_request(_request):
         return user
+
+
+class FakeSMTPServer(ThreadingTCPServer):
+    """A local SMTP server that accepts and records every message.
+
+    Attributes:
+        connections: The number of connections accepted.
+        messages: The data of each message received.
+        commands: Every command received, in order.
+        drop_after: Close each connection after this many messages.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.connections = 0
+        self.messages: List[bytes] = []
+        self.commands: List[str] = []
+        self.drop_after = None
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib to send a message."""
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        sent = 0
+        self.reply("220 localhost fake SMTP")
+        for line in self.rfile:
+            command = line.decode("ascii").strip().upper()
+            server.commands.append(command.split(" ")[0])
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                server.messages.append(data)
+                sent += 1
+                self.reply("250 OK queued")
+                if server.drop_after and sent >= server.drop_after:
+                    return
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
@@ -11,6 +11,14 @@ from test.setup_tests import SetupTest, USR
 HEALTH = {"status": "online"}
 
 
+class TestQueryBudgets(SetupTest):
+    """Tests the query budgets of the APIs in app.views.api.py"""
+
+    def test_budgets(self):
+        """Ensure every API declares a query budget."""
+        self.assert_query_budgets("api")
+
+
 class TestChangePassword(SetupTest):
     """Tests the change password API in app.views.api.py"""
 
@@ -95,6 +103,17 @@ class TestDeleteAccount(SetupTest):
         assert resp.status_code == 200
         assert data["status"] == "success"
 
+    def test_delete_account_missing(self):
+        """Ensure deleting an account that no longer exists fails cleanly."""
+        token = generate_jwt("gone@example.com", ["user"])
+        resp = self.client.delete(
+            url_for("api.delete_account"),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        data = json.loads(resp.get_data())
+        assert resp.status_code == 404
+        assert data["status"] == "failure"
+
 
 class TestHealth(SetupTest):
     """Tests the health API in app.views.api.py"""
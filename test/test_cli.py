@@ -0,0 +1,214 @@
+"""Unit testing for the Flask CLI commands."""
+
+import json
+from os import remove
+from tempfile import mkstemp
+
+import bcrypt
+
+from app.extensions import db, deferred, hash_pool, mail
+from app.models.db import Outbox, User
+from app.utils.auth import authenticate
+from app.utils.backfill import backfills, checkpoints, pending, run_batch
+from app.utils.backfill import run_backfills
+from app.utils.outbox import dispatch_batch, dispatched
+from test.setup_tests import SetupTest, USR
+
+
+class TestUsersCli(SetupTest):
+    """Tests the user commands in app.cli.py"""
+
+    def setUp(self):
+        super().setUp()
+        self.runner = self.app.test_cli_runner()
+        _, self.path = mkstemp(suffix=".csv")
+
+    def tearDown(self):
+        super().tearDown()
+        remove(self.path)
+
+    def test_import(self):
+        """Ensure users are imported in batches with their roles."""
+        with open(self.path, "w") as f:
+            f.write("email,password,roles\n")
+            f.write(f"{USR},password,\n")
+            for i in range(5):
+                f.write(f"new{i}@usr.com,password{i},user;admin\n")
+            f.write("new0@usr.com,password,\n")
+
+        result = self.runner.invoke(
+            args=["users", "import", self.path, "--batch-size", "2"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Imported 5 of 7 users" in result.output
+
+        user = User.query.filter(User.email == "new3@usr.com").first()
+        assert sorted(user.get_roles()) == ["admin", "user"]
+        assert user.pw_algo == hash_pool.algo
+        assert authenticate("new3@usr.com", "password3").success
+
+    def test_normalized_email(self):
+        """Ensure imported emails are lower cased before deduplication."""
+        with open(self.path, "w") as f:
+            f.write("email,password,roles\n")
+            f.write(" Alice@Example.com,password,\n")
+            f.write("alice@example.com,password,\n")
+            f.write(f"{USR.upper()},password,\n")
+
+        result = self.runner.invoke(args=["users", "import", self.path])
+        assert result.exit_code == 0, result.output
+        assert "Imported 1 of 3 users" in result.output
+        assert authenticate("alice@example.com", "password").success
+
+    def test_unknown_algo(self):
+        """Ensure an import with an unknown hash algorithm is rejected."""
+        with open(self.path, "w") as f:
+            record = {"email": "new@usr.com", "pw_hash": "x", "pw_algo": "md5"}
+            f.write(json.dumps(record) + "\n")
+
+        result = self.runner.invoke(
+            args=["users", "import", self.path, "--format", "jsonl"]
+        )
+        assert result.exit_code != 0
+        assert 'Unknown pw_algo "md5"' in result.output
+        assert User.query.filter(User.email == "new@usr.com").first() is None
+
+    def test_no_password(self):
+        """Ensure an import with a record lacking a password is rejected."""
+        with open(self.path, "w") as f:
+            f.write("email,password,roles\n")
+            f.write("new@usr.com,,user\n")
+
+        result = self.runner.invoke(args=["users", "import", self.path])
+        assert result.exit_code != 0
+        assert 'No password for "new@usr.com"' in result.output
+
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"email": "new@usr.com"}) + "\n")
+
+        result = self.runner.invoke(
+            args=["users", "import", self.path, "--format", "jsonl"]
+        )
+        assert result.exit_code != 0
+        assert 'No password for "new@usr.com"' in result.output
+        assert User.query.filter(User.email == "new@usr.com").first() is None
+
+    def test_unknown_role(self):
+        """Ensure an import with an unknown role is rejected."""
+        with open(self.path, "w") as f:
+            f.write("email,password,roles\n")
+            f.write("new@usr.com,password,owner\n")
+
+        result = self.runner.invoke(args=["users", "import", self.path])
+        assert result.exit_code != 0
+        assert 'Unknown role "owner"' in result.output
+        assert User.query.filter(User.email == "new@usr.com").first() is None
+
+    def test_round_trip(self):
+        """Ensure exported users with hashes can be imported again."""
+        result = self.runner.invoke(
+            args=["users", "export", "-", "--format", "jsonl", "--hashes"]
+        )
+        assert result.exit_code == 0, result.output
+        records = [json.loads(line) for line in result.output.splitlines()]
+        assert len(records) == 2
+        assert records[0]["email"] == USR
+        assert sorted(records[1]["roles"]) == ["admin", "user"]
+
+        records[0]["email"] = "copy@usr.com"
+        with open(self.path, "w") as f:
+            f.write(json.dumps(records[0]) + "\n")
+        result = self.runner.invoke(
+            args=["users", "import", self.path, "--format", "jsonl"]
+        )
+        assert result.exit_code == 0, result.output
+        assert authenticate("copy@usr.com", "password").success
+
+
+class TestBackfillCli(SetupTest):
+    """Tests the backfill commands in app.cli.py"""
+
+    def setUp(self):
+        super().setUp()
+        self.runner = self.app.test_cli_runner()
+        db.session.execute(
+            User.__table__.update().values(
+                pw_hash=bcrypt.hashpw(b"password", bcrypt.gensalt(5)),
+                pw_algo="bcrypt",
+                pw_cost=None,
+            )
+        )
+        db.session.execute(
+            checkpoints.insert().values(name="pw_cost", last_key=0, rows=0)
+        )
+        db.session.commit()
+
+    def test_run(self):
+        """Ensure a backfill processes every row and then finishes."""
+        result = self.runner.invoke(
+            args=["backfill", "run", "--batch-size", "1", "--sleep", "0"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "pw_cost : 2 rows" in result.output
+        assert {u.pw_cost for u in User.query} == {5}
+
+        result = self.runner.invoke(args=["backfill", "status"])
+        assert "pw_cost : 2 rows, finished" in result.output
+        assert pending() == []
+
+    def test_resume(self):
+        """Ensure a paused backfill resumes from its checkpoint."""
+        assert run_batch(backfills["pw_cost"], 1) == 1
+        result = self.runner.invoke(args=["backfill", "status"])
+        assert "pw_cost : 1 rows, at key 1" in result.output
+
+        assert run_backfills(sleep_sec=0) == {"pw_cost": 1}
+        assert run_backfills() == {}
+        assert {u.pw_cost for u in User.query} == {5}
+
+
+class TestOutboxCli(SetupTest):
+    """Tests the outbox commands in app.cli.py"""
+
+    def setUp(self):
+        super().setUp()
+        self.runner = self.app.test_cli_runner()
+        deferred.enabled = False
+
+    def test_run(self):
+        """Ensure the outbox is published in batches and emptied."""
+        for i in range(3):
+            data = {
+                "email": f"{i}@usr.com",
+                "pw": "testing123",
+                "confirm": "testing123",
+            }
+            self.client.post("/register", data=data)
+        assert Outbox.query.count() == 3
+
+        result = self.runner.invoke(args=["outbox", "status"])
+        assert "3 tasks pending" in result.output
+
+        with mail.record_messages() as outbox:
+            result = self.runner.invoke(
+                args=["outbox", "run", "--once", "--batch-size", "2"]
+            )
+        assert result.exit_code == 0, result.output
+        assert "Published 3 tasks" in result.output
+        assert len(outbox) == 6
+        assert Outbox.query.count() == 0
+
+    def test_failed_task(self):
+        """Ensure a failing task is removed without stopping its batch."""
+        db.session.add(Outbox(task="app.tasks.missing", args="[]"))
+        db.session.add(
+            Outbox(task="app.tasks.send_new_user_email", args=f'["{USR}"]')
+        )
+        db.session.commit()
+
+        before = dispatched.value()
+        with mail.record_messages() as outbox:
+            assert dispatch_batch(10) == 2
+        assert dispatched.value() == before + 2
+        assert len(outbox) == 2
+        assert dispatch_batch(10) == 0
@@ -0,0 +1,988 @@
+"""Unit testing for application utilities."""
+
+import json
+import logging
+from concurrent.futures import wait
+from os import remove
+from smtplib import SMTPResponseException, SMTPServerDisconnected
+from tempfile import mkstemp
+from threading import Lock
+from time import sleep
+
+from flask import session, url_for
+from flask_mail import Message
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+
+from app.extensions import cred_cache, db, hash_pool, login_failures
+from app.extensions import profiler, registered_emails, revocations
+from app.extensions import broker_breaker, deferred, delivery, mail
+from app.extensions import smtp_pool, user_cache
+from app.models.db import Outbox, Role, User, role_user_map
+from app.utils.auth import authenticate, generate_jwt, jwt_cache
+from app.utils.auth import validate_jwt
+from app.utils.bloom import BloomFilter
+from app.utils.breaker import CircuitOpen, open_state
+from app.utils.cache import TTLCache
+from app.utils.deferred import failures
+from app.utils.hashing import hashers, tune_cost
+from app.utils.metrics import registry
+from app.utils.outbox import dispatch_batch
+from app.utils.profiler import query_budget, QueryBudgetExceeded
+from app.utils.pool import checkout_wait, connects, in_use
+from app.utils.pool import InstrumentedQueuePool, instrument_pool
+from app.utils.pool import prewarm_pools
+from app.utils.ratelimit import MemoryBucketStore, RedisBucketStore
+from app.utils.registered import RegisteredEmails
+from app.utils.repository import email_exists, get_by_email, get_role
+from app.utils.repository import get_with_roles
+from app.utils.routing import STICKY_KEY
+from app.utils.tokens import CompactSigner
+from app.utils.user import change_pw, load_user, record_auth_fail
+from test.setup_tests import ADM, FakeSMTPServer, force_auth_user
+from test.setup_tests import SetupTest, USR
+
+
+class TestHashPool(SetupTest):
+    """Tests the password hashing pool in app.utils.hashing.py"""
+
+    def test_hash_and_check(self):
+        """Ensure hashes made by the pool verify correctly."""
+        pw_hash = hash_pool.hashpw("password")
+        assert hash_pool.checkpw("password", pw_hash, hash_pool.algo)
+        assert not hash_pool.checkpw("pass", pw_hash, hash_pool.algo)
+
+    def test_default_workers(self):
+        """Ensure default workers share the cores and fit the pending cap."""
+        self.app.config["PW_HASH_WORKERS"] = None
+        self.app.config["PW_HASH_PROCESSES"] = 10 ** 6
+        hash_pool.init_app(self.app)
+        assert hash_pool.workers == 1
+
+        self.app.config["PW_HASH_PROCESSES"] = 1
+        hash_pool.init_app(self.app)
+        assert hash_pool.workers <= self.app.config["PW_HASH_MAX_PENDING"]
+        hash_pool.start()
+        pw_hash = hash_pool.hashpw("password")
+        assert hash_pool.checkpw("password", pw_hash, hash_pool.algo)
+        hash_pool.shutdown()
+
+    def test_argon2id(self):
+        """Ensure argon2id hashes verify correctly."""
+        hasher = hashers["argon2id"]
+        pw_hash = hasher.hash(b"password", hasher.min_cost)
+        assert hasher.check(b"password", pw_hash)
+        assert not hasher.check(b"pass", pw_hash)
+
+    def test_tune_cost(self):
+        """Ensure cost tuning never drops below the hasher's minimum."""
+        hasher = hashers["bcrypt"]
+        assert tune_cost(hasher, 0) == hasher.min_cost
+        assert tune_cost(hasher, 0, 12) == 12
+
+    def test_rehash_upward(self):
+        """Ensure hashes are only rehashed to a higher cost or new algo."""
+        assert hash_pool.needs_rehash(hash_pool.algo, hash_pool.cost - 1)
+        assert hash_pool.needs_rehash(hash_pool.algo, None)
+        assert hash_pool.needs_rehash("argon2id", hash_pool.cost)
+        assert not hash_pool.needs_rehash(hash_pool.algo, hash_pool.cost)
+        assert not hash_pool.needs_rehash(hash_pool.algo, hash_pool.cost + 5)
+
+    def test_rehash_on_login(self):
+        """Ensure out of date hashes are replaced on a successful login."""
+        user = User.query.filter(User.email == USR).first()
+        user.pw_hash = hashers["argon2id"].hash(b"password", 2)
+        user.pw_algo = "argon2id"
+        user.pw_cost = 2
+        db.session.commit()
+
+        assert authenticate(USR, "password").success
+        user = User.query.filter(User.email == USR).first()
+        assert user.pw_algo == hash_pool.algo
+        assert user.pw_cost == hash_pool.cost
+        assert authenticate(USR, "password").success
+
+    def test_busy_api(self):
+        """Ensure API requests fail fast when the pool is saturated."""
+        slots = hash_pool._slots
+        while slots.acquire(blocking=False):
+            pass
+        resp = self.client.post(
+            url_for("api.token"),
+            data=json.dumps({"email": USR, "password": "password"}),
+            content_type="application/json",
+        )
+        data = json.loads(resp.get_data())
+        assert resp.status_code == 503
+        assert data["status"] == "failure"
+        assert resp.headers["Retry-After"] == str(hash_pool.retry_after)
+
+    def test_busy_ui(self):
+        """Ensure UI requests fail fast when the pool is saturated."""
+        slots = hash_pool._slots
+        while slots.acquire(blocking=False):
+            pass
+        data = {"email": USR, "pw": "password"}
+        resp = self.client.post(url_for("user.login"), data=data)
+        assert resp.status_code == 503
+        assert b"Server Busy" in resp.data
+        assert "Retry-After" in resp.headers
+
+
+class TestCache(SetupTest):
+    """Tests the caches in app.utils.cache.py"""
+
+    def test_ttl_cache(self):
+        """Ensure entries are evicted by age and by least recent use."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        cache.set("d", 4, ttl=0)
+        assert cache.get("d") is None
+
+    def test_credential_cache(self):
+        """Ensure cached logins skip hashing until the password changes."""
+        self.app.config["AUTH_CACHE_TTL_SEC"] = 60
+        cred_cache.init_app(self.app)
+        assert authenticate(USR, "password").success
+
+        # Saturate the hashing pool so only cached logins can succeed
+        slots = hash_pool._slots
+        while slots.acquire(blocking=False):
+            pass
+        assert authenticate(USR, "password").success
+        assert not cred_cache.check(USR, "pass")
+        hash_pool.init_app(self.app)
+
+        change_pw(USR, "new_password")
+        assert not cred_cache.check(USR, "password")
+        assert not authenticate(USR, "password").success
+
+    def test_credential_cache_revoked(self):
+        """Ensure a revocation by another process drops cached logins."""
+        self.app.config["AUTH_CACHE_TTL_SEC"] = 60
+        cred_cache.init_app(self.app)
+        cred_cache.add(USR, "password")
+        assert cred_cache.check(USR, "password")
+
+        # Another worker changed the password, leaving this cache as it was
+        revocations.revoke_user(USR)
+        assert not cred_cache.check(USR, "password")
+
+
+class TestJWT(SetupTest):
+    """Tests the JWT utilities in app.utils.auth.py"""
+
+    def test_validate_cached(self):
+        """Ensure verified tokens are served from the cache."""
+        jwt_cache.clear()
+        token = generate_jwt(USR, ["user"])
+        token_data = validate_jwt(token)
+        assert token_data["sub"] == USR
+        assert len(jwt_cache) == 1
+        assert validate_jwt(token) is token_data
+        assert validate_jwt(token[:-2]) is None
+        assert len(jwt_cache) == 1
+
+    def test_compact_format(self):
+        """Ensure compact tokens are used and legacy tokens still accepted."""
+        token = generate_jwt(USR, ["user"])
+        assert token.count(".") == 1
+        assert validate_jwt(token)["roles"] == ["user"]
+
+        self.app.config["JWT_FORMAT"] = "legacy"
+        legacy = generate_jwt(USR, ["user"])
+        assert legacy.count(".") == 2
+        assert validate_jwt(legacy)["sub"] == USR
+
+        jwt_cache.clear()
+        self.app.config["JWT_ACCEPT_LEGACY"] = False
+        assert validate_jwt(legacy) is None
+
+    def test_compact_signer(self):
+        """Ensure tampered and expired compact tokens are rejected."""
+        signer = CompactSigner("another-secret")
+        token = signer.dumps({"sub": USR, "exp": 2 ** 40})
+        assert signer.loads(token)["sub"] == USR
+        assert validate_jwt(token) is None
+        assert validate_jwt(signer.dumps({"sub": USR, "exp": 0})) is None
+        assert validate_jwt("not.a.token") is None
+        assert validate_jwt("garbage") is None
+
+
+class TestRevocation(SetupTest):
+    """Tests token revocation in app.utils.revoke.py"""
+
+    def test_bloom_filter(self):
+        """Ensure added items are always found and misses are rare."""
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"in{i}")
+        assert all(f"in{i}" in bloom for i in range(1000))
+        assert sum(f"out{i}" in bloom for i in range(1000)) < 50
+
+    def test_revoked_token(self):
+        """Ensure a token is rejected after it changes the password."""
+        token = generate_jwt(USR, ["user"])
+        resp = self.client.put(
+            url_for("api.change_password"),
+            data=json.dumps({"password": "new_password"}),
+            content_type="application/json",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert resp.status_code == 200
+        assert validate_jwt(token) is None
+
+    def test_revoked_user(self):
+        """Ensure only tokens issued before a user revocation are rejected."""
+        signer = CompactSigner(self.app.config["SECRET_KEY"])
+        old = signer.dumps(
+            {"sub": USR, "roles": ["user"], "iat": 0, "exp": 2 ** 40}
+        )
+        assert validate_jwt(old)["sub"] == USR
+        revocations.revoke_user(USR)
+        assert validate_jwt(old) is None
+        assert validate_jwt(generate_jwt(USR, ["user"]))["sub"] == USR
+
+
+class TestLoginFailures(SetupTest):
+    """Tests failed login counting in app.utils.counters.py"""
+
+    def test_lockout(self):
+        """Ensure the user row is only written once the lockout starts."""
+        limit = self.app.config["AUTH_FAILS"]
+        for _ in range(limit):
+            assert not authenticate(USR, "pass").success
+        assert login_failures.count(USR) == limit
+        assert User.query.filter(User.email == USR).first().auth_fail == 0
+
+        assert not authenticate(USR, "pass").success
+        assert User.query.filter(User.email == USR).first().auth_fail > limit
+        result = authenticate(USR, "password")
+        assert not result.success
+        assert "locked out" in result.message
+
+        change_pw(USR, "password")
+        assert login_failures.count(USR) == 0
+        assert authenticate(USR, "password").success
+
+    def test_record_auth_fail(self):
+        """Ensure stored failures are incremented rather than overwritten."""
+        user_id = User.query.filter(User.email == USR).first().id
+        assert record_auth_fail(user_id, 4) == 4
+        assert record_auth_fail(user_id, 4) == 5
+        assert record_auth_fail(user_id, 9) == 9
+        assert User.query.get(user_id).auth_fail == 9
+
+    def test_change_unknown_user(self):
+        """Ensure changing the password of an unknown email fails."""
+        slots = hash_pool._slots
+        while slots.acquire(blocking=False):
+            pass
+        result = change_pw("nobody@example.com", "password")
+        assert not result.success
+        assert "not registered" in result.message
+
+    def test_success_resets(self):
+        """Ensure a successful login clears the failure count."""
+        assert not authenticate(USR, "pass").success
+        assert login_failures.count(USR) == 1
+        assert authenticate(USR, "password").success
+        assert login_failures.count(USR) == 0
+
+
+class TestRateLimit(SetupTest):
+    """Tests the token bucket rate limiter in app.utils.ratelimit.py"""
+
+    def test_bucket_store(self):
+        """Ensure a bucket empties and reports how long until it refills."""
+        store = MemoryBucketStore()
+        assert store.take("key", 2, 60) == 0
+        assert store.take("key", 2, 60) == 0
+        assert 0 < store.take("key", 2, 60) <= 30
+        assert store.take("other", 2, 60) == 0
+
+    def test_bucket_prune(self):
+        """Ensure buckets that have refilled are dropped from the store."""
+        store = MemoryBucketStore(prune_sec=0)
+        store.take("key", 2, 60)
+        store.take("fast", 1000, 0.001)
+        sleep(0.01)
+        store.take("other", 2, 60)
+        assert len(store) == 2
+        assert "fast" not in store._buckets
+
+    def test_redis_timeout(self):
+        """Ensure Redis stores fail fast rather than hang."""
+        store = RedisBucketStore("redis://localhost:6379/1", timeout=0.25)
+        kwargs = store.redis.connection_pool.connection_kwargs
+        assert kwargs["socket_timeout"] == 0.25
+        assert kwargs["socket_connect_timeout"] == 0.25
+
+    def test_account_limit(self):
+        """Ensure token requests past the account limit are rejected."""
+        self.app.config["RATELIMIT_ENABLED"] = True
+        data = json.dumps({"email": USR, "password": "pass"})
+        for _ in range(10):
+            resp = self.client.post(
+                url_for("api.token"),
+                data=data,
+                content_type="application/json",
+            )
+            assert resp.status_code != 429
+        resp = self.client.post(
+            url_for("api.token"), data=data, content_type="application/json"
+        )
+        assert resp.status_code == 429
+        assert int(resp.headers["Retry-After"]) > 0
+        assert resp.get_json()["status"] == "failure"
+
+    def test_ip_limit(self):
+        """Ensure the login page is rejected past the address limit."""
+        self.app.config["RATELIMIT_ENABLED"] = True
+        for i in range(10):
+            data = {"email": f"{i}@usr.com", "pw": "pass"}
+            resp = self.client.post(url_for("user.login"), data=data)
+            assert resp.status_code != 429
+        assert self.client.get(url_for("user.login")).status_code == 200
+        data = {"email": USR, "pw": "pass"}
+        resp = self.client.post(url_for("user.login"), data=data)
+        assert resp.status_code == 429
+        assert b"Too Many Requests" in resp.data
+
+
+class TestUserCache(SetupTest):
+    """Tests the logged in user cache in app.utils.cache.py"""
+
+    def test_cached_page_view(self):
+        """Ensure an authenticated page view makes no queries once cached."""
+        data = {"email": USR, "pw": "password"}
+        self.client.post(url_for("user.login"), data=data)
+        self.client.get(url_for("user.delete"))
+        with self.assert_max_queries(0):
+            resp = self.client.get(url_for("user.delete"))
+        assert resp.status_code == 200
+
+    def test_invalidation(self):
+        """Ensure password and role changes drop the cached snapshot."""
+        user = User.query.filter(User.email == USR).first()
+        snapshot = load_user(str(user.id))
+        assert snapshot.get_roles() == ["user"]
+        assert load_user(str(user.id)) is snapshot
+
+        user.roles.append(Role.query.filter_by(name="admin").first())
+        db.session.commit()
+        assert user_cache.get(user.id) is None
+        assert set(load_user(str(user.id)).get_roles()) == {"user", "admin"}
+
+        snapshot = load_user(str(user.id))
+        change_pw(USR, "new-password")
+        assert load_user(str(user.id)) is not snapshot
+
+
+class TestRepository(SetupTest):
+    """Tests the baked user lookups in app.utils.repository.py"""
+
+    def test_lookups(self):
+        """Ensure each lookup finds existing rows and nothing otherwise."""
+        user = get_by_email(USR)
+        assert user.email == USR
+        assert get_by_email("nobody@example.com") is None
+        assert email_exists(ADM)
+        assert not email_exists("nobody@example.com")
+        assert get_role("admin").name == "admin"
+        assert get_role("nobody") is None
+
+    def test_roles_loaded(self):
+        """Ensure a user and their roles are loaded in one query."""
+        user_id = get_by_email(ADM).id
+        db.session.remove()
+        with self.assert_max_queries(1):
+            user = get_with_roles(user_id)
+            assert set(user.get_roles()) == {"user", "admin"}
+        assert get_with_roles(0) is None
+
+
+class TestRegisteredEmails(SetupTest):
+    """Tests the registered email filter in app.utils.registered.py"""
+
+    def setUp(self):
+        super().setUp()
+        registered_emails.sync()
+        _, self.path = mkstemp(suffix=".bloom")
+
+    def tearDown(self):
+        remove(self.path)
+        super().tearDown()
+
+    def test_definite_miss(self):
+        """Ensure unregistered emails are answered without a query."""
+        with self.assert_max_queries(0):
+            assert get_by_email("nobody@example.com") is None
+            assert not email_exists("nobody@example.com")
+            assert not authenticate("nobody@example.com", "password").success
+        assert get_by_email(USR).email == USR
+
+    def test_added_on_insert(self):
+        """Ensure new users and bulk inserted users are seen."""
+        # noinspection PyArgumentList
+        db.session.add(User(email="new@example.com", pw_hash=b"hash"))
+        db.session.commit()
+        assert email_exists("new@example.com")
+
+        db.session.execute(
+            User.__table__.insert().values(email="bulk@a.com", pw_hash=b"h")
+        )
+        db.session.commit()
+        assert "bulk@a.com" not in registered_emails
+        registered_emails.sync()
+        assert "BULK@a.com" in registered_emails
+
+    def test_stale_filter(self):
+        """Ensure misses are looked up once the filter is out of date."""
+        db.session.execute(
+            User.__table__.insert().values(email="host@a.com", pw_hash=b"h")
+        )
+        db.session.commit()
+        assert get_by_email("host@a.com") is None
+        registered_emails._synced_at -= registered_emails.max_age + 1
+        assert not registered_emails.fresh
+        assert get_by_email("host@a.com").email == "host@a.com"
+
+    def test_sync_after_response(self):
+        """Ensure a due sync runs once the response has been sent."""
+        db.session.execute(
+            User.__table__.insert().values(email="late@a.com", pw_hash=b"h")
+        )
+        db.session.commit()
+        registered_emails._next_sync = 0
+        resp = self.client.get(url_for("api.health"))
+        assert "late@a.com" not in registered_emails
+        resp.close()
+        assert "late@a.com" in registered_emails
+
+    def test_out_of_order(self):
+        """Ensure a user committed below the highest ID held is seen."""
+        db.session.execute(
+            User.__table__.insert().values(
+                id=100, email="high@a.com", pw_hash=b"h"
+            )
+        )
+        db.session.commit()
+        registered_emails.sync()
+        db.session.execute(
+            User.__table__.insert().values(
+                id=50, email="late@a.com", pw_hash=b"h"
+            )
+        )
+        db.session.commit()
+        assert not email_exists("late@a.com")
+        registered_emails.sync()
+        assert email_exists("late@a.com")
+
+    def test_shared_file(self):
+        """Ensure processes mapping the same file share the filter."""
+        self.app.config["EMAIL_FILTER_PATH"] = self.path
+        worker = RegisteredEmails(self.app)
+        other = RegisteredEmails(self.app)
+        assert USR in worker and USR in other
+
+        worker.add(["shared@example.com"])
+        assert "shared@example.com" in other
+        worker.close()
+        other.close()
+
+
+class TestRoleUserMap(SetupTest):
+    """Tests the keys of role_user_map in app.models.db.py"""
+
+    def test_cascade(self):
+        """Ensure deleting a user deletes their roles without loading them."""
+        user = User.query.filter(User.email == ADM).first()
+        with self.assert_max_queries(1):
+            db.session.delete(user)
+            db.session.commit()
+        count = db.session.query(role_user_map).count()
+        assert count == 1
+
+    def test_duplicate(self):
+        """Ensure a role cannot be assigned to a user twice."""
+        row = {"user_id": get_by_email(USR).id, "role_id": get_role("user").id}
+        with self.assertRaises(IntegrityError):
+            db.session.execute(role_user_map.insert().values(row))
+        db.session.rollback()
+
+
+class TestSMTPPool(SetupTest):
+    """Tests the SMTP connection pool in app.utils.smtp.py"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeSMTPServer()
+        mail = self.app.extensions["mail"]
+        mail.server, mail.port = "127.0.0.1", self.server.port
+        mail.use_tls = mail.use_ssl = mail.suppress = False
+        mail.password = None
+        smtp_pool.init_app(self.app)
+
+    def tearDown(self):
+        smtp_pool.close()
+        self.server.stop()
+        super().tearDown()
+
+    def send(self, count: int = 1):
+        """Send messages one at a time."""
+        for i in range(count):
+            smtp_pool.send(
+                Message(f"Test {i}", sender="a@a.com", recipients=[USR])
+            )
+
+    def test_reuse(self):
+        """Ensure every message is sent over one connection."""
+        self.send(3)
+        smtp_pool.send(
+            Message("Welcome", sender="a@a.com", recipients=[USR]),
+            Message("New User", sender="a@a.com", recipients=[ADM]),
+        )
+        assert len(self.server.messages) == 5
+        assert self.server.connections == 1
+
+    def test_max_messages(self):
+        """Ensure a connection is replaced after its message limit."""
+        smtp_pool.max_messages = 2
+        self.send(5)
+        assert len(self.server.messages) == 5
+        assert self.server.connections == 3
+
+    def test_noop_check(self):
+        """Ensure an idle connection is checked before it is reused."""
+        smtp_pool.noop_sec = 0
+        self.send(2)
+        assert "NOOP" in self.server.commands
+        assert self.server.connections == 1
+
+    def test_reconnect(self):
+        """Ensure a message is resent when the server drops the connection."""
+        self.server.drop_after = 1
+        self.send(3)
+        assert len(self.server.messages) == 3
+        assert self.server.connections == 3
+
+
+class RecordingPool:
+    """Stands in for the SMTP pool, recording concurrent sends by domain."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.active = {}
+        self.peak = {}
+        self.sent = []
+        self.lock = Lock()
+
+    def send(self, message):
+        domain = message.send_to.copy().pop().split("@")[1]
+        with self.lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.active[domain] = self.active.get(domain, 0) + 1
+            peak = max(self.peak.get(domain, 0), self.active[domain])
+            self.peak[domain] = peak
+        sleep(0.02)
+        with self.lock:
+            self.active[domain] -= 1
+            self.sent.append(message)
+
+
+class TestDelivery(SetupTest):
+    """Tests the email delivery engine in app.utils.delivery.py"""
+
+    def setUp(self):
+        super().setUp()
+        delivery.init_app(self.app, RecordingPool())
+        delivery.enabled = True
+        delivery.concurrency = 8
+        delivery.domain_concurrency = 2
+        delivery.backoff_sec = 0
+
+    def tearDown(self):
+        delivery.close()
+        super().tearDown()
+
+    def submit(self, *recipients: str) -> list:
+        """Submit one message for each recipient."""
+        return [
+            delivery.submit(Message("Hi", sender="a@a.com", recipients=[r]))
+            for r in recipients
+        ]
+
+    def test_limits(self):
+        """Ensure messages are sent concurrently within each domain limit."""
+        recipients = [f"{i}@{d}" for i in range(6) for d in ("a.com", "b.com")]
+        futures = self.submit(*recipients)
+        wait(futures, timeout=5)
+        assert all(f.exception() is None for f in futures)
+        assert len(delivery.pool.sent) == 12
+        assert delivery.pool.peak == {"a.com": 2, "b.com": 2}
+
+    def test_retry(self):
+        """Ensure temporary failures are retried and permanent ones are not."""
+        delivery.pool.errors = [
+            SMTPServerDisconnected("Connection lost"),
+            SMTPResponseException(451, b"Try again later"),
+        ]
+        assert self.submit(USR)[0].result(timeout=5) is None
+        assert len(delivery.pool.sent) == 1
+
+        delivery.pool.errors = [SMTPResponseException(550, b"No such user")]
+        future = self.submit(USR)[0]
+        assert isinstance(future.exception(timeout=5), SMTPResponseException)
+        assert len(delivery.pool.sent) == 1
+
+    def test_deliver(self):
+        """Ensure deliver waits for its messages and raises failures."""
+        msg = Message("Hi", sender="a@a.com", recipients=[USR])
+        delivery.deliver(msg, msg)
+        assert len(delivery.pool.sent) == 2
+
+        delivery.pool.errors = [SMTPResponseException(550, b"No such user")]
+        with self.assertRaises(SMTPResponseException):
+            delivery.deliver(msg)
+
+        delivery.pool.errors = [SMTPResponseException(550, b"No such user")]
+        with delivery.collect() as futures:
+            delivery.deliver(msg)
+        assert isinstance(futures[0].exception(timeout=5), Exception)
+
+    def test_outbox_retry(self):
+        """Ensure outbox tasks whose email failed temporarily are retried."""
+        from app.tasks import send_outbox
+
+        delivery.retries = 0
+        delivery.pool.errors = [SMTPServerDisconnected("Connection lost")]
+        send_outbox.apply(
+            args=[
+                [
+                    ["app.tasks.send_new_user_email", [USR]],
+                    ["app.tasks.send_contact_email", ["A", "B", "Hi"]],
+                ]
+            ]
+        )
+        subjects = {m.subject for m in delivery.pool.sent}
+        assert subjects == {
+            "CRC Welcome",
+            "CRC New User",
+            "CRC User Message : A B",
+        }
+
+    def test_smtp(self):
+        """Ensure messages are delivered over pooled SMTP connections."""
+        server = FakeSMTPServer()
+        mail = self.app.extensions["mail"]
+        mail.server, mail.port = "127.0.0.1", server.port
+        mail.use_tls = mail.use_ssl = mail.suppress = False
+        mail.password = None
+        smtp_pool.init_app(self.app)
+        delivery.pool = smtp_pool
+        try:
+            wait(self.submit(*[f"{i}@a.com" for i in range(10)]), timeout=5)
+            assert len(server.messages) == 10
+            assert server.connections <= delivery.domain_concurrency
+        finally:
+            smtp_pool.close()
+            server.stop()
+
+
+class TestDeferredDispatch(SetupTest):
+    """Tests the after response publishing in app.utils.deferred.py"""
+
+    def register(self, email: str):
+        data = {"email": email, "pw": "testing123", "confirm": "testing123"}
+        return self.client.post(url_for("user.register"), data=data)
+
+    def test_after_close(self):
+        """Ensure a request's tasks are published once its response closes."""
+        with mail.record_messages() as outbox:
+            resp = self.register("new@usr.com")
+            assert resp.status_code == 302
+            assert Outbox.query.count() == 1
+            assert len(outbox) == 0
+
+            resp.close()
+        assert Outbox.query.count() == 0
+        assert len(outbox) == 2
+
+    def test_failure(self):
+        """Ensure a failed publish leaves the tasks for the dispatcher."""
+        before = failures.value()
+        resp = self.register("new@usr.com")
+        db.session.execute(Outbox.__table__.update().values(args="{"))
+        db.session.commit()
+
+        resp.close()
+        assert failures.value() == before + 1
+        assert Outbox.query.count() == 1
+
+    def test_disabled(self):
+        """Ensure tasks are left to the dispatcher when disabled."""
+        deferred.enabled = False
+        self.register("new@usr.com").close()
+        assert Outbox.query.count() == 1
+
+
+class TestCircuitBreaker(SetupTest):
+    """Tests the circuit breaker in app.utils.breaker.py"""
+
+    def open(self):
+        for _ in range(self.app.config["BROKER_BREAKER_FAILURES"]):
+            broker_breaker.failure()
+
+    def test_states(self):
+        """Ensure the breaker opens, probes and then closes again."""
+        broker_breaker.reset_sec = 0.05
+        broker_breaker.failure()
+        assert not broker_breaker.is_open
+        assert broker_breaker.allow()
+
+        self.open()
+        assert broker_breaker.is_open
+        assert open_state.value(name="broker") == 1
+        assert not broker_breaker.allow()
+
+        sleep(0.06)
+        assert broker_breaker.allow()
+        assert not broker_breaker.allow()
+        broker_breaker.failure()
+        assert not broker_breaker.allow()
+
+        sleep(0.06)
+        assert broker_breaker.allow()
+        broker_breaker.success()
+        assert not broker_breaker.is_open
+        assert open_state.value(name="broker") == 0
+        assert broker_breaker.allow()
+
+    def test_slow_publish(self):
+        """Ensure publishes slower than the limit open the breaker."""
+        self.app.config["BROKER_SLOW_PUBLISH_SEC"] = -1
+        for _ in range(self.app.config["BROKER_BREAKER_FAILURES"]):
+            db.session.add(Outbox(task="app.tasks.missing", args="[]"))
+            db.session.commit()
+            assert dispatch_batch(10) == 1
+        assert broker_breaker.is_open
+
+    def test_outbox(self):
+        """Ensure tasks stay in the outbox while the breaker is open."""
+        self.open()
+        resp = self.client.post(
+            url_for("user.register"),
+            data={
+                "email": "new@usr.com",
+                "pw": "testing123",
+                "confirm": "testing123",
+            },
+        )
+        resp.close()
+        assert Outbox.query.count() == 1
+
+        with self.assertRaises(CircuitOpen) as e:
+            dispatch_batch(10)
+        assert e.exception.retry_after > 0
+        assert Outbox.query.count() == 1
+
+        broker_breaker.success()
+        assert dispatch_batch(10) == 1
+        assert Outbox.query.count() == 0
+
+
+class TestReplicaRouting(SetupTest):
+    """Tests read replica routing in app.utils.routing.py"""
+
+    def setUp(self):
+        super().setUp()
+        uri = self.app.config["SQLALCHEMY_DATABASE_URI"]
+        self.app.config["SQLALCHEMY_BINDS"] = {"replica": uri}
+        self.app.config["DB_REPLICA_BINDS"] = ["replica"]
+        session.pop(STICKY_KEY, None)
+        db.session.remove()
+
+        self.replica_reads = []
+        self.replica = db.get_engine(self.app, bind="replica")
+        db.event.listen(self.replica, "before_cursor_execute", self.count)
+
+    def tearDown(self):
+        db.event.remove(self.replica, "before_cursor_execute", self.count)
+        db.session.remove()
+        super().tearDown()
+
+    def count(self, *args):
+        self.replica_reads.append(args[2])
+
+    def test_reads_use_replica(self):
+        """Ensure reads use the replica until the session writes."""
+        user = User.query.filter(User.email == USR).first()
+        assert len(self.replica_reads) == 1
+
+        user.auth_fail = 1
+        db.session.commit()
+        assert User.query.filter(User.email == USR).first().auth_fail == 1
+        assert len(self.replica_reads) == 1
+        assert session[STICKY_KEY] > 0
+
+    def test_stateless_commit(self):
+        """Ensure API and replica free commits never set a cookie."""
+        token = generate_jwt(USR, ["user"])
+        data = {"first": "A", "last": "B", "message": "Hi"}
+        for replicas in (["replica"], []):
+            self.app.config["DB_REPLICA_BINDS"] = replicas
+            resp = self.client.post(
+                url_for("api.message"),
+                data=json.dumps(data),
+                content_type="application/json",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            assert resp.status_code == 200
+            assert "Set-Cookie" not in resp.headers
+
+        user = User.query.filter(User.email == USR).first()
+        user.auth_fail = 1
+        db.session.commit()
+        assert STICKY_KEY not in session
+
+    def test_use_primary(self):
+        """Ensure use_primary and recent commits bypass the replica."""
+        with db.use_primary():
+            assert User.query.filter(User.email == USR).first()
+        db.session.remove()
+
+        session[STICKY_KEY] = 2 ** 31
+        assert User.query.filter(User.email == USR).first()
+        assert self.replica_reads == []
+
+
+class TestPoolMetrics(SetupTest):
+    """Tests connection pool instrumentation in app.utils.pool.py"""
+
+    def setUp(self):
+        super().setUp()
+        _, self.path = mkstemp(suffix=".db")
+        self.engine = create_engine(
+            f"sqlite:///{self.path}",
+            poolclass=InstrumentedQueuePool,
+            pool_size=2,
+            max_overflow=1,
+        )
+        instrument_pool(self.engine.pool, "test-pool")
+
+    def tearDown(self):
+        self.engine.dispose()
+        remove(self.path)
+        super().tearDown()
+
+    def test_checkouts(self):
+        """Ensure checkouts record their wait, use and new connections."""
+        waits = checkout_wait.count(pool="test-pool")
+        opened = connects.value(pool="test-pool")
+        conns = [self.engine.connect() for _ in range(3)]
+        assert checkout_wait.count(pool="test-pool") == waits + 3
+        assert connects.value(pool="test-pool") == opened + 3
+        assert in_use.value(pool="test-pool") == 3
+        for conn in conns:
+            conn.close()
+        assert in_use.value(pool="test-pool") == 0
+
+    def test_prewarm(self):
+        """Ensure pre-warming opens up to the pool size of connections."""
+        self.app.config["DB_POOL_PREWARM"] = 5
+        opened = connects.value(pool="test-pool")
+        prewarm_pools(self.app, [self.engine])
+        assert connects.value(pool="test-pool") == opened + 2
+        assert self.engine.pool.checkedin() == 2
+
+    def test_metrics_view(self):
+        """Ensure metrics are only served to the allowed addresses."""
+        self.engine.connect().close()
+        resp = self.client.get(url_for("api.metrics"))
+        assert resp.status_code == 200
+        assert b'db_pool_in_use{pool="test-pool"' in resp.data
+        assert registry.render().startswith("# HELP")
+
+        resp = self.client.get(
+            url_for("api.metrics"), environ_base={"REMOTE_ADDR": "10.0.0.1"}
+        )
+        assert resp.status_code == 404
+
+
+class TestProfiler(SetupTest):
+    """Tests the SQL profiler in app.utils.profiler.py"""
+
+    def test_profiled_route(self):
+        """Ensure profiled routes report their queries and others do not."""
+        force_auth_user(app=self.app, admin=True)
+        args = {"order[0][column]": 0}
+        resp = self.client.get(url_for("admin.users", **args))
+        assert "X-SQL-Queries" not in resp.headers
+
+        profiler.routes.add("admin.users")
+        resp = self.client.get(url_for("admin.users", **args))
+        assert int(resp.headers["X-SQL-Queries"]) >= 2
+        assert float(resp.headers["X-SQL-Time-Ms"]) > 0
+
+    def test_settings_view(self):
+        """Ensure only allowed addresses can change profiling at runtime."""
+        url = url_for("api.sql_profiler")
+        data = json.dumps({"sample_rate": 0.5, "routes": ["admin.users"]})
+        resp = self.client.put(
+            url,
+            data=data,
+            content_type="application/json",
+            environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        )
+        assert resp.status_code == 404
+        assert profiler.sample_rate == 0.0
+
+        resp = self.client.put(
+            url, data=data, content_type="application/json"
+        )
+        assert resp.json == {"sample_rate": 0.5, "routes": ["admin.users"]}
+        assert profiler.routes == {"admin.users"}
+
+        resp = self.client.put(
+            url,
+            data=json.dumps({"sample_rate": 2}),
+            content_type="application/json",
+        )
+        assert resp.status_code == 400
+        assert self.client.get(url).json["sample_rate"] == 0.5
+
+    def test_slow_query(self):
+        """Ensure slow queries are logged with their query plan."""
+        profiler.sample_rate = 1.0
+        profiler.slow_sec = 0
+        profiler.logger = logging.getLogger("test.profiler")
+        with self.assertLogs(profiler.logger, "WARNING") as logs:
+            self.client.get(url_for("user.login"))
+            force_auth_user(app=self.app, admin=True)
+            self.client.get(url_for("admin.users"))
+        assert any("Slow query" in line for line in logs.output)
+        assert any("SCAN" in line or "SEARCH" in line for line in logs.output)
+
+    def test_query_budget(self):
+        """Ensure a view over its query budget fails loudly in tests."""
+
+        @query_budget(1)
+        def two_queries():
+            User.query.first()
+            User.query.first()
+            return "ok"
+
+        self.app.add_url_rule("/two", "two", two_queries)
+        with self.assertRaises(QueryBudgetExceeded) as e:
+            self.client.get("/two")
+        assert "ran 2 queries, over its budget of 1" in str(e.exception)
+
+        self.app.config["QUERY_BUDGET_STRICT"] = False
+        assert self.client.get("/two").status_code == 200
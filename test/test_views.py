@@ -2,6 +2,9 @@
 
 from flask import url_for
 
+from app.extensions import db, registered_emails
+from app.models.db import Outbox, User
+from app.utils.admin import count_cache
 from app.utils.auth import serialize_pw_token
 from test.setup_tests import force_anon_user, force_auth_user, SetupTest, USR
 
@@ -23,6 +26,22 @@ RESET_SUCCESS = b"Your password has been updated successfully"
 UNAUTHORIZED = b">You are not authorized to access the URL requested</p>"
 
 
+class TestQueryBudgets(SetupTest):
+    """Tests the query budgets of the views in app.views"""
+
+    def test_budgets(self):
+        """Ensure every view declares a query budget."""
+        self.assert_query_budgets("admin", "base", "user")
+
+    def test_cached_page(self):
+        """Ensure a logged in page view runs no queries once cached."""
+        data = {"email": USR, "pw": "password"}
+        self.client.post(url_for("user.login"), data=data)
+        self.client.get(url_for("base.index"))
+        with self.assert_max_queries(0):
+            self.client.get(url_for("base.index"))
+
+
 class TestAdmin(SetupTest):
     """Tests the views in app.views.admin.py"""
 
@@ -33,6 +52,37 @@ class TestAdmin(SetupTest):
         assert resp.status_code == 200
         assert UNAUTHORIZED not in resp.data
 
+    def test_users_page(self):
+        """Ensure the user table pages by seeking and searches by prefix."""
+        for i in range(12):
+            db.session.add(User(email=f"page{i:02d}@usr.com", pw_hash=b"x"))
+        db.session.commit()
+        count_cache.clear()
+        force_auth_user(app=self.app, admin=True)
+
+        args = {"length": 5, "order[0][column]": 0, "order[0][dir]": "asc"}
+        resp = self.client.get(url_for("admin.users", **args))
+        page = resp.get_json()
+        assert page["recordsTotal"] == 14
+        assert [row["email"] for row in page["data"]][:2] == [
+            "adm@adm.com",
+            "page00@usr.com",
+        ]
+        assert page["data"][0]["roles"] == "admin, user"
+
+        args.update({"start": 5, "after": page["next"]})
+        resp = self.client.get(url_for("admin.users", **args))
+        assert resp.get_json()["data"][0]["email"] == "page04@usr.com"
+
+        args = {"search[value]": "Page1", "order[0][column]": 3}
+        resp = self.client.get(url_for("admin.users", **args))
+        page = resp.get_json()
+        assert page["recordsFiltered"] == 2
+        assert [row["email"] for row in page["data"]] == [
+            "page11@usr.com",
+            "page10@usr.com",
+        ]
+
     def test_no_auth(self):
         """Ensure anonymous users cannot reach the admin page."""
         force_anon_user(app=self.app)
@@ -199,6 +249,12 @@ class TestRecoverUser(SetupTest):
         assert LOGIN in resp.data
         assert RECOVER_SUCCESS in resp.data
 
+    def test_recover_no_token_stored(self):
+        """Ensure the reset token is not written to the outbox."""
+        data = {"email": USR, "confirm": USR}
+        self.client.post(url_for("user.recover"), data=data)
+        assert [row.args for row in Outbox.query] == [f'["{USR}"]']
+
     def test_recover_invalid(self):
         """Ensure invalid recover form information is rejected."""
         data_sets = [
@@ -234,6 +290,24 @@ class TestRegisterUser(SetupTest):
         assert LOGIN in resp.data
         assert REGISTER_SUCCESS in resp.data
 
+    def test_register_unsynced(self):
+        """Ensure an email missing from the filter is still a duplicate."""
+        registered_emails.sync()
+        db.session.execute(
+            User.__table__.insert().values(email="other@a.com", pw_hash=b"h")
+        )
+        db.session.commit()
+        data = {
+            "email": "other@a.com",
+            "pw": "testing123",
+            "confirm": "testing123",
+        }
+        resp = self.client.post(
+            url_for("user.register"), data=data, follow_redirects=True
+        )
+        assert resp.status_code == 200
+        assert b"account already exists" in resp.data
+
     def test_register_invalid(self):
         """Ensure invalid register form information is rejected."""
         data_sets = [